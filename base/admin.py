@@ -1,27 +1,148 @@
 from django.contrib import admin
-from .models import Item, Stock, Order, OrderItem
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .analytics import sales_summary
+from .caching import invalidate_on_commit
+from .models import Item, Stock, StockMovement, Order, OrderItem, DailySales, OutboxMessage
+
+
+# 件数が多いテーブル用のページネーター。COUNT(*) で全件を数えずに件数を見積もる。
+# 絞り込みなしなら統計情報（PostgreSQL）か最大のIDから、
+# 絞り込みありなら COUNT_LIMIT 件までだけ数える。
+class EstimatedCountPaginator(Paginator):
+    COUNT_LIMIT = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = self.estimate_table_rows(queryset.model, connections[queryset.db])
+            if estimate is not None and estimate > self.COUNT_LIMIT:
+                return estimate
+        return queryset.order_by()[:self.COUNT_LIMIT].count()
+
+    def estimate_table_rows(self, model, connection):
+        table = model._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+            else:
+                cursor.execute(f"SELECT MAX({connection.ops.quote_name(model._meta.pk.column)}) FROM {connection.ops.quote_name(table)}")
+            row = cursor.fetchone()
+        return int(row[0]) if row and row[0] is not None and row[0] >= 0 else None
+
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "address", "total_price", "created_at")  # 一覧表示
     list_filter = ("created_at",)  # 作成日でフィルタリング
     search_fields = ("user__username", "address__name")  # 検索フィールド
+    list_select_related = ("user", "address")  # 行ごとにユーザーと住所を読まない
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 @admin.register(OrderItem)
 class OrderItemAdmin(admin.ModelAdmin):
     list_display = ("order", "item", "quantity", "subtotal_price")  # 一覧表示
-    list_filter = ("order",)  # 注文ごとにフィルタリング
-    search_fields = ("item__name",)  # 商品名で検索
+    # 注文ごとの絞り込みは全注文を一覧に出してしまうので、作成日と注文番号の検索にする
+    list_filter = ("created_at",)
+    search_fields = ("item__name", "=order__id")  # 商品名・注文番号で検索
+    list_select_related = ("order__user", "item")
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
 class StockInLine(admin.StackedInline):
     model = Stock
     extra = 1
 class ItemAdmin(admin.ModelAdmin):
-    list_display = ["name", "get_stock", "created_at"]
+    list_display = ["name", "sku", "price", "price_with_tax", "tax_category", "get_stock", "flash_sale", "created_at"]
+    list_filter = ["flash_sale", "tax_category"]
+    search_fields = ["name", "=sku"]
     inlines = [StockInLine]
+    actions = ["start_flash_sale", "end_flash_sale"]
+
+    # 在庫数はJOINして一緒に読み込み、並び替えもSQLで行う
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(stock_quantity=Coalesce("stock__quantity", 0))
 
+    @admin.display(description="在庫", ordering="stock_quantity")
     def get_stock(self, obj):
-        stock = Stock.objects.filter(item=obj).first()
-        return stock.quantity if stock else 0
-    get_stock.short_description = "在庫"
-    
+        return obj.stock_quantity
+
+    # フラッシュセール中は、カートに入れる代わりに整理券で受け付ける（base.flash_sales）
+    @admin.action(description="選択した商品のフラッシュセールを始める")
+    def start_flash_sale(self, request, queryset):
+        self.set_flash_sale(request, queryset, True)
+
+    @admin.action(description="選択した商品のフラッシュセールを終える")
+    def end_flash_sale(self, request, queryset):
+        self.set_flash_sale(request, queryset, False)
+
+    def set_flash_sale(self, request, queryset, enabled):
+        item_ids = list(queryset.values_list("id", flat=True))
+        # update() ではシグナルが送られないので、キャッシュはここで無効にする
+        with transaction.atomic():
+            updated = Item.objects.filter(id__in=item_ids).update(flash_sale=enabled, updated_at=timezone.now())
+            invalidate_on_commit(item_ids, catalog=True)
+        self.message_user(request, f"{updated}件の商品を更新しました")
+
 admin.site.register(Item, ItemAdmin)
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ("created_at", "item", "kind", "quantity", "order", "note")
+    list_filter = ("kind", "created_at")
+    search_fields = ("item__name", "=order__id")
+    list_select_related = ("item", "order__user")
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    # 履歴は追記のみなので、管理画面からは変更・削除させない
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+# 売上ダッシュボード。rollup_sales で作った集計表だけを読み、注文のテーブルには触らない。
+@admin.register(DailySales)
+class DailySalesAdmin(admin.ModelAdmin):
+    change_list_template = "admin/base/dailysales/change_list.html"
+    list_display = ("date", "orders", "units", "revenue")
+    date_hierarchy = "date"
+    ordering = ("-date",)
+    show_full_result_count = False
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {**(extra_context or {}), "summary": sales_summary()}
+        return super().changelist_view(request, extra_context)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+# 注文確認メールの送信状況。送信は send_outbox コマンドが行うので、ここでは見るだけにする。
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ("created_at", "kind", "order", "to", "status", "attempts", "available_at", "sent_at")
+    list_filter = ("status", "kind")
+    search_fields = ("to", "=order__id")
+    list_select_related = ("order__user",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,129 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import DailySales, ItemSales, Order, OrderItem, RollupState
+
+SALES_ROLLUP = "sales"
+
+
+# 集計済みの位置より後の注文を batch_size 件だけ集計表に足し込み、位置を進める。
+# 足し込みと位置の更新は同じトランザクションなので、途中で止まっても二重に数えない。
+# 確定の遅れたトランザクションの注文を飛ばさないよう、SALES_ROLLUP_LAG_SECONDS より新しい注文は次回に回す。
+# 戻り値は集計した注文の件数（0なら追いついている）。
+def roll_up_batch(batch_size=1000, now=None):
+    cutoff = (now or timezone.now()) - timedelta(seconds=settings.SALES_ROLLUP_LAG_SECONDS)
+    with transaction.atomic():
+        state, _ = RollupState.objects.select_for_update().get_or_create(name=SALES_ROLLUP)
+        candidates = list(
+            Order.objects.filter(id__gt=state.last_order_id).order_by("id").values_list("id", "created_at")[:batch_size]
+        )
+        # 新しすぎる注文が出てきたら、そこで区切る（id の順に集計済みの位置を進めるため）
+        order_ids = []
+        for order_id, created_at in candidates:
+            if created_at > cutoff:
+                break
+            order_ids.append(order_id)
+        if not order_ids:
+            return 0
+        first_id, last_id = order_ids[0], order_ids[-1]
+
+        days = (
+            Order.objects.filter(id__range=(first_id, last_id))
+            .annotate(day=TruncDate("created_at"))
+            .values("day")
+            .annotate(orders=Count("id"), revenue=Sum("total_price"))
+            .order_by()
+        )
+        lines = (
+            OrderItem.objects.filter(order_id__gte=first_id, order_id__lte=last_id)
+            .annotate(day=TruncDate("order__created_at"))
+            .values("day", "item_id")
+            .annotate(units=Sum("quantity"), revenue=Sum("subtotal_price"))
+            .order_by()
+        )
+        daily = {row["day"]: row for row in days}
+        units_per_day = {}
+        per_item = {}
+        for row in lines:
+            units_per_day[row["day"]] = units_per_day.get(row["day"], 0) + row["units"]
+            per_item[(row["item_id"], row["day"])] = row
+
+        _add_daily(daily, units_per_day)
+        _add_item_sales(per_item)
+        state.last_order_id = last_id
+        state.save(update_fields=["last_order_id", "updated_at"])
+    return len(order_ids)
+
+
+def _add_daily(daily, units_per_day):
+    existing = {row.date: row for row in DailySales.objects.select_for_update().filter(date__in=daily)}
+    created = []
+    now = timezone.now()
+    for day, row in daily.items():
+        sales = existing.get(day) or DailySales(date=day)
+        sales.updated_at = now
+        sales.orders += row["orders"]
+        sales.revenue += row["revenue"]
+        sales.units += units_per_day.get(day, 0)
+        if sales.pk is None:
+            created.append(sales)
+    DailySales.objects.bulk_create(created)
+    DailySales.objects.bulk_update(existing.values(), ["orders", "units", "revenue", "updated_at"])
+
+
+def _add_item_sales(per_item):
+    days = {day for _, day in per_item}
+    item_ids = {item_id for item_id, _ in per_item}
+    existing = {
+        (row.item_id, row.date): row
+        for row in ItemSales.objects.select_for_update().filter(date__in=days, item_id__in=item_ids)
+    }
+    created = []
+    now = timezone.now()
+    for key, row in per_item.items():
+        sales = existing.get(key) or ItemSales(item_id=key[0], date=key[1])
+        sales.updated_at = now
+        sales.units += row["units"]
+        sales.revenue += row["revenue"]
+        if sales.pk is None:
+            created.append(sales)
+    ItemSales.objects.bulk_create(created)
+    ItemSales.objects.bulk_update(existing.values(), ["units", "revenue", "updated_at"])
+
+
+# 追いつくまで batch_size 件ずつ集計する。progress には集計済みの件数の合計を渡す。
+def roll_up(batch_size=1000, now=None, progress=None):
+    total = 0
+    while processed := roll_up_batch(batch_size, now):
+        total += processed
+        if progress:
+            progress(total)
+    return total
+
+
+# 管理画面の売上ダッシュボード用。集計表だけを読む。
+def sales_summary(days=30, top=10, today=None):
+    today = today or timezone.localdate()
+    since = today - timedelta(days=days - 1)
+    daily = list(DailySales.objects.filter(date__gte=since).order_by("-date"))
+    top_items = list(
+        ItemSales.objects.filter(date__gte=since)
+        .values("item_id", "item__name")
+        .annotate(units=Sum("units"), revenue=Sum("revenue"))
+        .order_by("-revenue", "item_id")[:top]
+    )
+    state = RollupState.objects.filter(name=SALES_ROLLUP).first()
+    return {
+        "since": since,
+        "daily": daily,
+        "top_items": top_items,
+        "orders": sum(row.orders for row in daily),
+        "units": sum(row.units for row in daily),
+        "revenue": sum(row.revenue for row in daily),
+        "rolled_up_at": state.updated_at if state else None,
+    }
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'base'
+
+    def ready(self):
+        # キャッシュを無効にするシグナルと、設定のチェックを登録する
+        from . import checks, signals  # noqa: F401
@@ -0,0 +1,355 @@
+import math
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.db.models import Sum
+from django.template import engines
+from django.template.base import Template
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .exceptions import OutOfStockError
+from .flash_sales import enqueue, process_flash_sales
+from .models import User, Address, Item, Stock, StockReservation, Cart, Payment
+from .pricing import tax_included
+from .reservations import reserve
+
+BENCHMARK_PASSWORD = "bench-pass-12345"
+
+
+# 商品・在庫・ユーザー・住所・カートをまとめて作る。返り値は (ユーザーのリスト, 商品のリスト)。
+def seed(items=100, users=20, cart_lines=3, stock=100000, prefix="bench", rng=None):
+    rng = rng or random.Random(0)
+    now = timezone.now()
+    prices = [rng.randrange(500, 20000, 10) for _ in range(items)]
+    created_items = Item.objects.bulk_create([
+        Item(
+            name=f"{prefix}商品{i}",
+            price=price,
+            price_with_tax=tax_included(price),
+            is_published=True,
+            information=f"{prefix}商品{i}の説明",
+        )
+        for i, price in enumerate(prices)
+    ])
+    # bulk_create で id が返らないDBのために読み直す
+    created_items = list(Item.objects.filter(name__startswith=f"{prefix}商品").order_by("id"))
+    Stock.objects.bulk_create([Stock(item=item, quantity=stock) for item in created_items])
+
+    password = make_password(BENCHMARK_PASSWORD)
+    User.objects.bulk_create([
+        User(username=f"{prefix}{now:%H%M%S}_{i}", email=f"{prefix}{now:%H%M%S}_{i}@example.com", password=password)
+        for i in range(users)
+    ])
+    created_users = list(User.objects.filter(username__startswith=f"{prefix}{now:%H%M%S}_").order_by("id"))
+    Address.objects.bulk_create([
+        Address(user=user, post_code="100-0001", address="東京都千代田区1-1", name=user.username, telephone_number="0300000000")
+        for user in created_users
+    ])
+    Cart.objects.bulk_create([
+        Cart(user=user, item=item, quantity=1)
+        for user in created_users
+        for item in rng.sample(created_items, min(cart_lines, len(created_items)))
+    ])
+    return created_users, created_items
+
+
+# 計測中に使う設定。キャッシュは計測ごとの専用のローカルメモリーにし、レプリカは使わない。
+# 本番の共有キャッシュ（Redisなど）を書き換えたり空にしたりせず、計測用のテストDBを持たないレプリカも読まないため。
+def _isolated_settings():
+    return {
+        "CACHES": {
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": f"benchmark-{time.time_ns()}",
+            },
+        },
+        "DATABASE_REPLICAS": [],
+    }
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+# 1ステップ（1リクエスト）ごとの処理時間とSQLの件数を記録する
+class FunnelRecorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def request(self, client, step, method, path, data=None, expect=(200, 302)):
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = getattr(client, method)(path, data or {})
+            elapsed = time.perf_counter() - started
+        self.latencies[step].append(elapsed)
+        self.queries[step].append(len(context.captured_queries))
+        if response.status_code not in expect:
+            self.errors[step] += 1
+        return response
+
+    def report(self, wall_time):
+        views = {}
+        for step, latencies in self.latencies.items():
+            total = sum(latencies)
+            views[step] = {
+                "requests": len(latencies),
+                "errors": self.errors[step],
+                "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+                "mean_queries": round(sum(self.queries[step]) / len(latencies), 2),
+                "max_queries": max(self.queries[step]),
+                "throughput_rps": round(len(latencies) / total, 2) if total else None,
+            }
+        requests = sum(view["requests"] for view in views.values())
+        return {
+            "views": views,
+            "requests": requests,
+            "wall_time_s": round(wall_time, 3),
+            "throughput_rps": round(requests / wall_time, 2) if wall_time else None,
+        }
+
+
+def _buy(recorder, client, user_id, item, address_id):
+    recorder.request(client, "index", "get", reverse("index"))
+    recorder.request(client, "item_detail", "get", reverse("item_detail", args=[item.id]))
+    recorder.request(client, "add_to_cart", "post", reverse("add_to_cart", args=[item.id]), {"quantity": 1})
+    recorder.request(client, "cart", "get", reverse("cart"))
+    recorder.request(client, "checkout", "get", reverse("checkout"))
+    response = recorder.request(client, "checkout_post", "post", reverse("checkout"), {"address_id": address_id})
+    if response.status_code != 302 or "fake-checkout" not in response["Location"]:
+        recorder.errors["checkout_post"] += 1
+        return
+    session_id = Payment.objects.filter(user_id=user_id).latest("id").session_id
+    recorder.request(client, "fake_stripe_checkout", "get", reverse("fake_stripe_checkout", args=[session_id]))
+    recorder.request(client, "success", "get", reverse("success"), {"session_id": session_id})
+
+
+# 購入の流れ（会員登録 → 一覧 → 詳細 → カート追加 → checkout → 決済 → 完了）を実行して計測する。
+# 決済は FakeStripeGateway を使うので、ネットワークには出ない。
+def run_funnel(users, items, new_shoppers=5, rng=None):
+    rng = rng or random.Random(0)
+    recorder = FunnelRecorder()
+    started = time.perf_counter()
+
+    # 同じIPアドレスから続けて買うので、レート制限は外して計測する
+    with override_settings(
+        PAYMENT_GATEWAY="base.payments.FakeStripeGateway", FAKE_STRIPE_LATENCY=0, RATE_LIMIT_ENABLED=False,
+        **_isolated_settings(),
+    ):
+        # 新しいお客さん: 会員登録と住所登録から
+        for i in range(new_shoppers):
+            client = Client()
+            username = f"newbench{time.time_ns()}_{i}"
+            recorder.request(client, "register", "post", reverse("register"), {
+                "username": username,
+                "email": f"{username}@example.com",
+                "password1": BENCHMARK_PASSWORD,
+                "password2": BENCHMARK_PASSWORD,
+            })
+            recorder.request(client, "add_address", "post", reverse("add_address"), {
+                "post_code": "100-0001", "address": "東京都千代田区1-1", "name": username, "telephone_number": "0300000000",
+            })
+            address = Address.objects.filter(user__username=username).first()
+            if address is None:
+                recorder.errors["add_address"] += 1
+                continue
+            _buy(recorder, client, address.user_id, rng.choice(items), address.id)
+
+        # 既存のお客さん: 事前に作ったカートと住所を使う
+        addresses = dict(Address.objects.filter(user__in=users).values_list("user_id", "id"))
+        for user in users:
+            client = Client()
+            client.force_login(user)
+            _buy(recorder, client, user.id, rng.choice(items), addresses[user.id])
+
+    return recorder.report(time.perf_counter() - started)
+
+
+# 人気の商品一つに buyers 人が threads 本のスレッドから同時に申し込んだときの、申し込みの応答時間と結果を計測する。
+# mode="direct" は申し込みごとに在庫の行をロックして仮押さえする（checkout と同じ）。
+# mode="queued" は整理券を積むだけにして、ワーカー一つが並行して batch_size 件ずつ割り当てる（フラッシュセール）。
+def run_contention(mode, buyers=200, stock=50, threads=16, batch_size=100, prefix="contention"):
+    item = Item.objects.create(
+        name=f"{prefix}商品", price=1000, is_published=True, information="", flash_sale=mode == "queued",
+    )
+    Stock.objects.create(item=item, quantity=stock)
+    stamp = time.time_ns()
+    User.objects.bulk_create([
+        User(username=f"{prefix}{stamp}_{i}", email=f"{prefix}{stamp}_{i}@example.com") for i in range(buyers)
+    ])
+    users = list(User.objects.filter(username__startswith=f"{prefix}{stamp}_").order_by("id"))
+
+    latencies = []
+    outcomes = Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+    admitted = threading.Event()
+
+    def admit(user):
+        if mode == "queued":
+            return enqueue(user, item, 1).status
+        try:
+            reserve(user, {item.id: 1})
+        except OutOfStockError:
+            return "sold_out"
+        return "allocated"
+
+    def shopper(chunk):
+        barrier.wait()
+        try:
+            for user in chunk:
+                started = time.perf_counter()
+                try:
+                    outcome = admit(user)
+                except OperationalError:
+                    outcome = "error"
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    outcomes[outcome] += 1
+        finally:
+            connection.close()
+
+    def drain():
+        try:
+            while True:
+                done = admitted.is_set()
+                try:
+                    process_flash_sales(batch_size)
+                except OperationalError:
+                    # ロックが取れなければ次の回にまわす
+                    done = False
+                if done:
+                    return
+                time.sleep(0.01)
+        finally:
+            connection.close()
+
+    workers = [threading.Thread(target=shopper, args=(users[i::threads],)) for i in range(threads)]
+    drainer = threading.Thread(target=drain)
+    started = time.perf_counter()
+    if mode == "queued":
+        drainer.start()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    admitted_at = time.perf_counter()
+    admitted.set()
+    if mode == "queued":
+        drainer.join()
+    resolved_at = time.perf_counter()
+
+    allocated = StockReservation.objects.filter(item=item).aggregate(total=Sum("quantity"))["total"] or 0
+    return {
+        "mode": mode,
+        "buyers": buyers,
+        "stock": stock,
+        "threads": threads,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+        "throughput_rps": round(buyers / (admitted_at - started), 2),
+        # 全員の結果（確保・売り切れ）が決まるまでの時間
+        "resolved_s": round(resolved_at - started, 3),
+        "responses": dict(outcomes),
+        "errors": outcomes["error"],
+        "allocated": allocated,
+        "oversold": allocated > stock,
+    }
+
+
+# テンプレートごとの描画時間を記録する。{% include %} したテンプレートは、含めた側の時間にも入る。
+# {% extends %} の親テンプレートは子の描画の一部なので、子のテンプレート名で記録される。
+@contextmanager
+def template_timer():
+    timings = defaultdict(list)
+    original = Template.render
+
+    def render(self, context):
+        started = time.perf_counter()
+        try:
+            return original(self, context)
+        finally:
+            timings[self.origin.template_name or self.name].append(time.perf_counter() - started)
+
+    Template.render = render
+    try:
+        yield timings
+    finally:
+        Template.render = original
+
+
+def template_loader_names():
+    return [f"{type(loader).__module__}.{type(loader).__name__}" for loader in engines["django"].engine.template_loaders]
+
+
+# 店頭のページを rounds 回ずつ開き、テンプレートごとの描画時間を計測する。
+# cold はリクエストごとにキャッシュを空にする（断片のキャッシュが効かない）、warm はキャッシュが温まった状態。
+def run_template_render(user, item, rounds=20):
+    anonymous = Client()
+    member = Client()
+    member.force_login(user)
+    pages = [
+        (anonymous, reverse("index"), {}),
+        (anonymous, reverse("search"), {"q": item.name}),
+        (anonymous, reverse("item_detail", args=[item.id]), {}),
+        (member, reverse("index"), {}),
+        (member, reverse("item_detail", args=[item.id]), {}),
+        (member, reverse("cart"), {}),
+        (member, reverse("checkout"), {}),
+        (member, reverse("order_history"), {}),
+    ]
+
+    reports = {}
+    # 計測のたびに空にするので、本番の共有キャッシュではなく専用のキャッシュを使う
+    with override_settings(RATE_LIMIT_ENABLED=False, **_isolated_settings()):
+        for mode in ("cold", "warm"):
+            cache.clear()
+            with template_timer() as timings:
+                for _ in range(rounds):
+                    for client, path, data in pages:
+                        if mode == "cold":
+                            cache.clear()
+                        client.get(path, data)
+            reports[mode] = {
+                name: {
+                    "renders": len(values),
+                    "p50_ms": round(percentile(values, 50) * 1000, 3),
+                    "p95_ms": round(percentile(values, 95) * 1000, 3),
+                    "mean_ms": round(sum(values) / len(values) * 1000, 3),
+                }
+                for name, values in sorted(timings.items())
+            }
+    return {"loaders": template_loader_names(), "rounds": rounds, "templates": reports}
+
+
+# 前回の結果と比べて、p95 のレイテンシかSQLの平均件数が tolerance（割合）を超えて悪くなったビューを返す
+def compare_reports(baseline, current, tolerance=0.2):
+    regressions = []
+    for step, view in current["views"].items():
+        before = baseline.get("views", {}).get(step)
+        if before is None:
+            continue
+        if view["mean_queries"] > before["mean_queries"]:
+            regressions.append(f"{step}: SQLの件数 {before['mean_queries']} → {view['mean_queries']}")
+        if before["p95_ms"] and view["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{step}: p95 {before['p95_ms']}ms → {view['p95_ms']}ms")
+    return regressions
@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .routers import primary_reads
+
+# キャッシュのキーには商品ごと・一覧全体のバージョンを含める。
+# 商品や在庫が変わったらバージョンを上げるだけで、古いエントリは読まれなくなり、
+# キャッシュバックエンドの有効期限と MAX_ENTRIES による間引きで消えていく。
+# バージョンもキャッシュに持つので、ローカルメモリのキャッシュでは上げたプロセスでしか新しくならない
+# （ほかのプロセスは有効期限まで古いエントリを使う。settings.CACHES を参照）。
+CATALOG_VERSION_KEY = "catalog:version"
+
+_MISSING = object()
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+# このプロセスでのキャッシュのヒット数・ミス数
+def cache_stats():
+    with _stats_lock:
+        return {"hits": _stats["hits"], "misses": _stats["misses"]}
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def item_version_key(item_id):
+    return f"catalog:item:{item_id}:version"
+
+
+# バージョンは時刻から作る。バージョンのキー自体が消えても、以前と同じ値に戻ることはない。
+def _new_version():
+    return time.time_ns()
+
+
+def item_versions(item_ids):
+    keys = {item_version_key(item_id): item_id for item_id in item_ids}
+    found = cache.get_many(keys)
+    missing = {key: _new_version() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        found.update(missing)
+    return {keys[key]: version for key, version in found.items()}
+
+
+def catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        version = _new_version()
+        cache.set(CATALOG_VERSION_KEY, version, timeout=None)
+    return version
+
+
+# 商品詳細と在庫表示のキャッシュを無効にする
+def invalidate_items(item_ids):
+    cache.set_many({item_version_key(item_id): _new_version() for item_id in item_ids}, timeout=None)
+
+
+# 商品一覧のキャッシュを無効にする
+def invalidate_catalog():
+    cache.set(CATALOG_VERSION_KEY, _new_version(), timeout=None)
+
+
+# トランザクションの中で変更したときは、すぐと確定後の二回無効にする。
+# 確定前に別のリクエストが古い値をキャッシュしても、確定後に読まれなくなる。
+def invalidate_on_commit(item_ids=(), catalog=False):
+    item_ids = list(item_ids)
+
+    def invalidate():
+        if item_ids:
+            invalidate_items(item_ids)
+        if catalog:
+            invalidate_catalog()
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+# version を渡したときは、無効にしてから REPLICA_STICKY_SECONDS 秒以内なら作り直しをプライマリーから読む。
+# レプリカが追いつく前の古い内容を、新しいバージョンのキーで保存しないため。
+def get_or_set(key, compute, version=None):
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        _count("hits")
+        return value
+    _count("misses")
+    if version is not None and time.time_ns() - version < settings.REPLICA_STICKY_SECONDS * 10**9:
+        with primary_reads():
+            value = compute()
+    else:
+        value = compute()
+    cache.set(key, value)
+    return value
+
+
+# 商品一覧の1ページ分。並び順・絞り込み（filters は絞り込みの条件の文字列）・カーソルごとに、
+# 一覧のバージョンをキーに含めて保存する。
+def get_catalog_page(sort, cursor, compute, filters=""):
+    version = catalog_version()
+    return get_or_set(f"catalog:page:{version}:{sort}:{filters}:{cursor or ''}", compute, version)
+
+
+# 商品詳細ページに必要なデータ {"item": Item, "stock": 購入可能数}。商品がなければ None。
+def get_item_detail(item_id, compute):
+    version = item_versions([item_id])[item_id]
+    return get_or_set(f"catalog:item:{item_id}:{version}:detail", compute, version)
+
+
+# 商品カードのHTMLを商品ごとのバージョンをキーにしてまとめて取得し、ないものだけ描画する
+def render_item_cards(items):
+    versions = item_versions([item.id for item in items])
+    keys = [f"catalog:item:{item.id}:{versions[item.id]}:card" for item in items]
+    cached = cache.get_many(keys)
+
+    rendered = {}
+    cards = []
+    for key, item in zip(keys, items):
+        if key in cached:
+            _count("hits")
+            cards.append(mark_safe(cached[key]))
+            continue
+        _count("misses")
+        html = render_to_string("item_card.html", {"item": item})
+        rendered[key] = html
+        cards.append(mark_safe(html))
+    if rendered:
+        cache.set_many(rendered)
+    return cards
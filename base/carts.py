@@ -0,0 +1,184 @@
+import json
+
+from django.conf import settings
+from django.core.signing import BadSignature
+from django.db import transaction
+from django.db.models import F
+
+from .exceptions import CartFullError, FlashSaleItemError, OutOfStockError
+from .models import Cart, Item
+from .reservations import available_stock
+
+CART_COOKIE_SALT = "base.carts"
+
+
+# ログインしていないお客さんのカート。署名付きCookieに {商品ID: 個数} を持つので、DBには書き込まない。
+# 変更は CartCookieMiddleware がレスポンスに書き込む。
+class CookieCart:
+    def __init__(self, request):
+        self.data = self.load(request)
+        self.modified = False
+
+    @staticmethod
+    def load(request):
+        try:
+            raw = request.get_signed_cookie(
+                settings.CART_COOKIE_NAME, default="", salt=CART_COOKIE_SALT, max_age=settings.CART_COOKIE_AGE,
+            )
+            data = json.loads(raw) if raw else {}
+            return {int(item_id): int(quantity) for item_id, quantity in data.items() if int(quantity) > 0}
+        except (BadSignature, ValueError, TypeError, AttributeError):
+            return {}
+
+    def quantities(self, lock=False):
+        return dict(self.data)
+
+    def quantity(self, item_id):
+        return self.data.get(item_id, 0)
+
+    # {商品ID: 個数} の通りに置き換える。0 の商品は削除する。
+    def set_many(self, quantities):
+        data = {**self.data, **quantities}
+        data = {item_id: quantity for item_id, quantity in data.items() if quantity > 0}
+        if len(data) > settings.CART_COOKIE_MAX_LINES and len(data) > len(self.data):
+            raise CartFullError()
+        self.data = data
+        self.modified = True
+
+    # Cookieに入る大きさに収めるため、行数が上限に達していたら追加しない（False を返す）
+    def add(self, item_id, quantity):
+        if item_id not in self.data and len(self.data) >= settings.CART_COOKIE_MAX_LINES:
+            return False
+        self.data[item_id] = self.data.get(item_id, 0) + quantity
+        self.modified = True
+        return True
+
+    def remove(self, item_id):
+        if self.data.pop(item_id, None) is None:
+            return False
+        self.modified = True
+        return True
+
+    def clear(self):
+        self.modified = self.modified or bool(self.data)
+        self.data = {}
+
+    def write(self, response):
+        if not self.modified:
+            return
+        if self.data:
+            response.set_signed_cookie(
+                settings.CART_COOKIE_NAME,
+                json.dumps(self.data, separators=(",", ":")),
+                salt=CART_COOKIE_SALT,
+                max_age=settings.CART_COOKIE_AGE,
+                httponly=True,
+                samesite="Lax",
+            )
+        else:
+            response.delete_cookie(settings.CART_COOKIE_NAME, samesite="Lax")
+
+
+# ログイン中のお客さんのカート。Cart テーブルに持つ。
+class DatabaseCart:
+    def __init__(self, user):
+        self.user = user
+
+    def quantities(self, lock=False):
+        rows = self.user.cart_set.order_by("id")
+        if lock:
+            rows = rows.select_for_update()
+        return dict(rows.values_list("item_id", "quantity"))
+
+    def quantity(self, item_id):
+        return self.user.cart_set.filter(item_id=item_id).values_list("quantity", flat=True).first() or 0
+
+    def add(self, item_id, quantity):
+        if not self.user.cart_set.filter(item_id=item_id).update(quantity=F("quantity") + quantity):
+            Cart.objects.create(user=self.user, item_id=item_id, quantity=quantity)
+        return True
+
+    def remove(self, item_id):
+        deleted, _ = self.user.cart_set.filter(item_id=item_id).delete()
+        return bool(deleted)
+
+    # {商品ID: 個数} の通りに、一回の upsert と（0 の商品があれば）一回の削除で置き換える
+    def set_many(self, quantities):
+        Cart.objects.bulk_create(
+            [Cart(user=self.user, item_id=item_id, quantity=quantity) for item_id, quantity in quantities.items() if quantity > 0],
+            update_conflicts=True,
+            unique_fields=["user", "item"],
+            update_fields=["quantity", "updated_at"],
+        )
+        removed = [item_id for item_id, quantity in quantities.items() if quantity <= 0]
+        if removed:
+            self.user.cart_set.filter(item_id__in=removed).delete()
+
+    def clear(self):
+        self.user.cart_set.all().delete()
+
+    def write(self, response):
+        pass
+
+
+def cookie_cart(request):
+    if not hasattr(request, "_cookie_cart"):
+        request._cookie_cart = CookieCart(request)
+    return request._cookie_cart
+
+
+# リクエストのユーザーに合ったカート
+def get_cart(request):
+    if request.user.is_authenticated:
+        return DatabaseCart(request.user)
+    return cookie_cart(request)
+
+
+# 複数の商品の個数をまとめて変更する。quantities は {商品ID: 個数}。
+# replace=False なら今の個数に足し、True なら置き換える（0 で削除）。
+# 在庫は一回のクエリでまとめて確認し、足りない商品があれば OutOfStockError を送出して何も変えない。
+# フラッシュセール中の商品は整理券でしか増やせないので、増やそうとしたら FlashSaleItemError を送出する
+# （割り当て済みの分を減らしたり、そのまま残したりはできる）。
+def update_cart(request, quantities, replace=False):
+    user = request.user if request.user.is_authenticated else None
+    cart_storage = get_cart(request)
+    with transaction.atomic():
+        current = cart_storage.quantities(lock=True)
+        wanted = {
+            item_id: quantity if replace else current.get(item_id, 0) + quantity
+            for item_id, quantity in quantities.items()
+        }
+        increasing = [item_id for item_id, quantity in wanted.items() if quantity > current.get(item_id, 0)]
+        flash_sale = Item.objects.filter(id__in=increasing, flash_sale=True).values_list("id", flat=True) if increasing else []
+        if flash_sale:
+            raise FlashSaleItemError(flash_sale)
+        adding = [item_id for item_id, quantity in wanted.items() if quantity > 0]
+        stock = available_stock(adding, exclude_user=user) if adding else {}
+        short = [item_id for item_id in adding if wanted[item_id] > stock[item_id]]
+        if short:
+            raise OutOfStockError(short)
+        cart_storage.set_many(wanted)
+    return wanted
+
+
+# ログインしたときに、Cookieのカートをユーザーのカートに足し込む。
+# 既存の行の読み込みと、一回の upsert（bulk_create(update_conflicts=True)）で済ませる。
+def merge_cookie_cart(request, user):
+    anonymous_cart = cookie_cart(request)
+    quantities = anonymous_cart.quantities()
+    if not quantities:
+        return
+    # 削除された商品と、フラッシュセール中の商品（整理券でしか買えない）は捨てる
+    item_ids = set(Item.objects.filter(id__in=quantities, flash_sale=False).values_list("id", flat=True))
+    existing = dict(Cart.objects.filter(user=user, item_id__in=item_ids).values_list("item_id", "quantity"))
+    Cart.objects.bulk_create(
+        [
+            Cart(user=user, item_id=item_id, quantity=existing.get(item_id, 0) + quantity)
+            for item_id, quantity in quantities.items()
+            if item_id in item_ids
+        ],
+        update_conflicts=True,
+        unique_fields=["user", "item"],
+        update_fields=["quantity", "updated_at"],
+    )
+    anonymous_cart.clear()
@@ -0,0 +1,214 @@
+import csv
+import json
+import time
+from dataclasses import dataclass, field
+from itertools import islice
+
+from django.db import transaction
+
+from .caching import invalidate_on_commit
+from .models import Item, Stock, StockMovement
+from .pricing import tax_included
+from .search import index_items
+
+# ファイルの列。商品は商品コード（sku）で既存の行と突き合わせる。
+ITEM_FIELDS = ("sku", "name", "price", "is_published", "information")
+STOCK_FIELDS = ("sku", "quantity")
+
+IMPORT_NOTE = "一括取り込み"
+
+
+# 取り込めない行。行番号と理由を持つ。
+class InvalidRow(ValueError):
+    pass
+
+
+@dataclass
+class ImportResult:
+    processed: int = 0
+    imported: int = 0
+    errors: list = field(default_factory=list)  # [(行番号, 理由), ...]
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed else 0
+
+
+def guess_format(path):
+    return "jsonl" if str(path).endswith((".jsonl", ".ndjson")) else "csv"
+
+
+# ファイルを1行ずつ読み、(行番号, dict) を返すジェネレーター。ファイル全体は読み込まない。
+def read_rows(file, fmt):
+    if fmt == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_no, None
+            continue
+        yield line_no, row
+
+
+def write_rows(file, fmt, fields, rows):
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(file)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        return count
+    for row in rows:
+        file.write(json.dumps(dict(zip(fields, row)), ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _text(row, name, required=True):
+    value = row.get(name)
+    value = "" if value is None else str(value).strip()
+    if required and not value:
+        raise InvalidRow(f"{name} がありません")
+    return value
+
+
+def _integer(row, name):
+    value = row.get(name)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise InvalidRow(f"{name} が整数ではありません: {value!r}")
+    if value < 0:
+        raise InvalidRow(f"{name} がマイナスです: {value}")
+    return value
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def parse_item(row):
+    if not isinstance(row, dict):
+        raise InvalidRow("行を読み取れません")
+    return Item(
+        sku=_text(row, "sku"),
+        name=_text(row, "name"),
+        price=_integer(row, "price"),
+        is_published=_boolean(row.get("is_published")),
+        information=_text(row, "information", required=False),
+    )
+
+
+def parse_stock(row):
+    if not isinstance(row, dict):
+        raise InvalidRow("行を読み取れません")
+    return _text(row, "sku"), _integer(row, "quantity")
+
+
+# 読めない行はエラーとして記録して飛ばし、読めた行だけを返す
+def _parsed(rows, parse, result):
+    for line_no, row in rows:
+        result.processed += 1
+        try:
+            yield line_no, parse(row)
+        except InvalidRow as error:
+            result.errors.append((line_no, str(error)))
+
+
+# 商品を batch_size 行ずつ商品コードで upsert する。同じ商品コードが続いたら後の行を使う。
+def import_items(rows, batch_size=1000, progress=None):
+    result = ImportResult()
+    for batch in batched(_parsed(rows, parse_item, result), batch_size):
+        items = {item.sku: item for _, item in batch}
+        with transaction.atomic():
+            Item.objects.bulk_create(
+                items.values(),
+                update_conflicts=True,
+                unique_fields=["sku"],
+                update_fields=["name", "price", "is_published", "information", "updated_at"],
+            )
+            # bulk_create では save() もシグナルも呼ばれないので、税込み価格・検索の索引・キャッシュはここで更新する。
+            # 税込み価格は、既存の商品なら登録済みの税区分で計算する
+            saved = list(Item.objects.filter(sku__in=items).only("id", "name", "information", "price", "tax_category"))
+            for item in saved:
+                item.price_with_tax = tax_included(item.price, item.tax_category)
+            Item.objects.bulk_update(saved, ["price_with_tax"])
+            index_items((item.id, item.name, item.information) for item in saved)
+            invalidate_on_commit([item.id for item in saved], catalog=True)
+        result.imported += len(items)
+        if progress:
+            progress(result)
+    return result
+
+
+# 在庫数を batch_size 行ずつ上書きする。差分は在庫の履歴に記録する。
+def import_stock(rows, batch_size=1000, progress=None):
+    result = ImportResult()
+    for batch in batched(_parsed(rows, parse_stock, result), batch_size):
+        quantities = {}
+        lines = {}
+        for line_no, (sku, quantity) in batch:
+            quantities[sku] = quantity
+            lines[sku] = line_no
+
+        with transaction.atomic():
+            item_ids = dict(Item.objects.filter(sku__in=quantities).values_list("sku", "id"))
+            for sku in quantities.keys() - item_ids.keys():
+                result.errors.append((lines[sku], f"商品コードが見つかりません: {sku}"))
+            current = dict(
+                Stock.objects.select_for_update()
+                .filter(item_id__in=item_ids.values())
+                .order_by("item_id")
+                .values_list("item_id", "quantity")
+            )
+            stocks = [Stock(item_id=item_id, quantity=quantities[sku]) for sku, item_id in item_ids.items()]
+            Stock.objects.bulk_create(
+                stocks, update_conflicts=True, unique_fields=["item"], update_fields=["quantity", "updated_at"],
+            )
+            movements = []
+            for stock in stocks:
+                delta = stock.quantity - current.get(stock.item_id, 0)
+                if delta:
+                    kind = StockMovement.RECEIPT if delta > 0 else StockMovement.ADJUSTMENT
+                    movements.append(StockMovement(item_id=stock.item_id, kind=kind, quantity=delta, note=IMPORT_NOTE))
+            StockMovement.objects.bulk_create(movements)
+            invalidate_on_commit(item_ids.values())
+        result.imported += len(stocks)
+        if progress:
+            progress(result)
+    return result
+
+
+# 書き出す行のジェネレーター。iterator() で chunk_size 行ずつ読むので、件数が多くてもメモリは増えない。
+def export_items(chunk_size=2000):
+    return Item.objects.order_by("id").values_list(*ITEM_FIELDS).iterator(chunk_size=chunk_size)
+
+
+def export_stock(chunk_size=2000):
+    return (
+        Stock.objects.filter(item__sku__isnull=False)
+        .order_by("item_id")
+        .values_list("item__sku", "quantity")
+        .iterator(chunk_size=chunk_size)
+    )
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Tags, Warning, register
+
+from .throttling import cache_is_shared
+
+
+# 本番の設定（check --deploy）で、レート制限のバケットがプロセスごとのキャッシュにあれば警告する
+@register(Tags.caches, deploy=True)
+def check_rate_limit_cache(app_configs, **kwargs):
+    if not settings.RATE_LIMIT_ENABLED or cache_is_shared():
+        return []
+    return [
+        Warning(
+            "レート制限のバケットがプロセスごとのキャッシュにあります。上限がワーカーの数だけ倍になり、"
+            "rate_limit_stats も断った回数を数えられません。",
+            hint="CACHE_BACKEND に django.core.cache.backends.redis.RedisCache などの共有のキャッシュを設定してください。",
+            id="base.W001",
+        )
+    ]
+
+
+# 本番の設定（check --deploy）で、商品一覧・商品詳細のキャッシュがプロセスごとなら警告する。
+# 無効化が変更したプロセスにしか届かず、ほかのプロセスは有効期限まで古い内容と ETag を返すため。
+@register(Tags.caches, deploy=True)
+def check_catalog_cache(app_configs, **kwargs):
+    if not isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache):
+        return []
+    timeout = max(settings.CACHES[DEFAULT_CACHE_ALIAS].get("TIMEOUT", 300), settings.TEMPLATE_FRAGMENT_CACHE_SECONDS)
+    return [
+        Warning(
+            "商品一覧・商品詳細のキャッシュがプロセスごとです。商品や在庫を変えても、ほかのプロセスは"
+            f"最大{timeout}秒のあいだ古い内容を表示し、304 も返します。",
+            hint="CACHE_BACKEND に django.core.cache.backends.redis.RedisCache などの共有のキャッシュを設定してください。",
+            id="base.W002",
+        )
+    ]
@@ -0,0 +1,6 @@
+from django.conf import settings
+
+
+# テンプレートの {% cache %} で使う秒数
+def fragment_cache(request):
+    return {"fragment_cache_seconds": settings.TEMPLATE_FRAGMENT_CACHE_SECONDS}
@@ -0,0 +1,17 @@
+# 在庫が足りずに注文や仮押さえができなかったときに送出する
+class OutOfStockError(Exception):
+    def __init__(self, item_ids):
+        self.item_ids = list(item_ids)
+        super().__init__(f"在庫不足の商品があります: {self.item_ids}")
+
+
+# Cookieのカートの行数が上限を超えるときに送出する
+class CartFullError(Exception):
+    pass
+
+
+# フラッシュセール中の商品を、整理券を通さずにカートへ入れようとしたときに送出する
+class FlashSaleItemError(Exception):
+    def __init__(self, item_ids):
+        self.item_ids = list(item_ids)
+        super().__init__(f"フラッシュセール中の商品があります: {self.item_ids}")
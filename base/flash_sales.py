@@ -0,0 +1,117 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .caching import invalidate_on_commit
+from .models import Cart, FlashSaleTicket, Stock, StockReservation
+from .reservations import available_stock
+
+# フラッシュセール。購入の申し込みが一つの在庫の行に集まると、その行のロック待ちがサイト全体を詰まらせるので、
+# 申し込みは整理券を積むだけ（INSERT 一回）にして、ワーカーが受け付けた順にまとめて割り当てる。
+# 在庫の行をロックするのは、申し込み一件ごとではなく batch_size 件ごとに一回になる。
+
+
+# 整理券を積む。同じ人が受付中の整理券を持っていれば、それを返す。
+# 今の在庫（仮押さえを引いた数）が申し込みの個数に足りないときと、順番待ちが FLASH_SALE_QUEUE_LIMIT 人に
+# 達しているときは、DBに書き込まずに売り切れの整理券（保存していないもの）を返す。
+# 売り切れかどうかはキャッシュではなくDBで確かめる。ローカルメモリーのキャッシュはプロセスごとなので、
+# ワーカーが付けた印をWebのプロセスは見られず、管理画面で消してもそのプロセスの分しか消えないため。
+# 在庫の行はロックせずに読むだけなので、申し込みが集まっても待たされない。
+# quantity は 1〜MAX_QUANTITY_PER_ADD 個。それ以外は ValueError を送出する。
+def enqueue(user, item, quantity):
+    if not 1 <= quantity <= settings.MAX_QUANTITY_PER_ADD:
+        raise ValueError(f"数量は1〜{settings.MAX_QUANTITY_PER_ADD}個です: {quantity}")
+    sold_out = FlashSaleTicket(item=item, user=user, quantity=quantity, status=FlashSaleTicket.STATUS_SOLD_OUT)
+    if available_stock([item.id])[item.id] < quantity:
+        return sold_out
+    queue = FlashSaleTicket.objects.filter(item=item, status=FlashSaleTicket.STATUS_QUEUED)
+    existing = queue.filter(user=user).first()
+    if existing:
+        return existing
+    if queue.count() >= settings.FLASH_SALE_QUEUE_LIMIT:
+        return sold_out
+    try:
+        with transaction.atomic():
+            return FlashSaleTicket.objects.create(item=item, user=user, quantity=quantity)
+    except IntegrityError:
+        # 同じ人の同時の申し込みが先に整理券を積んだ（受付中の整理券は一人一枚の制約）。そちらを返す
+        return FlashSaleTicket.objects.filter(item=item, user=user).latest("id")
+
+
+# 順番待ちで自分より前にいる人数
+def queue_position(ticket):
+    return FlashSaleTicket.objects.filter(
+        item_id=ticket.item_id, status=FlashSaleTicket.STATUS_QUEUED, id__lt=ticket.id
+    ).count()
+
+
+# 一つの商品について、受付中の整理券を古い順に batch_size 件まで割り当てる。
+# 在庫の行のロックは一回だけ取り、割り当てた分は仮押さえにしてカートに入れる（そのまま checkout できる）。
+# 足りない整理券は売り切れにし、在庫がなくなったら残りの整理券もまとめて売り切れにする。
+# 戻り値は (割り当てた件数, 売り切れにした件数)
+def allocate_batch(item_id, batch_size=500, now=None):
+    now = now or timezone.now()
+    with transaction.atomic():
+        locked = Stock.objects.select_for_update().order_by("item_id")
+        available = available_stock([item_id], queryset=locked)[item_id]
+        tickets = list(
+            FlashSaleTicket.objects.select_for_update(skip_locked=True)
+            .filter(item_id=item_id, status=FlashSaleTicket.STATUS_QUEUED)
+            .order_by("id")[:batch_size]
+        )
+        if not tickets:
+            return 0, 0
+
+        allocated, sold_out = [], []
+        for ticket in tickets:
+            if ticket.quantity <= available:
+                available -= ticket.quantity
+                allocated.append(ticket)
+            else:
+                sold_out.append(ticket)
+
+        expires_at = now + timedelta(seconds=settings.STOCK_RESERVATION_SECONDS)
+        StockReservation.objects.bulk_create([
+            StockReservation(item_id=item_id, user_id=ticket.user_id, quantity=ticket.quantity, expires_at=expires_at)
+            for ticket in allocated
+        ])
+        Cart.objects.bulk_create(
+            [Cart(user_id=ticket.user_id, item_id=item_id, quantity=ticket.quantity) for ticket in allocated],
+            update_conflicts=True,
+            unique_fields=["user", "item"],
+            update_fields=["quantity", "updated_at"],
+        )
+        FlashSaleTicket.objects.filter(id__in=[ticket.id for ticket in allocated]).update(
+            status=FlashSaleTicket.STATUS_ALLOCATED, updated_at=now,
+        )
+        rejected = FlashSaleTicket.objects.filter(id__in=[ticket.id for ticket in sold_out])
+        if available == 0:
+            rejected = FlashSaleTicket.objects.filter(item_id=item_id, status=FlashSaleTicket.STATUS_QUEUED)
+        rejected_count = rejected.update(status=FlashSaleTicket.STATUS_SOLD_OUT, updated_at=now)
+        invalidate_on_commit([item_id])
+    return len(allocated), rejected_count
+
+
+# 受付中の整理券がなくなるまで、商品ごとに batch_size 件ずつ割り当てる。戻り値は (割り当てた件数, 売り切れにした件数)
+def process_flash_sales(batch_size=500, progress=None):
+    total_allocated = total_sold_out = 0
+    while True:
+        item_ids = list(
+            FlashSaleTicket.objects.filter(status=FlashSaleTicket.STATUS_QUEUED)
+            .order_by("item_id")
+            .values_list("item_id", flat=True)
+            .distinct()
+        )
+        processed = 0
+        for item_id in item_ids:
+            allocated, sold_out = allocate_batch(item_id, batch_size)
+            total_allocated += allocated
+            total_sold_out += sold_out
+            processed += allocated + sold_out
+        # 残りが別のワーカーの処理中（SKIP LOCKED で飛ばした）なら、そちらに任せて終える
+        if not processed:
+            return total_allocated, total_sold_out
+        if progress:
+            progress(total_allocated, total_sold_out)
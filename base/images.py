@@ -0,0 +1,147 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .caching import invalidate_on_commit
+from .models import Item
+
+logger = logging.getLogger(__name__)
+
+# 派生画像の形式と拡張子。WebPに対応していないブラウザには JPEG を使う。
+FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()
+
+
+# 元画像から幅ごとのサムネイルを WebP と JPEG で作る。
+# 別プロセスで動かすので、Djangoには触らずにバイト列だけを受け渡す。
+# 戻り値は [(実際の幅, 形式, バイト列), ...]
+def render_derivatives(data, widths, quality):
+    results = []
+    done = set()
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        for width in sorted(widths):
+            # 元画像より大きくはしない。元画像より広い幅は元画像の幅で一つだけ作り、srcset には実際の幅を書く
+            # （ブラウザは srcset の幅を見て選ぶので、同じ画像を違う幅として載せない）
+            thumbnail = image.copy()
+            thumbnail.thumbnail((min(width, image.width), image.height))
+            if thumbnail.width in done:
+                continue
+            done.add(thumbnail.width)
+            for fmt, pil_format in FORMATS.items():
+                converted = thumbnail if fmt == "webp" and thumbnail.mode in ("RGB", "RGBA") else thumbnail.convert("RGB")
+                buffer = io.BytesIO()
+                converted.save(buffer, pil_format, quality=quality)
+                results.append((thumbnail.width, fmt, buffer.getvalue()))
+    return results
+
+
+# 派生画像の名前。中身のハッシュを含めるので、同じ名前のファイルは中身も同じ（長期間キャッシュできる）。
+def derivative_name(source_name, width, fmt, data):
+    stem = os.path.splitext(os.path.basename(source_name))[0]
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    return f"images/derivatives/{stem}.{width}w.{digest}.{fmt}"
+
+
+# 作った派生画像を保存し、Item.image_variants に記録する
+def store_derivatives(item_id, source_name, results):
+    variants = {"source": source_name}
+    for width, fmt, data in results:
+        name = derivative_name(source_name, width, fmt, data)
+        if not default_storage.exists(name):
+            name = default_storage.save(name, ContentFile(data))
+        variants.setdefault(fmt, {})[str(width)] = name
+
+    # 処理中に画像が差し替えられていたら、古い画像の結果は記録しない
+    with transaction.atomic():
+        updated = Item.objects.filter(id=item_id, image=source_name).update(
+            image_variants=variants, updated_at=timezone.now(),
+        )
+        if updated:
+            invalidate_on_commit([item_id], catalog=True)
+    return variants
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.IMAGE_DERIVATIVE_WORKERS)
+        return _executor
+
+
+def _finish(item_id, source_name, future):
+    try:
+        store_derivatives(item_id, source_name, future.result())
+    except Exception:
+        logger.exception("派生画像の作成に失敗しました: item=%s image=%s", item_id, source_name)
+    finally:
+        _pending.discard((item_id, source_name))
+        # 結果の保存はプールのスレッドで行うので、使ったDB接続を閉じておく
+        connections.close_all()
+
+
+# 商品画像の派生画像の作成を予約する。重い処理はプロセスプールで行い、保存を待たせない。
+# 商品の保存（signals.create_image_derivatives）と build_image_derivatives コマンドから呼ぶ。
+# 元画像を読むので、ページの描画中には呼ばないこと。
+# IMAGE_DERIVATIVES_ASYNC が False のときはその場で作る（テスト・コマンド用）。
+def schedule_derivatives(item):
+    if not item.image or item.image_variants.get("source") == item.image.name:
+        return
+    key = (item.id, item.image.name)
+    if key in _pending:
+        return
+
+    with item.image.open("rb") as source:
+        data = source.read()
+    widths = settings.IMAGE_DERIVATIVE_WIDTHS
+    quality = settings.IMAGE_DERIVATIVE_QUALITY
+
+    if not settings.IMAGE_DERIVATIVES_ASYNC:
+        item.image_variants = store_derivatives(item.id, item.image.name, render_derivatives(data, widths, quality))
+        return
+
+    _pending.add(key)
+    future = executor().submit(render_derivatives, data, widths, quality)
+    future.add_done_callback(partial(_finish, item.id, item.image.name))
+
+
+# 派生画像がまだないか、元画像が変わった後のままの商品について、その場で作る（コマンド用）。
+# 一括取り込みなどシグナルを通らずに画像が変わった商品に使う。戻り値は作った商品の数
+def build_missing_derivatives(batch_size=100, progress=None):
+    built = 0
+    last_id = 0
+    items = Item.objects.exclude(image="").exclude(image__isnull=True).order_by("id").only("id", "image", "image_variants")
+    while batch := list(items.filter(id__gt=last_id)[:batch_size]):
+        last_id = batch[-1].id
+        for item in batch:
+            if item.image_variants.get("source") == item.image.name:
+                continue
+            try:
+                with item.image.open("rb") as source:
+                    data = source.read()
+                store_derivatives(
+                    item.id, item.image.name,
+                    render_derivatives(data, settings.IMAGE_DERIVATIVE_WIDTHS, settings.IMAGE_DERIVATIVE_QUALITY),
+                )
+            except Exception:
+                logger.exception("派生画像の作成に失敗しました: item=%s image=%s", item.id, item.image.name)
+                continue
+            built += 1
+        if progress:
+            progress(built)
+    return built
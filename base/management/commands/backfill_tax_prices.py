@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base.pricing import backfill_tax_prices
+
+
+class Command(BaseCommand):
+    help = "保存している商品の税込み価格を、今の税率（TAX_RATES）で計算し直す"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="一度に読み込む商品の数")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size は1以上にしてください")
+        checked, updated = backfill_tax_prices(
+            options["batch_size"],
+            progress=lambda checked, updated: self.stdout.write(f"{checked}件（更新{updated}件）", ending="\r"),
+        )
+        self.stdout.write(self.style.SUCCESS(f"{checked}件の商品を確かめ、{updated}件の税込み価格を更新しました"))
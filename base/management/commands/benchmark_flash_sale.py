@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from base.benchmarks import run_contention
+
+
+class Command(BaseCommand):
+    help = "人気の商品一つに申し込みが集中したときの、在庫の行を直接ロックする場合と整理券で受け付ける場合を比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--buyers", type=int, default=500, help="申し込む人数")
+        parser.add_argument("--stock", type=int, default=100, help="商品の在庫数")
+        parser.add_argument("--threads", type=int, default=16, help="同時に申し込むスレッドの数")
+        parser.add_argument("--batch-size", type=int, default=200, help="整理券の割り当てでロック一回に処理する数")
+        parser.add_argument("--output", default="", help="結果を保存するJSONファイル（省略時は benchmarks/ に保存）")
+
+    def handle(self, *args, **options):
+        if options["threads"] < 1 or options["buyers"] < options["threads"]:
+            raise CommandError("--threads は1以上、--buyers は --threads 以上にしてください")
+        setup_test_environment()
+        test_dir = None
+        if connection.vendor == "sqlite":
+            # メモリ上のテストDBはスレッドから同時に書き込めないので、一時ファイルに作る。
+            # 書き込むトランザクションは始めから書き込みロックを取り、ロック待ちをエラーではなく待ち時間として計る。
+            test_dir = tempfile.TemporaryDirectory()
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(test_dir.name, "benchmark.sqlite3")
+            connection.settings_dict["OPTIONS"].update(transaction_mode="IMMEDIATE", timeout=30)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            reports = [
+                run_contention(
+                    mode, buyers=options["buyers"], stock=options["stock"], threads=options["threads"],
+                    batch_size=options["batch_size"], prefix=mode,
+                )
+                for mode in ("direct", "queued")
+            ]
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            if test_dir:
+                test_dir.cleanup()
+
+        result = {"created_at": timezone.now().isoformat(), "database": connection.vendor, "reports": reports}
+        output = Path(
+            options["output"] or settings.BASE_DIR / "benchmarks" / f"flash-sale-{timezone.now():%Y%m%d-%H%M%S}.json"
+        )
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(result, ensure_ascii=False, indent=2))
+
+        for report in reports:
+            self.stdout.write(
+                f"{report['mode']:7} p50={report['p50_ms']:>8}ms p95={report['p95_ms']:>8}ms p99={report['p99_ms']:>8}ms "
+                f"rps={report['throughput_rps']:>8} resolved={report['resolved_s']}s "
+                f"allocated={report['allocated']}/{report['stock']} errors={report['errors']}"
+            )
+            if report["oversold"]:
+                raise CommandError(f"{report['mode']}: 在庫より多く割り当てました")
+        self.stdout.write(self.style.SUCCESS(f"結果を保存しました: {output}"))
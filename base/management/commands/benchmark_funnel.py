@@ -0,0 +1,82 @@
+import json
+import platform
+import random
+import subprocess
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from base.benchmarks import compare_reports, run_funnel, seed
+
+
+class Command(BaseCommand):
+    help = "購入の流れの負荷試験を行い、ビューごとのレイテンシ・SQL件数・スループットをJSONで保存する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--items", type=int, default=200, help="作る商品の数")
+        parser.add_argument("--users", type=int, default=20, help="住所とカート付きで作るユーザーの数")
+        parser.add_argument("--cart-lines", type=int, default=3, help="作るカートの行数（ユーザーごと）")
+        parser.add_argument("--new-shoppers", type=int, default=5, help="会員登録から始めるお客さんの数")
+        parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+        parser.add_argument("--output", default="", help="結果を保存するJSONファイル（省略時は benchmarks/ に保存）")
+        parser.add_argument("--baseline", default="", help="比較する前回の結果のJSONファイル")
+        parser.add_argument(
+            "--tolerance", type=float, default=0.2, help="p95 がこの割合を超えて悪化したら失敗にする（0.2 = 20%%）",
+        )
+        parser.add_argument(
+            "--keepdb", action="store_true",
+            help="計測用のテストDBを残す（設定されたDATABASESのエンジンでテストDBを作って計測する）",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        engine = connection.vendor
+        # 本番のデータに触らないよう、設定されたエンジンで計測用のテストDBを作る
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keepdb"])
+        try:
+            users, items = seed(
+                items=options["items"], users=options["users"], cart_lines=options["cart_lines"], rng=rng,
+            )
+            report = run_funnel(users, items, new_shoppers=options["new_shoppers"], rng=rng)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keepdb"])
+            teardown_test_environment()
+
+        report["meta"] = {
+            "created_at": timezone.now().isoformat(),
+            "database": engine,
+            "git_commit": self.git_commit(),
+            "python": platform.python_version(),
+            "options": {key: options[key] for key in ("items", "users", "cart_lines", "new_shoppers", "seed")},
+        }
+        output = Path(options["output"] or settings.BASE_DIR / "benchmarks" / f"funnel-{timezone.now():%Y%m%d-%H%M%S}.json")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+
+        for step, view in report["views"].items():
+            self.stdout.write(
+                f"{step:22} n={view['requests']:<5} p50={view['p50_ms']:>8}ms p95={view['p95_ms']:>8}ms "
+                f"p99={view['p99_ms']:>8}ms queries={view['mean_queries']:>6} rps={view['throughput_rps']}"
+            )
+        self.stdout.write(self.style.SUCCESS(f"結果を保存しました: {output}"))
+
+        if options["baseline"]:
+            baseline = json.loads(Path(options["baseline"]).read_text())
+            regressions = compare_reports(baseline, report, options["tolerance"])
+            if regressions:
+                raise CommandError("前回より悪化しました:\n" + "\n".join(regressions))
+            self.stdout.write(self.style.SUCCESS("前回の結果から悪化はありません"))
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,50 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from base.benchmarks import run_template_render, seed
+from base.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "店頭のページを開いて、テンプレートごとの描画時間をキャッシュが空のときと温まったときで計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--items", type=int, default=200, help="作る商品の数")
+        parser.add_argument("--cart-lines", type=int, default=10, help="計測するユーザーのカートの行数")
+        parser.add_argument("--rounds", type=int, default=20, help="ページごとに開く回数")
+        parser.add_argument("--output", default="", help="結果を保存するJSONファイル（省略時は benchmarks/ に保存）")
+
+    def handle(self, *args, **options):
+        # 本番のデータに触らないよう、設定されたエンジンで計測用のテストDBを作る
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            users, items = seed(items=options["items"], users=1, cart_lines=options["cart_lines"], prefix="render")
+            rebuild_index()
+            report = run_template_render(users[0], items[0], rounds=options["rounds"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report["created_at"] = timezone.now().isoformat()
+        output = Path(
+            options["output"] or settings.BASE_DIR / "benchmarks" / f"templates-{timezone.now():%Y%m%d-%H%M%S}.json"
+        )
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+
+        self.stdout.write(f"ローダー: {', '.join(report['loaders'])}")
+        for mode, templates in report["templates"].items():
+            self.stdout.write(f"[{mode}]")
+            for name, timing in templates.items():
+                self.stdout.write(
+                    f"  {name:24} n={timing['renders']:<5} p50={timing['p50_ms']:>8}ms "
+                    f"p95={timing['p95_ms']:>8}ms mean={timing['mean_ms']:>8}ms"
+                )
+        self.stdout.write(self.style.SUCCESS(f"結果を保存しました: {output}"))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base.images import build_missing_derivatives
+
+
+class Command(BaseCommand):
+    help = "縮小画像がない商品（または元画像が変わった商品）の縮小画像を作る"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="一度に読み込む商品の数")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size は1以上にしてください")
+        built = build_missing_derivatives(
+            options["batch_size"], progress=lambda built: self.stdout.write(f"{built}件", ending="\r"),
+        )
+        self.stdout.write(self.style.SUCCESS(f"{built}件の商品の縮小画像を作りました"))
@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+
+
+class Command(BaseCommand):
+    help = "プライマリーとレプリカに接続できるかを確かめる。接続できないものがあれば終了コード1で終わる（死活監視用）"
+
+    def handle(self, *args, **options):
+        failed = []
+        for alias in connections:
+            connection = connections[alias]
+            started = time.perf_counter()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                    lag = self.replication_lag(connection, cursor) if alias in settings.DATABASE_REPLICAS else None
+            except DatabaseError as error:
+                failed.append(alias)
+                self.stdout.write(self.style.ERROR(f"{alias}: 接続できません（{error}）"))
+                continue
+            message = f"{alias}: OK {(time.perf_counter() - started) * 1000:.1f}ms"
+            if lag is not None:
+                message += f"（レプリケーションの遅れ {lag:.1f}秒）"
+            self.stdout.write(self.style.SUCCESS(message))
+        if failed:
+            raise CommandError(f"接続できないデータベースがあります: {', '.join(failed)}")
+
+    # PostgreSQL のレプリカなら、最後に反映したトランザクションからの秒数
+    @staticmethod
+    def replication_lag(connection, cursor):
+        if connection.vendor != "postgresql":
+            return None
+        cursor.execute("SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())")
+        lag = cursor.fetchone()[0]
+        return None if lag is None else float(lag)
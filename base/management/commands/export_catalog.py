@@ -0,0 +1,34 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from base.catalog_io import ITEM_FIELDS, STOCK_FIELDS, export_items, export_stock, guess_format, write_rows
+
+EXPORTERS = {"items": (ITEM_FIELDS, export_items), "stock": (STOCK_FIELDS, export_stock)}
+
+
+class Command(BaseCommand):
+    help = "商品（items）または在庫数（stock）を CSV / JSONL に書き出す。import_catalog でそのまま取り込める"
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=EXPORTERS, help="書き出すもの")
+        parser.add_argument("path", help="書き出すファイル（- で標準出力）")
+        parser.add_argument("--format", choices=("csv", "jsonl"), help="ファイルの形式（省略時は拡張子から判断）")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="DBから一度に読む行数")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or guess_format(path)
+        fields, exporter = EXPORTERS[options["kind"]]
+        rows = exporter(chunk_size=options["chunk_size"])
+
+        started = time.perf_counter()
+        if path == "-":
+            count = write_rows(sys.stdout, fmt, fields, rows)
+        else:
+            with open(path, "w", newline="", encoding="utf-8") as file:
+                count = write_rows(file, fmt, fields, rows)
+        elapsed = time.perf_counter() - started
+        rate = count / elapsed if elapsed else 0
+        self.stderr.write(self.style.SUCCESS(f"{count}件を書き出しました（{elapsed:.1f}秒 / {rate:.0f}行/秒）"))
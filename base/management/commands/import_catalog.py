@@ -0,0 +1,43 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from base.catalog_io import guess_format, import_items, import_stock, read_rows
+
+IMPORTERS = {"items": import_items, "stock": import_stock}
+
+
+class Command(BaseCommand):
+    help = "商品（items）または在庫数（stock）を CSV / JSONL から一括で取り込む。商品は商品コードで上書きする"
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=IMPORTERS, help="取り込むもの")
+        parser.add_argument("path", help="読み込むファイル（- で標準入力）")
+        parser.add_argument("--format", choices=("csv", "jsonl"), help="ファイルの形式（省略時は拡張子から判断）")
+        parser.add_argument("--batch-size", type=int, default=1000, help="一度に書き込む行数")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size は1以上にしてください")
+        path = options["path"]
+        fmt = options["format"] or guess_format(path)
+        importer = IMPORTERS[options["kind"]]
+        self.verbosity = options["verbosity"]
+
+        if path == "-":
+            result = importer(read_rows(sys.stdin, fmt), options["batch_size"], self.progress)
+        else:
+            with open(path, newline="", encoding="utf-8") as file:
+                result = importer(read_rows(file, fmt), options["batch_size"], self.progress)
+
+        for line_no, message in result.errors:
+            self.stderr.write(f"{line_no}行目: {message}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{result.imported}件を取り込みました（{result.processed}行 / エラー{len(result.errors)}行 / "
+            f"{result.elapsed:.1f}秒 / {result.rows_per_second:.0f}行/秒）"
+        ))
+
+    def progress(self, result):
+        if self.verbosity >= 1:
+            self.stdout.write(f"{result.processed}行 {result.rows_per_second:.0f}行/秒", ending="\r")
+            self.stdout.flush()
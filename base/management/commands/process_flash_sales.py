@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from base.flash_sales import process_flash_sales
+
+
+class Command(BaseCommand):
+    help = "フラッシュセールの整理券に、受け付けた順に在庫を割り当てる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="在庫の行のロック一回で割り当てる整理券の数")
+        parser.add_argument("--loop", action="store_true", help="終了せずに、整理券が積まれるのを待ち続ける")
+        parser.add_argument("--interval", type=float, default=0.5, help="--loop で、整理券がないときに待つ秒数")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size は1以上にしてください")
+        while True:
+            allocated, sold_out = process_flash_sales(options["batch_size"])
+            if allocated or sold_out:
+                self.stdout.write(f"{allocated}件に在庫を割り当てました（売り切れ {sold_out}件）")
+            if not options["loop"]:
+                break
+            try:
+                time.sleep(options["interval"])
+            except KeyboardInterrupt:
+                break
+        if not options["loop"]:
+            self.stdout.write(self.style.SUCCESS("受付中の整理券はありません"))
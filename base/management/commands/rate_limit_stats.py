@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from base.throttling import cache_is_shared, rejection_counts, reset_rejection_counts
+
+
+class Command(BaseCommand):
+    help = "レート制限で断ったリクエストの数を、スコープ（account・cart など）と種類（user・ip）ごとに表示する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", action="store_true", help="JSONで出力する（監視ツールに取り込む用）")
+        parser.add_argument("--reset", action="store_true", help="表示したあとで数をゼロに戻す")
+
+    def handle(self, *args, **options):
+        # ローカルメモリのキャッシュでは、Webのプロセスで数えた回数はこのコマンドのプロセスから見えない
+        if not cache_is_shared():
+            self.stderr.write(self.style.WARNING(
+                "キャッシュがプロセスごとなので、Webのプロセスで断った回数は表示されません（共有のキャッシュを設定してください）"
+            ))
+        counts = rejection_counts()
+        if options["json"]:
+            rows = [{"scope": scope, "kind": kind, "rejected": count} for (scope, kind), count in sorted(counts.items())]
+            self.stdout.write(json.dumps(rows, ensure_ascii=False))
+        elif not counts:
+            self.stdout.write("断ったリクエストはありません")
+        else:
+            for (scope, kind), count in sorted(counts.items()):
+                self.stdout.write(f"{scope:10} {kind:4} {count}")
+        if options["reset"]:
+            reset_rejection_counts()
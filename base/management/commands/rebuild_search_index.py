@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "商品検索の索引をすべての商品から作り直す"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="一度に読み込む商品の数")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size は1以上にしてください")
+        total = rebuild_index(options["batch_size"], progress=lambda total: self.stdout.write(f"{total}件", ending="\r"))
+        self.stdout.write(self.style.SUCCESS(f"{total}件の商品で索引を作り直しました"))
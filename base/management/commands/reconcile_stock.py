@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from base.stock import reconcile
+
+
+class Command(BaseCommand):
+    help = "在庫数と在庫の履歴の合計を突き合わせる。--fix で差分を調整として履歴に記録する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="差分を調整の行として記録する")
+
+    def handle(self, *args, **options):
+        discrepancies = reconcile(fix=options["fix"])
+        for item_id, quantity, ledger in discrepancies:
+            self.stdout.write(f"商品{item_id}: 在庫数 {quantity} / 履歴の合計 {ledger}（差 {quantity - ledger}）")
+        if not discrepancies:
+            self.stdout.write(self.style.SUCCESS("在庫数と履歴は一致しています"))
+        elif options["fix"]:
+            self.stdout.write(self.style.SUCCESS(f"{len(discrepancies)}件の差分を調整として記録しました"))
+        else:
+            self.stdout.write(self.style.WARNING(f"{len(discrepancies)}件の差分があります"))
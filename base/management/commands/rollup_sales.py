@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base.analytics import roll_up
+
+
+class Command(BaseCommand):
+    help = "前回の続きから注文を売上の集計表に足し込む。何度実行しても二重には数えない"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="一つのトランザクションで集計する注文の数")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size は1以上にしてください")
+        total = roll_up(options["batch_size"], progress=lambda total: self.stdout.write(f"{total}件を集計しました"))
+        self.stdout.write(self.style.SUCCESS(f"集計が追いつきました（今回 {total}件）"))
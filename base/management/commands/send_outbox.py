@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from base.outbox import send_pending
+
+
+class Command(BaseCommand):
+    help = "アウトボックスに積まれた注文確認メールを送る。複数のプロセスで同時に実行してもよい"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50, help="一つの接続でまとめて送る件数")
+        parser.add_argument("--loop", action="store_true", help="終了せずに、送るものが出てくるのを待ち続ける")
+        parser.add_argument("--interval", type=float, default=5, help="--loop で、送るものがないときに待つ秒数")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size は1以上にしてください")
+        while True:
+            sent, failed = send_pending(options["batch_size"])
+            if sent or failed:
+                self.stdout.write(f"{sent}件を送信しました（失敗 {failed}件）")
+            if not options["loop"]:
+                break
+            try:
+                time.sleep(options["interval"])
+            except KeyboardInterrupt:
+                break
+        if not options["loop"]:
+            self.stdout.write(self.style.SUCCESS("送信待ちのメールを送り終えました"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from base.reservations import sweep_expired
+
+
+class Command(BaseCommand):
+    help = "期限切れの在庫の仮押さえを削除する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="一度に削除する件数")
+
+    def handle(self, *args, **options):
+        deleted = sweep_expired(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"期限切れの仮押さえを{deleted}件削除しました"))
@@ -0,0 +1,181 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .routers import routing_state
+
+logger = logging.getLogger("base.perf")
+
+# IN (%s, %s, ...) のように個数だけが違うクエリは同じものとして数える
+_IN_LIST = re.compile(r"\((?:%s, )+%s\)")
+
+
+def fingerprint(sql):
+    return _IN_LIST.sub("(...)", sql)
+
+
+# リクエスト中に実行したSQLを記録する
+class QueryRecorder:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((context["connection"].alias, sql, params, time.perf_counter() - started))
+
+    # 同じ形のクエリが閾値以上実行されていたら、N+1の疑いとして返す
+    def repeated(self, threshold):
+        counts = Counter(fingerprint(sql) for _, sql, _, _ in self.queries)
+        return [
+            {"fingerprint": sql, "count": count}
+            for sql, count in counts.most_common()
+            if count >= threshold
+        ]
+
+    # SQLもパラメータも同じ、まったく同じクエリの重複
+    def duplicates(self):
+        counts = Counter((sql, repr(params)) for _, sql, params, _ in self.queries)
+        return sum(count - 1 for count in counts.values() if count > 1)
+
+
+# ビューごとにSQLの件数・DB時間・重複クエリ・処理時間を記録し、JSONLで出力する。
+# 以下のミドルウェアはどれも同期・非同期の両方に対応する。ASGIで同期だけのミドルウェアがあると、
+# Djangoがリクエストごとにスレッドに切り替え、非同期の checkout を同時にたくさん待てなくなるため。
+class QueryInstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PERF_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with self.recording(recorder):
+            response = self.get_response(request)
+        self.record(request, response, recorder, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        # DBの接続はスレッドごとなので、クエリを実行するスレッド（sync_to_async の thread_sensitive で
+        # リクエストごとに1つ）の接続にラッパーを付け、外すのも同じスレッドで行う
+        stack = await sync_to_async(self.recording)(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        self.record(request, response, recorder, time.perf_counter() - started)
+        return response
+
+    @staticmethod
+    def recording(recorder):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        return stack
+
+    def record(self, request, response, recorder, elapsed):
+        repeated = recorder.repeated(settings.PERF_N_PLUS_ONE_THRESHOLD)
+        match = request.resolver_match
+        record = {
+            "view": match.view_name if match else None,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round(elapsed * 1000, 3),
+            "queries": len(recorder.queries),
+            "db_time_ms": round(sum(duration for *_, duration in recorder.queries) * 1000, 3),
+            "duplicate_queries": recorder.duplicates(),
+            "repeated_queries": repeated,
+            "n_plus_one": bool(repeated),
+            # レート制限で断ったときのスコープと種類（"cart:ip" など）
+            "throttled": getattr(request, "throttled", None),
+        }
+        request.perf_record = record
+        if repeated:
+            logger.warning(json.dumps(record, ensure_ascii=False))
+        else:
+            logger.info(json.dumps(record, ensure_ascii=False))
+
+
+# ログインしていないお客さんのカート（署名付きCookie）の変更をレスポンスに書き込む
+class CartCookieMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.write_cart(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.write_cart(request, await self.get_response(request))
+
+    @staticmethod
+    def write_cart(request, response):
+        cart = getattr(request, "_cookie_cart", None)
+        if cart is not None:
+            cart.write(response)
+        return response
+
+
+# 読み込みをレプリカに振り分けるための、リクエストごとの状態を用意する（base.routers.ReplicaRouter）。
+# 書き込んだリクエストには REPLICA_STICKY_SECONDS 秒のCookieを付け、その間はそのお客さんの読み込みをプライマリーに固定する。
+# 状態は ContextVar に持つので、非同期のビューから sync_to_async で実行したクエリにも引き継がれる。
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with routing_state(pinned=settings.REPLICA_STICKY_COOKIE in request.COOKIES) as state:
+            response = self.get_response(request)
+        return self.stick(state, response)
+
+    async def __acall__(self, request):
+        with routing_state(pinned=settings.REPLICA_STICKY_COOKIE in request.COOKIES) as state:
+            response = await self.get_response(request)
+        return self.stick(state, response)
+
+    @staticmethod
+    def stick(state, response):
+        if state.wrote:
+            response.set_cookie(
+                settings.REPLICA_STICKY_COOKIE, "1", max_age=settings.REPLICA_STICKY_SECONDS, httponly=True, samesite="Lax",
+            )
+        return response
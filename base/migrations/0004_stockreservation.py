@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_remove_item_stock_stock'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='quantity',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateField(auto_now=True)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.item')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['item', 'expires_at'], name='base_stockr_item_id_a9a6fd_idx'), models.Index(fields=['expires_at'], name='base_stockr_expires_9ba208_idx')],
+            },
+        ),
+    ]
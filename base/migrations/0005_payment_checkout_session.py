@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_stockreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='address',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.address'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='cart_snapshot',
+            field=models.JSONField(default=list),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='session_id',
+            field=models.CharField(max_length=255, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='total_price',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='order',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='base.order'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='status',
+            field=models.CharField(default='pending', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='stripe_payment_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
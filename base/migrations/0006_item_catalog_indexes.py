@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_payment_checkout_session'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['is_published', 'created_at', 'id'], name='item_published_new_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['is_published', 'price', 'id'], name='item_published_price_idx'),
+        ),
+    ]
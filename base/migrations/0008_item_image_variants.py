@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_updated_at_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
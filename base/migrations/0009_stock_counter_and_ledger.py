@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+# 同じ商品の在庫が複数行ある場合は、一番古い行に数量を合計してほかを削除する
+def merge_duplicate_stocks(apps, schema_editor):
+    Stock = apps.get_model("base", "Stock")
+    duplicated = (
+        Stock.objects.values("item_id")
+        .annotate(rows=Count("id"), total=Sum("quantity"))
+        .filter(rows__gt=1)
+    )
+    for row in duplicated:
+        stocks = list(Stock.objects.filter(item_id=row["item_id"]).order_by("id"))
+        keep = stocks[0]
+        Stock.objects.filter(id=keep.id).update(quantity=row["total"])
+        Stock.objects.filter(id__in=[stock.id for stock in stocks[1:]]).delete()
+
+
+# 今の在庫数を、履歴の最初の行（調整）として記録する
+def record_opening_balances(apps, schema_editor):
+    Stock = apps.get_model("base", "Stock")
+    StockMovement = apps.get_model("base", "StockMovement")
+    StockMovement.objects.bulk_create(
+        [
+            StockMovement(item_id=item_id, kind="adjustment", quantity=quantity, note="初期残高")
+            for item_id, quantity in Stock.objects.filter(quantity__gt=0).values_list("item_id", "quantity")
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_item_image_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_stocks, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='stock',
+            name='item',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stock', to='base.item'),
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('receipt', '入荷'), ('sale', '販売'), ('adjustment', '調整')], max_length=20)),
+                ('quantity', models.IntegerField()),
+                ('note', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.item')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['item', 'created_at'], name='base_stockm_item_id_5fc6e1_idx')],
+            },
+        ),
+        migrations.RunPython(record_opening_balances, migrations.RunPython.noop),
+    ]
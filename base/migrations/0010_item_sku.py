@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:59
+
+from django.db import migrations, models
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0009_stock_counter_and_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='sku',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+# 既存の注文に、明細の行数と商品名を書き込む
+def fill_order_summaries(apps, schema_editor):
+    Order = apps.get_model("base", "Order")
+    OrderItem = apps.get_model("base", "OrderItem")
+    last_id = 0
+    while batch := list(Order.objects.filter(id__gt=last_id).order_by("id").only("id")[:1000]):
+        last_id = batch[-1].id
+        names = {}
+        for order_id, name in (
+            OrderItem.objects.filter(order__in=batch).order_by("id").values_list("order_id", "item__name")
+        ):
+            names.setdefault(order_id, []).append(name)
+        for order in batch:
+            order.item_names = names.get(order.id, [])
+            order.line_count = len(order.item_names)
+        Order.objects.bulk_update(batch, ["item_names", "line_count"])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0010_item_sku'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_names',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='line_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='order_user_created_idx'),
+        ),
+        migrations.RunPython(fill_order_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:03
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+# 同じユーザー・商品のカートが複数行ある場合は、一番古い行に個数を合計してほかを削除する
+def merge_duplicate_carts(apps, schema_editor):
+    Cart = apps.get_model("base", "Cart")
+    duplicated = (
+        Cart.objects.values("user_id", "item_id")
+        .annotate(rows=Count("id"), total=Sum("quantity"))
+        .filter(rows__gt=1)
+    )
+    for row in duplicated:
+        carts = list(Cart.objects.filter(user_id=row["user_id"], item_id=row["item_id"]).order_by("id"))
+        Cart.objects.filter(id=carts[0].id).update(quantity=row["total"])
+        Cart.objects.filter(id__in=[cart.id for cart in carts[1:]]).delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0012_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user', 'item'), name='cart_user_item_unique'),
+        ),
+    ]
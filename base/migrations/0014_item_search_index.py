@@ -0,0 +1,69 @@
+import re
+import unicodedata
+
+from django.db import migrations
+
+# 商品検索の索引（SQLite は FTS5 の仮想テーブル、PostgreSQL は tsvector のテーブル）を作り、既存の商品を入れる。
+# 後で base.search を変えてもこのマイグレーションの結果が変わらないよう、必要なSQLと語の区切り方はここに書いておく。
+# それ以外のデータベースは索引を使わない（LIKE で探す）ので何もしない。
+_WORD = re.compile(r"\w+")
+
+
+def document(text):
+    tokens = []
+    for run in _WORD.findall(unicodedata.normalize("NFKC", text or "").lower()):
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        tokens.append(run[-1])
+    return " ".join(tokens)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        statements = [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS base_item_fts "
+            "USING fts5(name, information, tokenize='unicode61 remove_diacritics 0')",
+        ]
+        insert = "INSERT INTO base_item_fts (rowid, name, information) VALUES (%s, %s, %s)"
+    elif vendor == "postgresql":
+        statements = [
+            "CREATE TABLE IF NOT EXISTS base_item_search ("
+            "item_id bigint PRIMARY KEY REFERENCES base_item (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS base_item_search_document_idx ON base_item_search USING GIN (document)",
+        ]
+        insert = (
+            "INSERT INTO base_item_search (item_id, document) VALUES "
+            "(%s, setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B')) "
+            "ON CONFLICT (item_id) DO UPDATE SET document = EXCLUDED.document"
+        )
+    else:
+        return
+
+    Item = apps.get_model("base", "Item")
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+        last_id = 0
+        rows = Item.objects.order_by("id").values_list("id", "name", "information")
+        while batch := list(rows.filter(id__gt=last_id)[:1000]):
+            cursor.executemany(insert, [(item_id, document(name), document(information)) for item_id, name, information in batch])
+            last_id = batch[-1][0]
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    with schema_editor.connection.cursor() as cursor:
+        if vendor == "sqlite":
+            cursor.execute("DROP TABLE IF EXISTS base_item_fts")
+        elif vendor == "postgresql":
+            cursor.execute("DROP TABLE IF EXISTS base_item_search")
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0013_cart_user_item_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
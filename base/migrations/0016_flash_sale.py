@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:19
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0015_outbox_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='flash_sale',
+            field=models.BooleanField(default=False, verbose_name='フラッシュセール'),
+        ),
+        migrations.CreateModel(
+            name='FlashSaleTicket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('queued', '受付中'), ('allocated', '確保済み'), ('sold_out', '売り切れ')], default='queued', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.item')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['item', 'status', 'id'], name='flash_ticket_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+# 既存の商品に税込み価格を書き込む（base.pricing.tax_included と同じ整数演算）
+def fill_price_with_tax(apps, schema_editor):
+    Item = apps.get_model("base", "Item")
+    last_id = 0
+    while batch := list(Item.objects.filter(id__gt=last_id).order_by("id").only("id", "price", "tax_category")[:1000]):
+        last_id = batch[-1].id
+        for item in batch:
+            item.price_with_tax = item.price * (100 + settings.TAX_RATES[item.tax_category]) // 100
+        Item.objects.bulk_update(batch, ["price_with_tax"])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0016_flash_sale'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='item',
+            name='item_published_price_idx',
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='price_with_tax',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='税込み価格'),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='tax_category',
+            field=models.CharField(choices=[('standard', '標準税率'), ('reduced', '軽減税率')], default='standard', max_length=16, verbose_name='税区分'),
+        ),
+        migrations.RunPython(fill_price_with_tax, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['is_published', 'price_with_tax', 'id'], name='item_published_price_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:04
+
+from django.db import migrations, models
+from django.db.models import Count
+
+# 同じユーザー・商品の受付中の整理券が複数ある場合は、一番古いものを残してほかを売り切れにする
+def sell_out_duplicate_tickets(apps, schema_editor):
+    FlashSaleTicket = apps.get_model("base", "FlashSaleTicket")
+    queued = FlashSaleTicket.objects.filter(status="queued")
+    duplicated = queued.values("user_id", "item_id").annotate(rows=Count("id")).filter(rows__gt=1)
+    for row in duplicated:
+        ticket_ids = list(
+            queued.filter(user_id=row["user_id"], item_id=row["item_id"]).order_by("id").values_list("id", flat=True)
+        )
+        FlashSaleTicket.objects.filter(id__in=ticket_ids[1:]).update(status="sold_out")
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0017_item_price_with_tax'),
+    ]
+
+    operations = [
+        migrations.RunPython(sell_out_duplicate_tickets, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='flashsaleticket',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'queued')), fields=('user', 'item'), name='flash_ticket_one_queued'),
+        ),
+    ]
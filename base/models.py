@@ -1,12 +1,15 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+
+from .pricing import tax_included
 
 def upload_image_to(instance, filename):
     return f"images/{filename}"
 class User(AbstractUser):
     email = models.EmailField(unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     # DjangoのでファルとUserモデルとの競合を防ぐため、related_nameを追加した
     groups = models.ManyToManyField(
@@ -28,34 +31,144 @@ class Address(models.Model):
     name = models.CharField(max_length=100)
     telephone_number = models.CharField(max_length=20)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.name} ({self.post_code}) - {self.address}" 
 
 
 class Item(models.Model):
+    TAX_STANDARD = "standard"
+    TAX_REDUCED = "reduced"
+    TAX_CATEGORY_CHOICES = [
+        (TAX_STANDARD, "標準税率"),
+        (TAX_REDUCED, "軽減税率"),
+    ]
+
+    # 商品コード。一括取り込みで既存の商品と突き合わせるのに使う
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)
     name = models.CharField(max_length=100)
     image = models.ImageField(upload_to=upload_image_to, blank=True, null=True)
+    # 一覧などで使う縮小画像。{"source": 元画像, "webp": {"200": 名前, ...}, "jpeg": {...}}
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     price = models.PositiveIntegerField(default=0)
+    # 税区分（settings.TAX_RATES のキー）と、保存時に計算する税込み価格。一覧の並び替え・絞り込みは税込み価格で行う
+    tax_category = models.CharField("税区分", max_length=16, choices=TAX_CATEGORY_CHOICES, default=TAX_STANDARD)
+    price_with_tax = models.PositiveIntegerField("税込み価格", default=0, editable=False)
     is_published = models.BooleanField(default=False)
+    # フラッシュセール中の商品は、カートに入れる代わりに整理券（FlashSaleTicket）で受け付け、順番に在庫を割り当てる
+    flash_sale = models.BooleanField("フラッシュセール", default=False)
     information = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # 商品一覧のキーセットページネーション（新着順・価格順）に使う
+            models.Index(fields=["is_published", "created_at", "id"], name="item_published_new_idx"),
+            models.Index(fields=["is_published", "price_with_tax", "id"], name="item_published_price_idx"),
+        ]
 
-    # templatesのitem_detailで呼び出している
+    # 在庫数。在庫は商品ごとに1行なので、select_related("stock") すればクエリは増えない
     def get_stock(self):
-        stock_entry = Stock.objects.filter(item=self).first()
-        return stock_entry.quantity if stock_entry else 0
+        try:
+            return self.stock.quantity
+        except Stock.DoesNotExist:
+            return 0
     
-    def tax_price(self):
-        return int(self.price * 1.1)
+    # bulk_create・update では呼ばれないので、その場合は price_with_tax も一緒に書き込むこと
+    def save(self, *args, **kwargs):
+        self.price_with_tax = tax_included(self.price, self.tax_category)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"price", "tax_category"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "price_with_tax"}
+        super().save(*args, **kwargs)
 
+# 商品ごとの在庫数（1商品1行）。増減はすべて StockMovement にも記録する。
 class Stock(models.Model):
+    item = models.OneToOneField(Item, on_delete=models.CASCADE, related_name="stock")
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+# 在庫の増減の履歴（追記のみ）。quantity は増えたら正、減ったら負。
+class StockMovement(models.Model):
+    RECEIPT = "receipt"
+    SALE = "sale"
+    ADJUSTMENT = "adjustment"
+    KIND_CHOICES = [
+        (RECEIPT, "入荷"),
+        (SALE, "販売"),
+        (ADJUSTMENT, "調整"),
+    ]
+
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    quantity = models.IntegerField()
+    order = models.ForeignKey("Order", on_delete=models.SET_NULL, null=True, blank=True)
+    note = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["item", "created_at"]),
+        ]
+
+    # 履歴は書き換えない。間違いは調整の行を追加して直す。
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("在庫の履歴は変更できません")
+        super().save(*args, **kwargs)
+
+
+# 決済が終わるまで在庫を確保しておくための仮押さえ
+class StockReservation(models.Model):
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # 商品ごとの有効な仮押さえ数の集計と、期限切れの掃除に使う
+            models.Index(fields=["item", "expires_at"]),
+            models.Index(fields=["expires_at"]),
+        ]
+
+
+# フラッシュセールの購入の受付（整理券）。add_to_cart で積むだけにして在庫の行はロックせず、
+# process_flash_sales コマンドが受け付けた順にまとめて在庫を割り当てる（割り当てた分は仮押さえにしてカートに入れる）。
+class FlashSaleTicket(models.Model):
+    STATUS_QUEUED = "queued"
+    STATUS_ALLOCATED = "allocated"
+    STATUS_SOLD_OUT = "sold_out"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "受付中"),
+        (STATUS_ALLOCATED, "確保済み"),
+        (STATUS_SOLD_OUT, "売り切れ"),
+    ]
+
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # 受付中の整理券は1ユーザー1商品1枚。同時に申し込んでも二重に割り当てない
+            models.UniqueConstraint(
+                fields=["user", "item"], condition=models.Q(status="queued"), name="flash_ticket_one_queued",
+            ),
+        ]
+        indexes = [
+            # 商品ごとに受付中の整理券を受け付けた順に読むのと、順番待ちの人数を数えるのに使う
+            models.Index(fields=["item", "status", "id"], name="flash_ticket_queue_idx"),
+        ]
 
 
 class Cart(models.Model):
@@ -63,10 +176,16 @@ class Cart(models.Model):
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # 1ユーザー1商品1行。ログイン時のカートの統合はこの制約で upsert する
+            models.UniqueConstraint(fields=["user", "item"], name="cart_user_item_unique"),
+        ]
 
     def subtotal(self):
-        return self.item.tax_price() * self.quantity
+        return self.item.price_with_tax * self.quantity
 
 # 注文情報
 class Order(models.Model):
@@ -74,8 +193,17 @@ class Order(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     address = models.ForeignKey(Address, on_delete=models.CASCADE)
     total_price = models.PositiveIntegerField()
+    # 注文履歴の一覧用に、確定した時点の明細の行数と商品名を持っておく
+    line_count = models.PositiveIntegerField(default=0)
+    item_names = models.JSONField(default=list, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # 注文履歴のキーセットページネーション（新しい順）に使う
+            models.Index(fields=["user", "created_at", "id"], name="order_user_created_idx"),
+        ]
 
     def __str__(self):
         return f"注文 {self.id} - {self.user.username} - {self.created_at.strftime('%Y-%m-%d')}"
@@ -87,19 +215,101 @@ class OrderItem(models.Model):
     quantity = models.PositiveIntegerField()
     subtotal_price = models.PositiveIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
 # 決済情報
+# checkout でStripeの決済画面を作った時点で作成し、session_id を冪等キーにして注文を一度だけ確定する。
 class Payment(models.Model):
-    order = models.ForeignKey(Order, on_delete=models.CASCADE)
-    stripe_payment_id = models.CharField(max_length=255)
-    status = models.CharField(max_length=20)
+    STATUS_PENDING = "pending"
+    STATUS_PAID = "paid"
+    STATUS_EXPIRED = "expired"
+    # 在庫不足で注文を確定できなかった。返金できたら STATUS_REFUNDED にする
+    STATUS_FAILED = "failed"
+    STATUS_REFUNDED = "refunded"
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True, blank=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    address = models.ForeignKey(Address, on_delete=models.SET_NULL, null=True)
+    session_id = models.CharField(max_length=255, unique=True, null=True)
+    stripe_payment_id = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=20, default=STATUS_PENDING)
+    # checkout 時点のカートの内容。[{"cart_id", "item_id", "quantity", "subtotal"}, ...]
+    cart_snapshot = models.JSONField(default=list)
+    total_price = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
-    
 
+# 売上の集計（日別）。rollup_sales コマンドが Order から差分だけを足し込む。
+class DailySales(models.Model):
+    date = models.DateField(unique=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "日別売上"
+        verbose_name_plural = "日別売上"
+
+# 売上の集計（商品別・日別）
+class ItemSales(models.Model):
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    date = models.DateField()
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["item", "date"], name="item_sales_item_date_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["date", "item"]),
+        ]
 
+# 集計済みの位置（最後に集計した Order.id）
+class RollupState(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    last_order_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
 
 
+# 送信待ちのメール（トランザクショナル・アウトボックス）。注文と同じトランザクションで書き込み、
+# send_outbox コマンドがまとめて送る。available_at より前には送らない（取り出し中・再送待ちの間は先の時刻になる）。
+class OutboxMessage(models.Model):
+    ORDER_CONFIRMATION = "order_confirmation"
+
+    STATUS_PENDING = "pending"
+    STATUS_SENT = "sent"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "送信待ち"),
+        (STATUS_SENT, "送信済み"),
+        (STATUS_FAILED, "送信失敗"),
+    ]
+
+    kind = models.CharField(max_length=50)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True, blank=True)
+    to = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    # 取り出したワーカーの識別子。送信中の行を他のワーカーが取り出さないようにする
+    claimed_by = models.CharField(max_length=64, blank=True)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # 同じ注文の確認メールは一通だけ
+            models.UniqueConstraint(fields=["kind", "order"], name="outbox_kind_order_unique"),
+        ]
+        indexes = [
+            # ワーカーが送信待ちの行を古い順に取り出すのに使う
+            models.Index(fields=["status", "available_at", "id"], name="outbox_pending_idx"),
+        ]
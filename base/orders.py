@@ -0,0 +1,160 @@
+import logging
+
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, When
+from django.utils import timezone
+
+from .caching import invalidate_on_commit
+from .exceptions import OutOfStockError
+from .models import Item, Stock, StockMovement, Cart, Order, OrderItem, Payment
+from .outbox import enqueue_order_confirmation
+from .payments import get_gateway
+from .reservations import available_stock, release
+
+logger = logging.getLogger(__name__)
+
+
+# カートの内容から注文を確定し、在庫を減らす。
+# lines は (item, quantity, subtotal_price) のタプルのリスト。
+# カートの行数に関係なく発行するクエリ数は一定になる。
+# 在庫が足りない場合は OutOfStockError を送出し、何も書き込まない。
+def commit_order(user, address, lines):
+    # 同じ商品が複数行に分かれていても在庫は商品ごとに一回で減らす
+    quantities = {}
+    for item, quantity, _ in lines:
+        quantities[item.id] = quantities.get(item.id, 0) + quantity
+    item_ids = sorted(quantities)
+
+    with transaction.atomic():
+        # 商品IDの順にロックを取り、同時に注文が入ってもデッドロックしないようにする
+        # 自分の仮押さえ分は使えるが、他の人の仮押さえ分は使えない
+        locked = Stock.objects.select_for_update().order_by("item_id")
+        available = available_stock(item_ids, exclude_user=user, queryset=locked)
+        short = [item_id for item_id in item_ids if available[item_id] < quantities[item_id]]
+        if short:
+            raise OutOfStockError(short)
+
+        # 在庫が足りている行だけを条件付きで一度に減らす。
+        # ロックが効かないDBでも、更新件数が合わなければロールバックする。
+        enough = Q()
+        for item_id in item_ids:
+            enough |= Q(item_id=item_id, quantity__gte=quantities[item_id])
+        updated = Stock.objects.filter(enough).update(
+            quantity=Case(
+                *[When(item_id=item_id, then=F("quantity") - quantities[item_id]) for item_id in item_ids],
+                default=F("quantity"),
+                output_field=PositiveIntegerField(),
+            ),
+            updated_at=timezone.now(),
+        )
+        if updated != len(item_ids):
+            raise OutOfStockError(item_ids)
+        invalidate_on_commit(item_ids)
+
+        order = Order.objects.create(
+            user=user,
+            address=address,
+            total_price=sum(subtotal for _, _, subtotal in lines),
+            line_count=len(lines),
+            item_names=[item.name for item, _, _ in lines],
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, item=item, quantity=quantity, subtotal_price=subtotal)
+            for item, quantity, subtotal in lines
+        ])
+        StockMovement.objects.bulk_create([
+            StockMovement(item_id=item_id, kind=StockMovement.SALE, quantity=-quantities[item_id], order=order)
+            for item_id in item_ids
+        ])
+        release(user, item_ids)
+        # 確認メールは送らずに積むだけにする（送信は send_outbox コマンドが行う）
+        enqueue_order_confirmation(order, lines)
+
+    return order
+
+
+# Stripeの決済が完了したセッションから注文を確定する。
+# session_id を冪等キーにしているので、Webhookと success が何度呼んでも注文は一つだけ。
+# 注文は checkout 時点のカートのスナップショットから作る。
+# 在庫不足で確定できなければ、決済を返金してから OutOfStockError を送出する。
+def finalize_checkout(session_id, payment_intent=""):
+    with transaction.atomic():
+        payment = (
+            Payment.objects.select_for_update()
+            .select_related("user", "address")
+            .get(session_id=session_id)
+        )
+        if payment.order_id:
+            return payment.order
+        payment.stripe_payment_id = payment_intent or payment.stripe_payment_id
+
+        if payment.status not in (Payment.STATUS_FAILED, Payment.STATUS_REFUNDED):
+            items = Item.objects.in_bulk([line["item_id"] for line in payment.cart_snapshot])
+            lines = [
+                (items[line["item_id"]], line["quantity"], line["subtotal"])
+                for line in payment.cart_snapshot
+            ]
+            try:
+                # 在庫不足で失敗しても決済の状態は残したいので、セーブポイントの中で確定する
+                with transaction.atomic():
+                    order = commit_order(payment.user, payment.address, lines)
+                    Cart.objects.filter(id__in=[line["cart_id"] for line in payment.cart_snapshot]).delete()
+            except OutOfStockError:
+                payment.status = Payment.STATUS_FAILED
+                payment.save(update_fields=["status", "stripe_payment_id", "updated_at"])
+            else:
+                payment.order = order
+                payment.status = Payment.STATUS_PAID
+                payment.save(update_fields=["order", "status", "stripe_payment_id", "updated_at"])
+                return order
+
+    # 失敗の記録を確定してから、トランザクションの外で返金する。
+    # 返金に失敗しても STATUS_FAILED のまま残り、Webhookの再送や success でもう一度返金を試みる。
+    if payment.status == Payment.STATUS_FAILED:
+        refund_payment(payment)
+    raise OutOfStockError([line["item_id"] for line in payment.cart_snapshot])
+
+
+def refund_payment(payment):
+    if not payment.stripe_payment_id:
+        logger.error("返金する支払いが分かりません: %s", payment.session_id)
+        return
+    try:
+        get_gateway().refund(payment.stripe_payment_id, idempotency_key=f"refund-{payment.session_id}")
+    except Exception:
+        logger.exception("在庫不足の注文を返金できませんでした: %s", payment.session_id)
+        return
+    Payment.objects.filter(id=payment.id, status=Payment.STATUS_FAILED).update(
+        status=Payment.STATUS_REFUNDED, updated_at=timezone.now(),
+    )
+    payment.status = Payment.STATUS_REFUNDED
+
+
+# 決済されずに期限が切れたセッションの仮押さえを解放する。
+# 仮押さえはユーザーごとで、checkout のたびに置き換わる（reserve）。同じユーザーのもっと新しいセッションが
+# 決済待ちなら、今の仮押さえはそのセッションのものなので解放しない（解放すると、決済できても在庫がなくなる）。
+def expire_checkout(session_id):
+    with transaction.atomic():
+        payment = Payment.objects.select_for_update().filter(session_id=session_id).first()
+        if payment is None or payment.status != Payment.STATUS_PENDING:
+            return
+        payment.status = Payment.STATUS_EXPIRED
+        payment.save(update_fields=["status", "updated_at"])
+        newer = Payment.objects.filter(user_id=payment.user_id, status=Payment.STATUS_PENDING, id__gt=payment.id)
+        if not newer.exists():
+            release(payment.user, [line["item_id"] for line in payment.cart_snapshot])
+
+
+# StripeのWebhookイベントを処理する。対象外のイベントは無視する。
+def handle_payment_event(event):
+    session = event["data"]["object"]
+    if event["type"] in ("checkout.session.completed", "checkout.session.async_payment_succeeded"):
+        if session.get("payment_status") == "paid":
+            try:
+                finalize_checkout(session["id"], session.get("payment_intent") or "")
+            except Payment.DoesNotExist:
+                logger.warning("未知の決済セッションです: %s", session["id"])
+            except OutOfStockError:
+                logger.error("決済済みですが在庫不足で注文を確定できませんでした（返金を試みました）: %s", session["id"])
+    elif event["type"] == "checkout.session.expired":
+        expire_checkout(session["id"])
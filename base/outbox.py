@@ -0,0 +1,132 @@
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+# 注文確認メールをアウトボックスに積む。commit_order のトランザクションの中で呼ぶので、
+# 注文がロールバックされればメールも残らず、注文が確定すれば必ず送られる。
+# lines は commit_order と同じ (item, quantity, subtotal_price) のリスト。メール本文はこの時点の内容で作る。
+def enqueue_order_confirmation(order, lines):
+    if not order.user.email:
+        return None
+    body = render_to_string("emails/order_confirmation.txt", {
+        "user": order.user,
+        "order": order,
+        "address": order.address,
+        "lines": lines,
+    })
+    return OutboxMessage.objects.create(
+        kind=OutboxMessage.ORDER_CONFIRMATION,
+        order=order,
+        to=order.user.email,
+        subject=f"ご注文ありがとうございます（注文番号 {order.id}）",
+        body=body,
+    )
+
+
+# 送り直すまでの秒数。失敗するたびに倍にする
+def retry_delay(attempts):
+    return timedelta(seconds=min(settings.OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.OUTBOX_RETRY_MAX_SECONDS))
+
+
+# 送信待ちの行を batch_size 件まで取り出す。取り出した行は available_at を OUTBOX_LEASE_SECONDS 秒先にして、
+# その間は他のワーカーが取り出さないようにする。
+# PostgreSQL では SKIP LOCKED で他のワーカーが取り出し中の行を待たずに飛ばす。
+# SKIP LOCKED のないDBでも、条件付きの UPDATE で取り出すので、同じ行を二つのワーカーが取り出すことはない。
+def claim_batch(batch_size=50, now=None):
+    now = now or timezone.now()
+    worker = uuid.uuid4().hex
+    ready = OutboxMessage.objects.filter(status=OutboxMessage.STATUS_PENDING, available_at__lte=now)
+    with transaction.atomic():
+        message_ids = list(
+            ready.select_for_update(skip_locked=True).order_by("available_at", "id").values_list("id", flat=True)[:batch_size]
+        )
+        if not message_ids:
+            return []
+        ready.filter(id__in=message_ids).update(
+            claimed_by=worker, available_at=now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS), updated_at=now,
+        )
+    return list(OutboxMessage.objects.filter(id__in=message_ids, claimed_by=worker).order_by("id"))
+
+
+# 一つの接続（SMTPなら一回のログイン）でまとめて送る。戻り値は (送れた行, [(送れなかった行, 例外), ...])
+def deliver(messages):
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as error:
+        return [], [(message, error) for message in messages]
+
+    sent, failed = [], []
+    try:
+        for message in messages:
+            email = EmailMessage(
+                message.subject, message.body, settings.DEFAULT_FROM_EMAIL, [message.to], connection=connection,
+            )
+            # 一通の失敗（宛先の誤りなど）で残りを止めないよう、どの例外でも記録して次へ進む
+            try:
+                email.send()
+            except Exception as error:
+                failed.append((message, error))
+            else:
+                sent.append(message)
+    finally:
+        connection.close()
+    return sent, failed
+
+
+# 送信の結果を書き込む。失敗した行は待ち時間を延ばして送信待ちに戻し、OUTBOX_MAX_ATTEMPTS 回目で諦める。
+def record_results(sent, failed, now=None):
+    now = now or timezone.now()
+    if sent:
+        OutboxMessage.objects.filter(id__in=[message.id for message in sent]).update(
+            status=OutboxMessage.STATUS_SENT, sent_at=now, claimed_by="", last_error="", updated_at=now,
+        )
+    for message, error in failed:
+        message.attempts += 1
+        message.last_error = f"{type(error).__name__}: {error}"
+        message.claimed_by = ""
+        message.updated_at = now
+        if message.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            message.status = OutboxMessage.STATUS_FAILED
+            logger.error("メールを送信できませんでした（諦めます）: outbox=%s %s", message.id, message.last_error)
+        else:
+            message.available_at = now + retry_delay(message.attempts)
+            logger.warning("メールを送信できませんでした（再送します）: outbox=%s %s", message.id, message.last_error)
+    OutboxMessage.objects.bulk_update(
+        [message for message, _ in failed], ["status", "attempts", "available_at", "claimed_by", "last_error", "updated_at"],
+    )
+
+
+# 一回分（batch_size 件まで）を送る。戻り値は (送れた件数, 送れなかった件数)
+def send_batch(batch_size=50, now=None):
+    messages = claim_batch(batch_size, now)
+    if not messages:
+        return 0, 0
+    sent, failed = deliver(messages)
+    record_results(sent, failed)
+    return len(sent), len(failed)
+
+
+# 今送れるものがなくなるまで batch_size 件ずつ送る。progress には (送れた件数, 送れなかった件数) の合計を渡す。
+# 送れなかった行は先の時刻に回るので、同じ呼び出しの中で何度も送り直すことはない。
+def send_pending(batch_size=50, progress=None):
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = send_batch(batch_size)
+        if not sent and not failed:
+            return total_sent, total_failed
+        total_sent += sent
+        total_failed += failed
+        if progress:
+            progress(total_sent, total_failed)
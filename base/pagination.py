@@ -0,0 +1,88 @@
+import base64
+import json
+from dataclasses import dataclass
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+# カーソルが壊れている・改ざんされているときに送出する
+class InvalidCursor(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class KeysetPage:
+    object_list: list
+    next_cursor: str
+    has_next: bool
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, default=str, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, size):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor(cursor)
+    return values
+
+
+# ordering の並びで values より後ろにある行だけを選ぶ条件。
+# 例えば ("-created_at", "-id") なら created_at < v0 OR (created_at = v0 AND id < v1)
+def after_filter(ordering, values):
+    condition = Q()
+    for i, field in enumerate(ordering):
+        name = field.lstrip("-")
+        lookup = "lt" if field.startswith("-") else "gt"
+        step = Q(**{f"{name}__{lookup}": values[i]})
+        for previous, value in zip(ordering[:i], values[:i]):
+            step &= Q(**{previous.lstrip("-"): value})
+        condition |= step
+    return condition
+
+
+# カーソルの値を、並びに使う列の型に直す。形は正しくても型が違えば（改ざんなど）InvalidCursor を送出する。
+def cursor_values(model, ordering, cursor):
+    values = []
+    for field_name, value in zip(ordering, decode_cursor(cursor, len(ordering))):
+        field = model._meta.get_field(field_name.lstrip("-"))
+        try:
+            if value is None:
+                raise ValueError(value)
+            value = field.to_python(value)
+            field.run_validators(value)
+        except (ValidationError, TypeError, ValueError):
+            raise InvalidCursor(cursor)
+        values.append(value)
+    return values
+
+
+# OFFSET を使わず、前のページの最後の行の値から次のページを読む（キーセットページネーション）。
+# ordering は一意になるように最後に id を含めること。どのページでも読む行数は per_page + 1 行。
+def keyset_page(queryset, ordering, cursor=None, per_page=24):
+    ordering = tuple(ordering)
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        queryset = queryset.filter(after_filter(ordering, cursor_values(queryset.model, ordering, cursor)))
+
+    rows = list(queryset[:per_page + 1])
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = ""
+    if has_next:
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, field.lstrip("-")) for field in ordering])
+    return KeysetPage(object_list=rows, next_cursor=next_cursor, has_next=has_next)
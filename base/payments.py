@@ -0,0 +1,158 @@
+import asyncio
+import functools
+import json
+import logging
+import math
+import time
+import uuid
+from types import SimpleNamespace
+
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Stripeの決済画面の期限は、作成から30分以上先でなければならない
+STRIPE_MIN_SESSION_SECONDS = 30 * 60
+# 秒の切り捨てと、リクエストがStripeに届くまでの遅れの分の余裕
+STRIPE_SESSION_MARGIN_SECONDS = 60
+
+
+# 決済画面の期限（UNIX時刻）。CHECKOUT_SESSION_SECONDS が短くても Stripe の最短期限を下回らないようにする。
+def checkout_session_expires_at(now=None):
+    seconds = max(settings.CHECKOUT_SESSION_SECONDS, STRIPE_MIN_SESSION_SECONDS + STRIPE_SESSION_MARGIN_SECONDS)
+    return math.ceil(now or time.time()) + seconds
+
+
+# 署名の検証に失敗したWebhookのときに送出する
+class InvalidWebhook(Exception):
+    pass
+
+
+# 決済サービスとのやり取りのインターフェース。settings.PAYMENT_GATEWAY で差し替える。
+# checkout は非同期版の acreate_checkout_session を使うので、待っている間にワーカーを塞がない。
+class PaymentGateway:
+    def create_checkout_session(self, request, **params):
+        raise NotImplementedError
+
+    async def acreate_checkout_session(self, request, **params):
+        return await sync_to_async(self.create_checkout_session)(request, **params)
+
+    def retrieve_checkout_session(self, session_id):
+        raise NotImplementedError
+
+    # 支払いを全額返金する。idempotency_key が同じなら、何度呼んでも返金は一回だけ。
+    def refund(self, payment_intent, idempotency_key):
+        raise NotImplementedError
+
+    def construct_event(self, payload, signature):
+        raise NotImplementedError
+
+
+# プロセス内で使い回すStripeのクライアント。
+# HTTPの接続はプールして再利用し、タイムアウトとリトライ回数の上限をつける。
+# httpx が入っていれば非同期の呼び出しもプールした接続で行う。
+# 入っていなければ非同期の呼び出しはスレッドで同期の呼び出しを待つことになるので、警告を出しておく。
+@functools.cache
+def stripe_client():
+    try:
+        async_http_client = stripe.HTTPXClient(timeout=settings.STRIPE_TIMEOUT)
+    except ImportError:
+        async_http_client = None
+        logger.warning("httpx がないため、Stripeへの非同期の呼び出しはスレッドで同期的に行います")
+    http_client = stripe.RequestsClient(timeout=settings.STRIPE_TIMEOUT, async_fallback_client=async_http_client)
+    return stripe.StripeClient(
+        settings.STRIPE_SECRET_KEY,
+        http_client=http_client,
+        max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+    ), async_http_client is not None
+
+
+# 本番用。Stripeの決済画面の作成とWebhookの検証を行う。
+class StripeGateway(PaymentGateway):
+    def create_checkout_session(self, request, **params):
+        client, _ = stripe_client()
+        return client.v1.checkout.sessions.create(params=params)
+
+    async def acreate_checkout_session(self, request, **params):
+        client, supports_async = stripe_client()
+        if not supports_async:
+            return await super().acreate_checkout_session(request, **params)
+        return await client.v1.checkout.sessions.create_async(params=params)
+
+    def retrieve_checkout_session(self, session_id):
+        client, _ = stripe_client()
+        return client.v1.checkout.sessions.retrieve(session_id)
+
+    def refund(self, payment_intent, idempotency_key):
+        client, _ = stripe_client()
+        return client.v1.refunds.create(
+            params={"payment_intent": payment_intent}, options={"idempotency_key": idempotency_key},
+        )
+
+    def construct_event(self, payload, signature):
+        try:
+            return stripe.Webhook.construct_event(payload, signature, settings.STRIPE_WEBHOOK_SECRET)
+        except (ValueError, stripe.SignatureVerificationError) as e:
+            raise InvalidWebhook(str(e))
+
+
+# ネットワークなしで決済の流れを試すためのStripeの代わり。
+# 決済画面は fake_stripe_checkout ビューで、開くと支払い済みになり success_url に戻る。
+# settings.FAKE_STRIPE_LATENCY 秒だけ応答を遅らせて、負荷試験にも使える。
+class FakeStripeGateway(PaymentGateway):
+    sessions = {}
+    refunds = {}
+
+    def create_checkout_session(self, request, **params):
+        time.sleep(settings.FAKE_STRIPE_LATENCY)
+        return self._create_session(request, params)
+
+    async def acreate_checkout_session(self, request, **params):
+        await asyncio.sleep(settings.FAKE_STRIPE_LATENCY)
+        return self._create_session(request, params)
+
+    def _create_session(self, request, params):
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        self.sessions[session_id] = {
+            "id": session_id,
+            "object": "checkout.session",
+            "payment_status": "unpaid",
+            "status": "open",
+            "payment_intent": None,
+            "amount_total": sum(
+                line["price_data"]["unit_amount"] * line["quantity"] for line in params["line_items"]
+            ),
+            "expires_at": params.get("expires_at"),
+            "success_url": params["success_url"],
+            "cancel_url": params["cancel_url"],
+            "url": request.build_absolute_uri(reverse("fake_stripe_checkout", args=[session_id])),
+        }
+        return SimpleNamespace(**self.sessions[session_id])
+
+    def retrieve_checkout_session(self, session_id):
+        return SimpleNamespace(**self.sessions[session_id])
+
+    def complete(self, session_id):
+        session = self.sessions[session_id]
+        session.update(payment_status="paid", status="complete", payment_intent=f"pi_test_{uuid.uuid4().hex}")
+        return {"type": "checkout.session.completed", "data": {"object": dict(session)}}
+
+    def refund(self, payment_intent, idempotency_key):
+        refund = self.refunds.setdefault(
+            idempotency_key, {"id": f"re_test_{uuid.uuid4().hex}", "payment_intent": payment_intent},
+        )
+        return SimpleNamespace(**refund)
+
+    def construct_event(self, payload, signature):
+        try:
+            return json.loads(payload)
+        except ValueError as e:
+            raise InvalidWebhook(str(e))
+
+
+def get_gateway():
+    return import_string(settings.PAYMENT_GATEWAY)()
@@ -0,0 +1,23 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+
+# ログの書き込みを別スレッドに任せるハンドラ。リクエストのスレッドはキューに積むだけで戻る。
+# settings.LOGGING から filename を指定して使う。
+class QueueFileHandler(logging.handlers.QueueHandler):
+    def __init__(self, filename, encoding="utf-8"):
+        super().__init__(queue.SimpleQueue())
+        file_handler = logging.FileHandler(filename, encoding=encoding)
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        self.listener = logging.handlers.QueueListener(self.queue, file_handler)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    # メッセージはJSON文字列なので、そのまま書き出す
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.args = None
+        record.exc_info = None
+        return record
@@ -0,0 +1,174 @@
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .caching import invalidate_on_commit
+
+# 税込み価格は整数演算で計算して、小数の誤差で1円ずれないようにする。
+# 税率（%）は商品の税区分ごとに settings.TAX_RATES で決める。
+# 商品の税込み価格（Item.price_with_tax）は保存するときに計算して持つので、
+# 税率を変えたら backfill_tax_prices コマンドで計算し直すこと。
+
+
+def tax_included(price, tax_category="standard"):
+    return price * (100 + settings.TAX_RATES[tax_category]) // 100
+
+
+# 保存している税込み価格を、今の税率で計算し直す。商品は id の順に batch_size 件ずつ読み、
+# 変わったものだけを書き込んでキャッシュを無効にする。戻り値は (確かめた件数, 書き換えた件数)
+def backfill_tax_prices(batch_size=1000, progress=None):
+    # models がこのモジュールを読み込むので、ここで読み込む
+    from .models import Item
+
+    checked = updated = 0
+    last_id = 0
+    now = timezone.now()
+    items = Item.objects.order_by("id").only("id", "price", "tax_category", "price_with_tax")
+    while batch := list(items.filter(id__gt=last_id)[:batch_size]):
+        last_id = batch[-1].id
+        changed = []
+        for item in batch:
+            price_with_tax = tax_included(item.price, item.tax_category)
+            if item.price_with_tax != price_with_tax:
+                item.price_with_tax = price_with_tax
+                # 一覧・詳細ページの Last-Modified と ETag は updated_at から作るので、一緒に進める
+                item.updated_at = now
+                changed.append(item)
+        if changed:
+            with transaction.atomic():
+                Item.objects.bulk_update(changed, ["price_with_tax", "updated_at"])
+                invalidate_on_commit([item.id for item in changed], catalog=True)
+        checked += len(batch)
+        updated += len(changed)
+        if progress:
+            progress(checked, updated)
+    return checked, updated
+
+
+# カートの1行分の金額
+@dataclass(frozen=True)
+class PricedLine:
+    cart_id: int
+    item: object
+    quantity: int
+    unit_price: int
+    subtotal: int
+
+
+# 金額を計算済みのカート。作成後は変更しない。
+@dataclass(frozen=True)
+class PricedCart:
+    lines: tuple
+    total_price: int
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    @property
+    def cart_ids(self):
+        return [line.cart_id for line in self.lines]
+
+    # 商品ごとの合計個数 {item_id: 個数}
+    def quantities(self):
+        quantities = {}
+        for line in self.lines:
+            quantities[line.item.id] = quantities.get(line.item.id, 0) + line.quantity
+        return quantities
+
+    # commit_order に渡す (item, quantity, subtotal_price) のリスト
+    def order_lines(self):
+        return [(line.item, line.quantity, line.subtotal) for line in self.lines]
+
+    # 決済完了後に注文を確定するための、checkout 時点のスナップショット
+    def snapshot(self):
+        return [
+            {"cart_id": line.cart_id, "item_id": line.item.id, "quantity": line.quantity, "subtotal": line.subtotal}
+            for line in self.lines
+        ]
+
+    # カートのAPIで返すJSON
+    def as_dict(self):
+        return {
+            "lines": [
+                {
+                    "item_id": line.item.id,
+                    "name": line.item.name,
+                    "quantity": line.quantity,
+                    "unit_price": line.unit_price,
+                    "subtotal": line.subtotal,
+                }
+                for line in self.lines
+            ],
+            "total_price": self.total_price,
+        }
+
+    # Stripeの決済画面に渡す line_items
+    def stripe_line_items(self):
+        return [
+            {
+                "price_data": {
+                    "currency": "jpy",
+                    "product_data": {
+                        "name": line.item.name,
+                    },
+                    "unit_amount": line.unit_price,
+                },
+                "quantity": line.quantity,
+            }
+            for line in self.lines
+        ]
+
+
+# ユーザーのカートを商品と一緒に一回のクエリで読み込み、金額を計算する
+def price_cart(user):
+    cart_items = user.cart_set.select_related("item").order_by("id")
+    lines = []
+    for cart_item in cart_items:
+        unit_price = cart_item.item.price_with_tax
+        lines.append(PricedLine(
+            cart_id=cart_item.id,
+            item=cart_item.item,
+            quantity=cart_item.quantity,
+            unit_price=unit_price,
+            subtotal=unit_price * cart_item.quantity,
+        ))
+    return PricedCart(lines=tuple(lines), total_price=sum(line.subtotal for line in lines))
+
+
+# ログインしていないお客さんのカート {商品ID: 個数} を、商品を一回のクエリで読み込んで計算する。
+# Cart の行はないので cart_id は None。
+def price_quantities(quantities):
+    # models がこのモジュールを読み込むので、ここで読み込む
+    from .models import Item
+
+    items = Item.objects.in_bulk(list(quantities))
+    lines = []
+    for item_id, quantity in quantities.items():
+        item = items.get(item_id)
+        if item is None:
+            continue
+        unit_price = item.price_with_tax
+        lines.append(PricedLine(
+            cart_id=None, item=item, quantity=quantity, unit_price=unit_price, subtotal=unit_price * quantity,
+        ))
+    return PricedCart(lines=tuple(lines), total_price=sum(line.subtotal for line in lines))
+
+
+# 1回のリクエストの中ではカートの計算結果を使い回す
+def get_priced_cart(request, refresh=False):
+    if refresh or not hasattr(request, "_priced_cart"):
+        if request.user.is_authenticated:
+            request._priced_cart = price_cart(request.user)
+        else:
+            from .carts import cookie_cart
+
+            request._priced_cart = price_quantities(cookie_cart(request).quantities())
+    return request._priced_cart
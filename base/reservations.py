@@ -0,0 +1,93 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .caching import invalidate_items, invalidate_on_commit
+from .models import Stock, StockReservation
+from .exceptions import OutOfStockError
+
+
+# 有効な仮押さえ数を商品ごとに合計するサブクエリ。exclude_user の分は数えない。
+def held_quantity_subquery(now, exclude_user=None):
+    holds = StockReservation.objects.filter(item_id=OuterRef("item_id"), expires_at__gt=now)
+    if exclude_user is not None:
+        holds = holds.exclude(user=exclude_user)
+    holds = holds.order_by().values("item_id").annotate(total=Sum("quantity")).values("total")
+    return Coalesce(Subquery(holds, output_field=IntegerField()), 0)
+
+
+# 在庫数から有効な仮押さえ数を引いた、購入可能な数を一回のクエリで返す。
+# 戻り値は {item_id: 購入可能数}。在庫のない商品は 0 になる。
+def available_stock(item_ids, exclude_user=None, queryset=None):
+    item_ids = list(item_ids)
+    queryset = Stock.objects.all() if queryset is None else queryset
+    rows = (
+        queryset.filter(item_id__in=item_ids)
+        .annotate(held=held_quantity_subquery(timezone.now(), exclude_user))
+        .values_list("item_id", "quantity", "held")
+    )
+    available = dict.fromkeys(item_ids, 0)
+    for item_id, quantity, held in rows:
+        available[item_id] += quantity
+        available[item_id] -= held
+    return {item_id: max(quantity, 0) for item_id, quantity in available.items()}
+
+
+# checkout で決済が終わるまで在庫を仮押さえする。
+# quantities は {item_id: 個数}。以前の仮押さえは置き換える。
+# 足りない商品があれば OutOfStockError を送出し、何も確保しない。
+def reserve(user, quantities):
+    expires_at = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_SECONDS)
+    item_ids = sorted(quantities)
+
+    with transaction.atomic():
+        # 商品IDの順に在庫行をロックしてから、他の人の仮押さえを差し引いて確認する
+        locked = Stock.objects.select_for_update().order_by("item_id")
+        available = available_stock(item_ids, exclude_user=user, queryset=locked)
+        short = [item_id for item_id in item_ids if available[item_id] < quantities[item_id]]
+        if short:
+            raise OutOfStockError(short)
+
+        previous = StockReservation.objects.filter(user=user)
+        previous_item_ids = set(previous.values_list("item_id", flat=True))
+        previous.delete()
+        StockReservation.objects.bulk_create([
+            StockReservation(item_id=item_id, user=user, quantity=quantities[item_id], expires_at=expires_at)
+            for item_id in item_ids
+        ])
+        invalidate_on_commit(previous_item_ids.union(item_ids))
+
+    return expires_at
+
+
+# 決済が終わったユーザーの仮押さえを消す。注文確定と同じトランザクションで呼ぶ。
+def release(user, item_ids=None):
+    holds = StockReservation.objects.filter(user=user)
+    if item_ids is None:
+        item_ids = set(holds.values_list("item_id", flat=True))
+    else:
+        holds = holds.filter(item_id__in=list(item_ids))
+    deleted = holds.delete()[0]
+    if deleted:
+        invalidate_on_commit(item_ids)
+    return deleted
+
+
+# 期限切れの仮押さえをまとめて削除する。一度に消す件数は batch_size まで。
+def sweep_expired(batch_size=1000, now=None):
+    now = now or timezone.now()
+    deleted = 0
+    while True:
+        rows = list(
+            StockReservation.objects.filter(expires_at__lte=now)
+            .order_by("expires_at")
+            .values_list("id", "item_id")[:batch_size]
+        )
+        if not rows:
+            return deleted
+        deleted += StockReservation.objects.filter(id__in=[row[0] for row in rows]).delete()[0]
+        invalidate_items({row[1] for row in rows})
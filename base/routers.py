@@ -0,0 +1,123 @@
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+# レプリカから読んでよいのは base アプリのモデルだけ。セッションとユーザーはログイン直後に読むので、常にプライマリーから読む。
+REPLICA_APP_LABELS = {"base"}
+
+_state = ContextVar("db_routing_state", default=None)
+# 接続できなかったレプリカと、もう一度試す時刻（プロセス内で共有する）
+_unhealthy = {}
+
+
+# リクエストごとの振り分けの状態
+class RoutingState:
+    def __init__(self, pinned=False):
+        # 直前のリクエストで書き込んだ（レプリカがまだ追いついていないかもしれない）
+        self.pinned = pinned
+        # このリクエストで書き込んだ
+        self.wrote = False
+        # レプリカから読んでよい範囲（@replica_reads のビューの中）にいる
+        self.replica_reads = False
+        self.primary_depth = 0
+
+    @property
+    def use_replica(self):
+        return self.replica_reads and not (self.pinned or self.wrote or self.primary_depth)
+
+
+@contextmanager
+def routing_state(pinned=False):
+    state = RoutingState(pinned)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+# ビューの中の読み込みをレプリカに振り分けてよいことにする（ReplicaRoutingMiddleware が必要）
+def replica_reads(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        state = _state.get()
+        if state is None:
+            return view(request, *args, **kwargs)
+        state.replica_reads = True
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            state.replica_reads = False
+    return wrapper
+
+
+# この中の読み込みはプライマリーから行う（無効にした直後のキャッシュを作り直すときなど）
+@contextmanager
+def primary_reads():
+    state = _state.get()
+    if state is None:
+        yield
+        return
+    state.primary_depth += 1
+    try:
+        yield
+    finally:
+        state.primary_depth -= 1
+
+
+def healthy_replicas(now=None):
+    now = now or time.monotonic()
+    return [alias for alias in settings.DATABASE_REPLICAS if _unhealthy.get(alias, 0) <= now]
+
+
+# 接続できるレプリカを一つ選ぶ。接続できなければ REPLICA_RETRY_SECONDS 秒は使わない。なければ None（プライマリー）
+def choose_replica():
+    candidates = healthy_replicas()
+    random.shuffle(candidates)
+    for alias in candidates:
+        try:
+            connections[alias].ensure_connection()
+        except DatabaseError:
+            logger.warning("レプリカに接続できないため、しばらくプライマリーから読みます: %s", alias, exc_info=True)
+            _unhealthy[alias] = time.monotonic() + settings.REPLICA_RETRY_SECONDS
+            continue
+        _unhealthy.pop(alias, None)
+        return alias
+    return None
+
+
+# 読み込みをレプリカに振り分けるルーター。レプリカに振り分けるのは次のすべてを満たすときだけ:
+# @replica_reads のビューの中で、そのリクエストでまだ書き込んでおらず、直前に書き込んだユーザーでもなく、
+# プライマリーのトランザクションの中でもない。書き込みは常にプライマリーに行う。
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.use_replica or model._meta.app_label not in REPLICA_APP_LABELS:
+            return None
+        if model._meta.label == settings.AUTH_USER_MODEL or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return choose_replica()
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    # レプリカはプライマリーの複製なので、どちらから読んだオブジェクトも関連づけてよい
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    # マイグレーションはプライマリーにだけ行い、レプリカにはレプリケーションで反映する
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
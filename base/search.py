@@ -0,0 +1,251 @@
+import re
+import unicodedata
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections, router, transaction
+from django.db.models import Q
+
+from .models import Item
+from .pagination import InvalidCursor, decode_cursor, encode_cursor
+
+# 商品検索の索引。日本語は単語の区切りがないので、文字列を2文字ずつ（bi-gram）に区切った語で索引を作り、
+# 検索語も同じように区切って「隣り合って並んでいる」ことを条件にする（部分一致と同じ結果になる）。
+# SQLite は FTS5 の仮想テーブル、PostgreSQL は tsvector の列と GIN インデックスを使う。
+# それ以外のデータベースでは索引を作らず、商品名と説明文の LIKE で探す（LikeSearchBackend）。
+SQLITE_TABLE = "base_item_fts"
+POSTGRES_TABLE = "base_item_search"
+
+_WORD = re.compile(r"\w+")
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+# 文字列を bi-gram の語に区切る。1文字だけの検索語も前方一致で探せるよう、各かたまりの最後の1文字も語にする。
+def bigrams(text):
+    tokens = []
+    for run in _WORD.findall(normalize(text)):
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        tokens.append(run[-1])
+    return tokens
+
+
+def document(text):
+    return " ".join(bigrams(text))
+
+
+# 検索語を空白で区切り、それぞれを bi-gram の並びにする。戻り値は [[語, ...], ...]（1文字なら [文字]）
+def query_terms(query):
+    terms = []
+    for word in normalize(query).split():
+        for run in _WORD.findall(word):
+            terms.append([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+    return terms
+
+
+class SQLiteSearchBackend:
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_TABLE} "
+            "USING fts5(name, information, tokenize='unicode61 remove_diacritics 0')"
+        )
+
+    def drop(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {SQLITE_TABLE}")
+
+    def remove(self, cursor, item_ids):
+        cursor.executemany(f"DELETE FROM {SQLITE_TABLE} WHERE rowid = %s", [(item_id,) for item_id in item_ids])
+
+    def insert(self, cursor, rows):
+        cursor.executemany(
+            f"INSERT INTO {SQLITE_TABLE} (rowid, name, information) VALUES (%s, %s, %s)",
+            [(item_id, document(name), document(information)) for item_id, name, information in rows],
+        )
+
+    def clear(self, cursor):
+        cursor.execute(f"DELETE FROM {SQLITE_TABLE}")
+
+    @staticmethod
+    def match_expression(terms, name_only=False):
+        phrases = []
+        for term in terms:
+            phrase = '"' + " ".join(token.replace('"', '""') for token in term) + '"'
+            phrases.append(phrase + "*" if len(term) == 1 and len(term[0]) == 1 else phrase)
+        expression = "(" + " AND ".join(phrases) + ")"
+        return f"name : {expression}" if name_only else f"{expression} NOT name : {expression}"
+
+    def search(self, cursor, terms, tier, before_id, limit):
+        before = f"AND {SQLITE_TABLE}.rowid < %s " if before_id else ""
+        cursor.execute(
+            f"SELECT {SQLITE_TABLE}.rowid FROM {SQLITE_TABLE} JOIN base_item i ON i.id = {SQLITE_TABLE}.rowid "
+            f"WHERE {SQLITE_TABLE} MATCH %s AND i.is_published {before}"
+            f"ORDER BY {SQLITE_TABLE}.rowid DESC LIMIT %s",
+            [self.match_expression(terms, name_only=tier == 0), *([before_id] if before_id else []), limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearchBackend:
+    def create(self, cursor):
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {POSTGRES_TABLE} ("
+            "item_id bigint PRIMARY KEY REFERENCES base_item (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {POSTGRES_TABLE}_document_idx ON {POSTGRES_TABLE} USING GIN (document)"
+        )
+
+    def drop(self, cursor):
+        cursor.execute(f"DROP TABLE IF EXISTS {POSTGRES_TABLE}")
+
+    def remove(self, cursor, item_ids):
+        cursor.execute(f"DELETE FROM {POSTGRES_TABLE} WHERE item_id = ANY(%s)", [list(item_ids)])
+
+    def insert(self, cursor, rows):
+        cursor.executemany(
+            f"INSERT INTO {POSTGRES_TABLE} (item_id, document) VALUES "
+            "(%s, setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B')) "
+            "ON CONFLICT (item_id) DO UPDATE SET document = EXCLUDED.document",
+            [(item_id, document(name), document(information)) for item_id, name, information in rows],
+        )
+
+    def clear(self, cursor):
+        cursor.execute(f"TRUNCATE {POSTGRES_TABLE}")
+
+    @staticmethod
+    def tsquery(terms, weight=""):
+        phrases = []
+        for term in terms:
+            lexemes = ["'" + token.replace("'", "''").replace("\\", "\\\\") + "'" for token in term]
+            if len(term) == 1 and len(term[0]) == 1:
+                phrases.append(f"{lexemes[0]}:*{weight}")
+            else:
+                phrases.append(" <-> ".join(f"{lexeme}:{weight}" if weight else lexeme for lexeme in lexemes))
+        return " & ".join(f"({phrase})" for phrase in phrases)
+
+    def search(self, cursor, terms, tier, before_id, limit):
+        # 商品名は重み A で索引に入れているので、A に限った検索が商品名での一致になる
+        name_query = self.tsquery(terms, weight="A")
+        if tier == 0:
+            condition, params = "s.document @@ to_tsquery('simple', %s)", [name_query]
+        else:
+            condition = "s.document @@ to_tsquery('simple', %s) AND NOT s.document @@ to_tsquery('simple', %s)"
+            params = [self.tsquery(terms), name_query]
+        if before_id:
+            condition += " AND s.item_id < %s"
+            params.append(before_id)
+        cursor.execute(
+            f"SELECT s.item_id FROM {POSTGRES_TABLE} s JOIN base_item i ON i.id = s.item_id "
+            f"WHERE {condition} AND i.is_published ORDER BY s.item_id DESC LIMIT %s",
+            [*params, limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+# 全文検索の索引がないデータベース用。索引の更新は何もせず、検索のたびに商品の表を LIKE で読む。
+# 商品が多いと遅く、全角・半角の違いも吸収しないが、商品の保存や検索は動く。
+class LikeSearchBackend:
+    def create(self, cursor):
+        pass
+
+    def drop(self, cursor):
+        pass
+
+    def remove(self, cursor, item_ids):
+        pass
+
+    def insert(self, cursor, rows):
+        pass
+
+    def clear(self, cursor):
+        pass
+
+    def search(self, cursor, terms, tier, before_id, limit):
+        # bi-gram の並びを元の語に戻す（["鹿肉", "肉ロ"] → "鹿肉ロ"）
+        words = [term[0] + "".join(token[1:] for token in term[1:]) for term in terms]
+        in_name = Q()
+        in_text = Q()
+        for word in words:
+            in_name &= Q(name__icontains=word)
+            in_text &= Q(name__icontains=word) | Q(information__icontains=word)
+        items = Item.objects.using(cursor.db.alias).filter(is_published=True)
+        items = items.filter(in_name) if tier == 0 else items.filter(in_text).exclude(in_name)
+        if before_id:
+            items = items.filter(id__lt=before_id)
+        return list(items.order_by("-id").values_list("id", flat=True)[:limit])
+
+
+def get_backend(using=None):
+    vendor = (using or connection).vendor
+    if vendor == "postgresql":
+        return PostgresSearchBackend()
+    if vendor == "sqlite":
+        return SQLiteSearchBackend()
+    return LikeSearchBackend()
+
+
+# 商品を索引に入れ直す。rows は (id, name, information) の並び。
+def index_items(rows):
+    rows = list(rows)
+    if not rows:
+        return
+    backend = get_backend()
+    with connection.cursor() as cursor:
+        backend.remove(cursor, [row[0] for row in rows])
+        backend.insert(cursor, rows)
+
+
+def remove_items(item_ids):
+    item_ids = list(item_ids)
+    if item_ids:
+        with connection.cursor() as cursor:
+            get_backend().remove(cursor, item_ids)
+
+
+# 索引を作り直す。商品は id の順に batch_size 件ずつ読み込む。
+# 一つのトランザクションで行うので、作り直している間も検索には前の索引が使われる。
+def rebuild_index(batch_size=1000, progress=None):
+    backend = get_backend()
+    total = 0
+    last_id = 0
+    rows = Item.objects.order_by("id").values_list("id", "name", "information")
+    with transaction.atomic(), connection.cursor() as cursor:
+        backend.clear(cursor)
+        while batch := list(rows.filter(id__gt=last_id)[:batch_size]):
+            backend.insert(cursor, batch)
+            last_id = batch[-1][0]
+            total += len(batch)
+            if progress:
+                progress(total)
+    return total
+
+
+# 公開中の商品を検索する。順位は「すべての検索語が商品名にある」商品を先に、次に説明文にもある商品を、
+# それぞれ新しい順に並べる。件数の多い語で bm25 などの点数を全件分計算すると遅いので、
+# 索引を id の降順に読んで必要な件数だけで止められる並べ方にしている。
+# 次のページは (段, 最後の商品ID) のカーソルで続きから読む。戻り値は (商品IDのリスト, 次のページのカーソル)
+def search_item_ids(query, cursor=None, per_page=24):
+    terms = query_terms(query)
+    if not terms:
+        return [], ""
+    tier, before_id = decode_cursor(cursor, 2) if cursor else (0, None)
+    if tier not in (0, 1) or not isinstance(before_id, (int, type(None))):
+        raise InvalidCursor(cursor)
+
+    # 索引も商品と一緒に複製されるので、商品と同じくレプリカから読んでよい
+    db = connections[router.db_for_read(Item) or DEFAULT_DB_ALIAS]
+    backend = get_backend(db)
+    found = []
+    with db.cursor() as db_cursor:
+        for current_tier in range(tier, 2):
+            item_ids = backend.search(
+                db_cursor, terms, current_tier, before_id if current_tier == tier else None, per_page + 1 - len(found),
+            )
+            found.extend((current_tier, item_id) for item_id in item_ids)
+            if len(found) > per_page:
+                break
+
+    page = found[:per_page]
+    next_cursor = encode_cursor(list(page[-1])) if len(found) > per_page else ""
+    return [item_id for _, item_id in page], next_cursor
@@ -0,0 +1,70 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .caching import invalidate_on_commit
+from .carts import merge_cookie_cart
+from .images import schedule_derivatives
+from .models import Item, Stock, StockMovement
+from .search import index_items, remove_items
+
+
+# 管理画面などで商品が変わったら、商品詳細・商品カード・商品一覧のキャッシュを無効にする
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_item_cache(sender, instance, **kwargs):
+    invalidate_on_commit([instance.id], catalog=True)
+
+
+# 商品検索の索引を商品の保存・削除と同じトランザクションで更新する
+@receiver(post_save, sender=Item)
+def update_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_items([(instance.id, instance.name, instance.information)])
+
+
+@receiver(post_delete, sender=Item)
+def remove_from_search_index(sender, instance, **kwargs):
+    remove_items([instance.id])
+
+
+# 商品画像が登録・変更されたら、確定後に縮小画像を作る
+@receiver(post_save, sender=Item)
+def create_image_derivatives(sender, instance, **kwargs):
+    if instance.image and instance.image_variants.get("source") != instance.image.name:
+        transaction.on_commit(lambda: schedule_derivatives(instance))
+
+
+# 在庫が変わったら、その商品の詳細のキャッシュを無効にする
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+def invalidate_stock_cache(sender, instance, **kwargs):
+    invalidate_on_commit([instance.item_id])
+
+
+# 管理画面などで在庫を直接保存したときも、増減を履歴に記録する
+@receiver(pre_save, sender=Stock)
+def remember_previous_quantity(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        instance._previous_quantity = 0
+    else:
+        instance._previous_quantity = (
+            Stock.objects.filter(pk=instance.pk).values_list("quantity", flat=True).first() or 0
+        )
+
+
+@receiver(post_save, sender=Stock)
+def record_stock_movement(sender, instance, raw=False, **kwargs):
+    delta = instance.quantity - getattr(instance, "_previous_quantity", 0)
+    if raw or not delta:
+        return
+    kind = StockMovement.RECEIPT if delta > 0 else StockMovement.ADJUSTMENT
+    StockMovement.objects.create(item_id=instance.item_id, kind=kind, quantity=delta, note="在庫の直接更新")
+
+
+# ログインしたら、ログイン前にCookieのカートに入れた商品をユーザーのカートに移す
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    if request is not None:
+        merge_cookie_cart(request, user)
@@ -0,0 +1,48 @@
+from django.db import transaction
+from django.db.models import F, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .caching import invalidate_on_commit
+from .models import Stock, StockMovement
+
+
+# 在庫数を増減し、履歴に1行追加する。減らしすぎる場合は ValueError。
+def adjust_stock(item, delta, kind=StockMovement.ADJUSTMENT, note="", order=None):
+    with transaction.atomic():
+        stock, _ = Stock.objects.select_for_update().get_or_create(item=item, defaults={"quantity": 0})
+        if stock.quantity + delta < 0:
+            raise ValueError(f"在庫がマイナスになります: item={item.id}")
+        Stock.objects.filter(id=stock.id).update(quantity=F("quantity") + delta)
+        StockMovement.objects.create(item=item, kind=kind, quantity=delta, note=note, order=order)
+        invalidate_on_commit([item.id])
+    stock.refresh_from_db(fields=["quantity"])
+    return stock
+
+
+# 在庫数と履歴の合計が合わない商品を一回のクエリで探す。
+# 戻り値は [(item_id, 在庫数, 履歴の合計), ...]
+def find_discrepancies():
+    ledger = (
+        StockMovement.objects.filter(item_id=OuterRef("item_id"))
+        .order_by()
+        .values("item_id")
+        .annotate(total=Sum("quantity"))
+        .values("total")
+    )
+    return list(
+        Stock.objects.annotate(ledger=Coalesce(Subquery(ledger, output_field=IntegerField()), 0))
+        .exclude(quantity=F("ledger"))
+        .order_by("item_id")
+        .values_list("item_id", "quantity", "ledger")
+    )
+
+
+# 合わない商品について、在庫数に合わせる調整の行を履歴に追加する
+def reconcile(fix=False):
+    discrepancies = find_discrepancies()
+    if fix and discrepancies:
+        StockMovement.objects.bulk_create([
+            StockMovement(item_id=item_id, kind=StockMovement.ADJUSTMENT, quantity=quantity - ledger, note="棚卸し調整")
+            for item_id, quantity, ledger in discrepancies
+        ])
+    return discrepancies
@@ -0,0 +1,39 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+
+register = template.Library()
+
+
+def _srcset(names):
+    return ", ".join(
+        f"{default_storage.url(name)} {width}w"
+        for width, name in sorted(names.items(), key=lambda pair: int(pair[0]))
+    )
+
+
+# 商品画像を縮小版の srcset 付きで出力する。縮小版がまだなければ元画像を出す。
+# 縮小版は商品の保存時（または build_image_derivatives コマンド）に作るので、ここでは元画像を開かない。
+# 使い方: {% item_image item 200 %}
+@register.simple_tag
+def item_image(item, width=200):
+    if not item.image:
+        return ""
+
+    variants = item.image_variants or {}
+    if variants.get("source") != item.image.name:
+        return format_html(
+            '<img src="{}" alt="{}" width="{}" loading="lazy">', item.image.url, item.name, width
+        )
+
+    jpeg = variants["jpeg"]
+    # 表示する幅以上で一番小さいものを src にする
+    fallback_width = min((int(w) for w in jpeg if int(w) >= width), default=max(int(w) for w in jpeg))
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}" sizes="{}px">'
+        '<img src="{}" srcset="{}" sizes="{}px" alt="{}" width="{}" loading="lazy">'
+        '</picture>',
+        _srcset(variants["webp"]), width,
+        default_storage.url(jpeg[str(fallback_width)]), _srcset(jpeg), width, item.name, width,
+    )
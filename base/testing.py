@@ -0,0 +1,45 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+# base/urls.py の URL名ごとに、1リクエストで許すSQLの件数。
+# ログイン中のリクエストはセッションとユーザーの読み込みで2件使う。
+QUERY_BUDGETS = {
+    "register": 0,
+    "login": 0,
+    "logout": 4,
+    "index": 3,
+    "search": 3,
+    "item_detail": 4,
+    "cart": 3,
+    "add_to_cart": 9,
+    "flash_sale_ticket": 4,
+    "remove_from_cart": 6,
+    "cart_batch": 9,
+    "add_address": 2,
+    "checkout": 12,
+    "success": 4,
+    "order_history": 4,
+    "reorder": 10,
+    "stripe_webhook": 16,
+    "fake_stripe_checkout": 18,
+}
+
+
+# テストで、URL名ごとのSQLの件数の上限（QUERY_BUDGETS）を確かめるためのミックスイン。
+# QueryInstrumentationMiddleware が有効なら、N+1の疑いがあるときも失敗にする。
+class QueryBudgetMixin:
+    def assertQueryBudget(self, url_name, *args, method="get", data=None, budget=None, allow_n_plus_one=False, **extra):
+        budget = QUERY_BUDGETS[url_name] if budget is None else budget
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(reverse(url_name, args=args), data, **extra)
+
+        executed = len(context.captured_queries)
+        if executed > budget:
+            queries = "\n".join(f"{i}. {query['sql']}" for i, query in enumerate(context.captured_queries, start=1))
+            self.fail(f"{url_name}: {executed}件のSQLが実行されました（上限{budget}件）\n{queries}")
+
+        record = getattr(response.wsgi_request, "perf_record", None)
+        if record and record["n_plus_one"] and not allow_n_plus_one:
+            self.fail(f"{url_name}: N+1の疑いがあります {record['repeated_queries']}")
+        return response
@@ -1,3 +1,1745 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from datetime import datetime, timedelta
+from smtplib import SMTPException
+from unittest.mock import patch
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail import get_connection
+from django.core.signing import get_cookie_signer
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, connections, router, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F, QuerySet
+from django.template import Context, Template, engines
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (
+    User, Address, Item, Stock, StockMovement, StockReservation, Cart, Order, OrderItem, Payment, DailySales, ItemSales,
+    OutboxMessage, FlashSaleTicket,
+)
+from PIL import Image
+
+from . import routers
+from .admin import EstimatedCountPaginator
+from .analytics import roll_up
+from .benchmarks import compare_reports, percentile, run_contention, run_funnel, run_template_render, seed, template_timer
+from .catalog_io import import_items
+from .carts import CART_COOKIE_SALT
+from .checks import check_catalog_cache, check_rate_limit_cache
+from .caching import cache_stats, invalidate_on_commit, item_version_key, reset_cache_stats
+from .flash_sales import allocate_batch, enqueue, process_flash_sales
+from .images import executor, render_derivatives
+from .orders import commit_order, OutOfStockError
+from .pagination import encode_cursor
+from .outbox import claim_batch, retry_delay, send_pending
+from .payments import FakeStripeGateway
+from .pricing import backfill_tax_prices, price_cart, tax_included
+from .reservations import available_stock, reserve, sweep_expired
+from .routers import routing_state
+from .search import LikeSearchBackend, get_backend, search_item_ids
+from .stock import adjust_stock, reconcile
+from .throttling import client_ip, rejection_counts, take
+from .middleware import QueryRecorder, fingerprint
+from .testing import QUERY_BUDGETS, QueryBudgetMixin
+
+
+def make_user(username="taro"):
+    return User.objects.create_user(username=username, email=f"{username}@example.com")
+
+
+def make_address(user):
+    return Address.objects.create(user=user, post_code="100-0001", address="東京都千代田区", name="山田太郎", telephone_number="0312345678")
+
+
+def make_item(name="鹿肉セット", price=1000, stock=10):
+    item = Item.objects.create(name=name, price=price, is_published=True, information="説明")
+    Stock.objects.create(item=item, quantity=stock)
+    return item
+
+
+class CommitOrderTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.address = make_address(self.user)
+
+    def test_decrements_stock_and_creates_lines(self):
+        deer = make_item("鹿肉", stock=5)
+        boar = make_item("猪肉", stock=3)
+
+        order = commit_order(self.user, self.address, [(deer, 2, 2200), (boar, 3, 3300)])
+
+        self.assertEqual(order.total_price, 5500)
+        self.assertEqual(OrderItem.objects.filter(order=order).count(), 2)
+        self.assertEqual(Stock.objects.get(item=deer).quantity, 3)
+        self.assertEqual(Stock.objects.get(item=boar).quantity, 0)
+
+    def test_out_of_stock_writes_nothing(self):
+        deer = make_item("鹿肉", stock=5)
+        boar = make_item("猪肉", stock=1)
+
+        with self.assertRaises(OutOfStockError) as ctx:
+            commit_order(self.user, self.address, [(deer, 2, 2200), (boar, 2, 2200)])
+
+        self.assertEqual(ctx.exception.item_ids, [boar.id])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(Stock.objects.get(item=deer).quantity, 5)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        items = [make_item(f"商品{i}", stock=10) for i in range(8)]
+
+        with self.assertNumQueries(9):
+            commit_order(self.user, self.address, [(items[0], 1, 1100)])
+        with self.assertNumQueries(9):
+            commit_order(self.user, self.address, [(item, 1, 1100) for item in items])
+
+
+class ReservationTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.other = make_user("hanako")
+        self.item = make_item(stock=5)
+
+    def test_reserve_hides_stock_from_other_users(self):
+        reserve(self.user, {self.item.id: 3})
+
+        self.assertEqual(available_stock([self.item.id])[self.item.id], 2)
+        self.assertEqual(available_stock([self.item.id], exclude_user=self.user)[self.item.id], 5)
+        with self.assertRaises(OutOfStockError):
+            reserve(self.other, {self.item.id: 3})
+
+    def test_reserve_replaces_previous_holds(self):
+        reserve(self.user, {self.item.id: 3})
+        reserve(self.user, {self.item.id: 4})
+
+        self.assertEqual(StockReservation.objects.get(user=self.user).quantity, 4)
+
+    def test_commit_consumes_own_hold_and_respects_others(self):
+        reserve(self.other, {self.item.id: 4})
+        with self.assertRaises(OutOfStockError):
+            commit_order(self.user, make_address(self.user), [(self.item, 2, 2200)])
+
+        commit_order(self.other, make_address(self.other), [(self.item, 4, 4400)])
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(available_stock([self.item.id])[self.item.id], 1)
+
+    def test_available_stock_is_one_query(self):
+        items = [make_item(f"商品{i}") for i in range(5)]
+        with self.assertNumQueries(1):
+            available_stock([item.id for item in items])
+
+    def test_expired_holds_are_ignored_and_swept(self):
+        past = timezone.now() - timedelta(minutes=1)
+        StockReservation.objects.bulk_create([
+            StockReservation(item=self.item, user=self.other, quantity=1, expires_at=past) for _ in range(5)
+        ])
+        reserve(self.user, {self.item.id: 1})
+
+        self.assertEqual(available_stock([self.item.id])[self.item.id], 4)
+        self.assertEqual(sweep_expired(batch_size=2), 5)
+        self.assertEqual(StockReservation.objects.count(), 1)
+        call_command("sweep_reservations", stdout=StringIO())
+
+    def test_item_detail_shows_available_stock(self):
+        reserve(self.other, {self.item.id: 3})
+
+        response = self.client.get(reverse("item_detail", args=[self.item.id]))
+
+        self.assertEqual(response.context["stock"], 2)
+        self.assertEqual(list(response.context["stock_item_range"]), [1, 2])
+
+
+class PricingTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.client.force_login(self.user)
+
+    def fill_cart(self, count):
+        for i in range(count):
+            Cart.objects.create(user=self.user, item=make_item(f"商品{i}", price=1000 + i), quantity=2)
+
+    def test_tax_included_uses_integer_math(self):
+        self.assertEqual(tax_included(1000), 1100)
+        self.assertEqual(tax_included(999), 1098)
+        self.assertEqual(tax_included(999, Item.TAX_REDUCED), 1078)
+        self.assertEqual(make_item(price=999).price_with_tax, 1098)
+
+    def test_price_cart(self):
+        self.fill_cart(2)
+
+        with self.assertNumQueries(1):
+            priced = price_cart(self.user)
+
+        self.assertEqual([line.subtotal for line in priced], [2200, 2202])
+        self.assertEqual(priced.total_price, 4402)
+        self.assertEqual(priced.quantities(), {line.item.id: 2 for line in priced})
+        self.assertEqual(priced.stripe_line_items()[1]["price_data"]["unit_amount"], 1101)
+
+    def test_cart_and_checkout_queries_do_not_grow(self):
+        self.fill_cart(1)
+        with self.assertNumQueries(4) as small:
+            self.client.get(reverse("checkout"))
+        self.fill_cart(10)
+        with self.assertNumQueries(len(small.captured_queries)):
+            response = self.client.get(reverse("checkout"))
+        self.assertEqual(response.context["total_price"], price_cart(self.user).total_price)
+
+        with self.assertNumQueries(len(small.captured_queries) - 1):
+            self.client.get(reverse("cart"))
+
+
+@override_settings(PAYMENT_GATEWAY="base.payments.FakeStripeGateway")
+class CheckoutFlowTests(TestCase):
+    def setUp(self):
+        # レート制限のバケットはキャッシュにあるので、前のテストの分を残さない
+        cache.clear()
+        self.user = make_user()
+        self.address = make_address(self.user)
+        self.item = make_item(stock=5)
+        Cart.objects.create(user=self.user, item=self.item, quantity=2)
+        self.client.force_login(self.user)
+
+    def start_checkout(self):
+        response = self.client.post(reverse("checkout"), {"address_id": self.address.id})
+        self.assertEqual(response.status_code, 302)
+        return Payment.objects.get(user=self.user), response["Location"]
+
+    def post_event(self, event_type, payment):
+        session = {"id": payment.session_id, "payment_status": "paid", "payment_intent": "pi_test"}
+        return self.client.post(
+            reverse("stripe_webhook"),
+            json.dumps({"type": event_type, "data": {"object": session}}),
+            content_type="application/json",
+        )
+
+    def test_checkout_creates_pending_payment_with_snapshot(self):
+        payment, _ = self.start_checkout()
+
+        self.assertEqual(payment.status, Payment.STATUS_PENDING)
+        self.assertEqual(payment.total_price, 2200)
+        self.assertEqual(payment.cart_snapshot[0]["quantity"], 2)
+        self.assertFalse(Order.objects.exists())
+
+    def test_full_flow_finalizes_once(self):
+        payment, url = self.start_checkout()
+
+        response = self.client.get(url, follow=True)
+        self.assertEqual(response.context["order"], Order.objects.get())
+        self.client.get(reverse("success"), {"session_id": payment.session_id})
+        self.post_event("checkout.session.completed", payment)
+
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Stock.objects.get(item=self.item).quantity, 3)
+        self.assertFalse(Cart.objects.filter(user=self.user).exists())
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.STATUS_PAID)
+
+    def test_webhook_uses_snapshot_not_current_cart(self):
+        payment, _ = self.start_checkout()
+        Cart.objects.filter(user=self.user).update(quantity=4)
+
+        self.assertEqual(self.post_event("checkout.session.completed", payment).status_code, 200)
+
+        self.assertEqual(OrderItem.objects.get().quantity, 2)
+        response = self.client.get(reverse("success"), {"session_id": payment.session_id})
+        self.assertEqual(response.context["order"].total_price, 2200)
+
+    def test_expired_session_releases_hold(self):
+        payment, _ = self.start_checkout()
+        self.assertEqual(available_stock([self.item.id])[self.item.id], 3)
+
+        self.post_event("checkout.session.expired", payment)
+
+        self.assertEqual(available_stock([self.item.id])[self.item.id], 5)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.STATUS_EXPIRED)
+
+    def test_expired_old_session_keeps_the_newer_sessions_hold(self):
+        old, _ = self.start_checkout()
+        self.client.post(reverse("checkout"), {"address_id": self.address.id})
+        new = Payment.objects.filter(user=self.user).latest("id")
+        self.assertNotEqual(new, old)
+
+        self.post_event("checkout.session.expired", old)
+
+        old.refresh_from_db()
+        self.assertEqual(old.status, Payment.STATUS_EXPIRED)
+        self.assertEqual(available_stock([self.item.id])[self.item.id], 3)
+        # 新しいセッションが期限切れになれば解放する
+        self.post_event("checkout.session.expired", new)
+        self.assertEqual(available_stock([self.item.id])[self.item.id], 5)
+
+    def test_session_closes_before_the_hold_expires(self):
+        started = time.time()
+        payment, _ = self.start_checkout()
+
+        session = FakeStripeGateway.sessions[payment.session_id]
+        self.assertGreaterEqual(session["expires_at"] - started, 30 * 60 + 60)
+        hold = StockReservation.objects.get(user=self.user)
+        self.assertGreater(hold.expires_at.timestamp(), session["expires_at"] + settings.STOCK_RESERVATION_GRACE_SECONDS - 5)
+
+    def test_late_payment_without_stock_is_refunded_once(self):
+        payment, _ = self.start_checkout()
+        # 仮押さえが切れ、その間に在庫が売れてしまった
+        StockReservation.objects.filter(user=self.user).delete()
+        Stock.objects.filter(item=self.item).update(quantity=0)
+
+        with self.assertLogs("base.orders", "ERROR"):
+            self.post_event("checkout.session.completed", payment)
+            self.post_event("checkout.session.completed", payment)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.STATUS_REFUNDED)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(FakeStripeGateway.refunds[f"refund-{payment.session_id}"]["payment_intent"], "pi_test")
+        response = self.client.get(reverse("success"), {"session_id": payment.session_id})
+        self.assertRedirects(response, reverse("cart"), fetch_redirect_response=False)
+
+    async def test_async_checkout_view(self):
+        await self.async_client.aforce_login(self.user)
+
+        response = await self.async_client.post(reverse("checkout"), {"address_id": self.address.id})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(await Payment.objects.filter(user=self.user, session_id__isnull=False).aexists())
+
+    @override_settings(FAKE_STRIPE_LATENCY=0.2)
+    def test_gateway_calls_overlap(self):
+        request = RequestFactory().get("/checkout")
+        params = {
+            "line_items": [{"price_data": {"unit_amount": 1100}, "quantity": 1}],
+            "success_url": "/success/",
+            "cancel_url": "/checkout/",
+        }
+
+        async def create_many():
+            gateway = FakeStripeGateway()
+            return await asyncio.gather(*[gateway.acreate_checkout_session(request, **params) for _ in range(20)])
+
+        started = time.monotonic()
+        sessions = asyncio.run(create_many())
+
+        self.assertEqual(len({session.id for session in sessions}), 20)
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_invalid_webhook_payload(self):
+        response = self.client.post(reverse("stripe_webhook"), "not json", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CATALOG_PAGE_SIZE=3)
+class CatalogPaginationTests(TestCase):
+    def setUp(self):
+        self.items = [make_item(f"商品{i}", price=(i * 7) % 10 * 100) for i in range(8)]
+        Item.objects.create(name="非公開", price=1, information="説明")
+
+    def walk(self, sort):
+        seen, cursor = [], None
+        while True:
+            params = {"sort": sort, **({"cursor": cursor} if cursor else {})}
+            response = self.client.get(reverse("index"), params)
+            page = response.context["page"]
+            seen += [item.id for item in page]
+            if not page.has_next:
+                return seen
+            cursor = page.next_cursor
+
+    def test_walks_every_published_item_once(self):
+        seen = self.walk("new")
+
+        self.assertEqual(seen, [item.id for item in reversed(self.items)])
+
+    def test_sort_by_price(self):
+        seen = self.walk("price_asc")
+
+        prices = list(Item.objects.filter(id__in=seen).values_list("id", "price"))
+        self.assertEqual(seen, [item_id for item_id, _ in sorted(prices, key=lambda row: (row[1], row[0]))])
+
+    def test_page_is_a_single_query(self):
+        first = self.client.get(reverse("index")).context["page"]
+        with self.assertNumQueries(1):
+            self.client.get(reverse("index"), {"cursor": first.next_cursor})
+
+    def test_invalid_cursor_redirects_to_first_page(self):
+        response = self.client.get(reverse("index"), {"cursor": "!!broken"})
+
+        self.assertRedirects(response, reverse("index") + "?sort=new")
+
+    def test_cursor_with_wrong_types_redirects_to_first_page(self):
+        for sort in ("new", "price_asc", "price_desc"):
+            # [1, 2] は価格の並びでは正しいカーソル
+            broken = [["abc", "def"], [1, "x"], [None, 1], [2 ** 70, 1]] + ([[1, 2]] if sort == "new" else [])
+            for values in broken:
+                response = self.client.get(reverse("index"), {"sort": sort, "cursor": encode_cursor(values)})
+                self.assertEqual(response.status_code, 302, (sort, values))
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        self.item = make_item(stock=5)
+        reset_cache_stats()
+
+    def test_item_detail_is_served_from_cache(self):
+        self.client.get(reverse("item_detail", args=[self.item.id]))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("item_detail", args=[self.item.id]))
+        self.assertEqual(response.context["stock"], 5)
+        self.assertEqual(cache_stats(), {"hits": 1, "misses": 1})
+
+    def test_stock_and_reservation_changes_invalidate_detail(self):
+        url = reverse("item_detail", args=[self.item.id])
+        self.client.get(url)
+
+        stock = Stock.objects.get(item=self.item)
+        stock.quantity = 8
+        stock.save()
+        self.assertEqual(self.client.get(url).context["stock"], 8)
+
+        reserve(make_user(), {self.item.id: 3})
+        self.assertEqual(self.client.get(url).context["stock"], 5)
+
+    def test_catalog_is_served_from_cache_until_an_item_changes(self):
+        self.client.get(reverse("index"))
+        with self.assertNumQueries(0):
+            self.client.get(reverse("index"))
+
+        self.item.name = "猪肉"
+        self.item.save()
+
+        self.assertContains(self.client.get(reverse("index")), "猪肉")
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as location:
+            backend = {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location}
+            with self.settings(CACHES={"default": backend}):
+                self.client.get(reverse("item_detail", args=[self.item.id]))
+                with self.assertNumQueries(0):
+                    self.client.get(reverse("item_detail", args=[self.item.id]))
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = make_item(stock=5)
+
+    def test_item_detail_returns_304_until_stock_changes(self):
+        url = reverse("item_detail", args=[self.item.id])
+        first = self.client.get(url)
+        self.assertTrue(first.has_header("Last-Modified"))
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 304)
+
+        stock = Stock.objects.get(item=self.item)
+        stock.quantity = 1
+        stock.save()
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.context["stock"], 1)
+
+    def test_index_returns_304_until_catalog_changes(self):
+        first = self.client.get(reverse("index"))
+
+        self.assertEqual(self.client.get(reverse("index"), HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 304)
+        self.assertEqual(
+            self.client.get(reverse("index"), HTTP_IF_MODIFIED_SINCE=first["Last-Modified"]).status_code, 304
+        )
+
+        make_item("新商品")
+        self.assertEqual(self.client.get(reverse("index"), HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 200)
+
+    def test_etag_varies_by_user(self):
+        url = reverse("item_detail", args=[self.item.id])
+        anonymous = self.client.get(url)["ETag"]
+        self.client.force_login(make_user())
+
+        self.assertNotEqual(self.client.get(url)["ETag"], anonymous)
+
+    def test_etag_changes_when_csrf_secret_rotates(self):
+        url = reverse("item_detail", args=[self.item.id])
+        first = self.client.get(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 304)
+
+        user = make_user()
+        user.set_password("pass-12345")
+        user.save()
+        # ログインの画面から入ると、CSRFのシークレットが作り直される
+        self.client.post(reverse("login"), {"username": user.username, "password": "pass-12345"})
+        self.client.post(reverse("logout"))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_follows_the_database_not_the_cache_version(self):
+        url = reverse("item_detail", args=[self.item.id])
+        first = self.client.get(url)
+        # 別のプロセス（管理コマンドなど）が在庫を変え、このプロセスのバージョンは上がらないまま、
+        # キャッシュした詳細データだけが期限切れになった
+        Stock.objects.filter(item=self.item).update(quantity=2, updated_at=timezone.now())
+        version = cache.get(item_version_key(self.item.id))
+        cache.delete(f"catalog:item:{self.item.id}:{version}:detail")
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "残り約2個")
+
+    def test_updated_at_is_a_timestamp(self):
+        self.assertIsInstance(self.item.updated_at, datetime)
+
+
+def make_png(width=1000, height=600):
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), "brown").save(buffer, "PNG")
+    return SimpleUploadedFile("deer.png", buffer.getvalue(), content_type="image/png")
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = self.settings(
+            MEDIA_ROOT=media.name, IMAGE_DERIVATIVE_WIDTHS=[200, 400], IMAGE_DERIVATIVES_ASYNC=False
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_render_derivatives_never_upscales(self):
+        results = render_derivatives(make_png(300, 100).read(), [200, 400, 800], 80)
+
+        sizes = {(width, fmt): Image.open(BytesIO(data)).size for width, fmt, data in results}
+        self.assertEqual(sizes[(200, "webp")], (200, 67))
+        # 元画像より広い幅は、元画像の幅で一つだけ作る
+        self.assertEqual(sizes[(300, "jpeg")], (300, 100))
+        self.assertEqual(sorted({width for width, _, _ in results}), [200, 300])
+
+    def test_saving_an_image_creates_hashed_variants(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            item = Item.objects.create(name="鹿肉", price=1000, information="説明", image=make_png())
+        item.refresh_from_db()
+
+        self.assertEqual(item.image_variants["source"], item.image.name)
+        self.assertEqual(set(item.image_variants["webp"]), {"200", "400"})
+        self.assertRegex(item.image_variants["webp"]["200"], r"^images/derivatives/deer\.200w\.[0-9a-f]{12}\.webp$")
+
+        html = Template("{% load image_tags %}{% item_image item 200 %}").render(Context({"item": item}))
+        self.assertIn('type="image/webp"', html)
+        self.assertIn("200w", html)
+        self.assertIn("400w", html)
+
+    def test_tag_does_not_generate_variants_while_rendering(self):
+        item = Item.objects.create(name="鹿肉", price=1000, information="説明", image=make_png())
+        Item.objects.filter(id=item.id).update(image_variants={})
+        item.refresh_from_db()
+
+        with patch("base.images.render_derivatives") as render:
+            html = Template("{% load image_tags %}{% item_image item 200 %}").render(Context({"item": item}))
+        render.assert_not_called()
+        self.assertNotIn("srcset", html)
+
+        out = StringIO()
+        call_command("build_image_derivatives", stdout=out)
+        self.assertIn("1件", out.getvalue())
+        item.refresh_from_db()
+        self.assertEqual(item.image_variants["source"], item.image.name)
+
+
+class QueryInstrumentationTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.address = make_address(self.user)
+        self.items = [make_item(f"商品{i}") for i in range(5)]
+        for item in self.items:
+            Cart.objects.create(user=self.user, item=item, quantity=1)
+        self.client.force_login(self.user)
+
+    def test_every_url_has_a_budget(self):
+        from .urls import urlpatterns
+
+        self.assertEqual({pattern.name for pattern in urlpatterns}, set(QUERY_BUDGETS))
+
+    def test_storefront_views_stay_within_budget(self):
+        self.assertQueryBudget("index")
+        self.assertQueryBudget("item_detail", self.items[0].id)
+        self.assertQueryBudget("cart")
+        self.assertQueryBudget("checkout")
+        self.assertQueryBudget("add_to_cart", self.items[0].id, method="post", data={"quantity": 1})
+
+    def test_records_are_logged_as_json(self):
+        with self.assertLogs("base.perf", "INFO") as logs:
+            self.client.get(reverse("cart"))
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["view"], "cart")
+        self.assertEqual(record["status"], 200)
+        self.assertGreater(record["queries"], 0)
+        self.assertFalse(record["n_plus_one"])
+
+    async def test_async_requests_stay_async_and_are_recorded(self):
+        from django.core.handlers.asgi import ASGIHandler
+
+        handler = ASGIHandler()
+        self.assertTrue(asyncio.iscoroutinefunction(handler._middleware_chain))
+        await self.async_client.aforce_login(self.user)
+        with self.assertLogs("base.perf", "INFO") as logs:
+            response = await self.async_client.get(reverse("cart"))
+
+        self.assertEqual(response.status_code, 200)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["view"], "cart")
+        self.assertGreater(record["queries"], 0)
+
+    def test_repeated_queries_are_flagged(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for item in self.items:
+                Stock.objects.filter(item=item).first()
+            list(Stock.objects.filter(item_id__in=[1, 2, 3]))
+
+        self.assertEqual(recorder.repeated(3)[0]["count"], 5)
+        self.assertEqual(fingerprint('WHERE "id" IN (%s, %s, %s)'), 'WHERE "id" IN (...)')
+
+
+class FunnelBenchmarkTests(TestCase):
+    def test_seed_and_run_funnel(self):
+        users, items = seed(items=5, users=2, cart_lines=2)
+        self.assertEqual(Cart.objects.filter(user__in=users).count(), 4)
+        cache.clear()
+        cache.set("shared", 1)
+
+        with override_settings(DATABASE_REPLICAS=["replica1"]):
+            report = run_funnel(users, items, new_shoppers=1)
+
+        # 本番のキャッシュには触らず、レプリカ（テストDBを持たない）も読まない
+        self.assertEqual(list(cache._cache), [cache.make_key("shared")])
+
+        self.assertEqual(report["views"]["success"]["requests"], 3)
+        self.assertEqual(sum(view["errors"] for view in report["views"].values()), 0)
+        self.assertEqual(Order.objects.count(), 3)
+        for key in ("p50_ms", "p95_ms", "p99_ms", "mean_queries", "throughput_rps"):
+            self.assertIn(key, report["views"]["index"])
+
+    def test_percentile_and_compare(self):
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+        baseline = {"views": {"index": {"p95_ms": 10.0, "mean_queries": 2}}}
+        current = {"views": {"index": {"p95_ms": 15.0, "mean_queries": 3}}}
+
+        self.assertEqual(len(compare_reports(baseline, current, tolerance=0.2)), 2)
+        self.assertEqual(compare_reports(baseline, baseline), [])
+
+
+class StockLedgerTests(TestCase):
+    def setUp(self):
+        self.item = make_item(stock=10)
+
+    def ledger_total(self):
+        return sum(StockMovement.objects.filter(item=self.item).values_list("quantity", flat=True))
+
+    def test_one_stock_row_per_item(self):
+        with self.assertRaises(IntegrityError):
+            Stock.objects.create(item=self.item, quantity=1)
+
+    def test_get_stock_uses_the_joined_row(self):
+        item = Item.objects.select_related("stock").get(id=self.item.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(item.get_stock(), 10)
+        self.assertEqual(Item(name="在庫なし").get_stock(), 0)
+
+    def test_every_change_is_in_the_ledger(self):
+        user = make_user()
+        order = commit_order(user, make_address(user), [(self.item, 3, 3300)])
+        adjust_stock(self.item, 5, StockMovement.RECEIPT, note="入荷")
+        stock = Stock.objects.get(item=self.item)
+        stock.quantity = 2
+        stock.save()
+
+        kinds = list(StockMovement.objects.filter(item=self.item).order_by("id").values_list("kind", "quantity"))
+        self.assertEqual(kinds, [("receipt", 10), ("sale", -3), ("receipt", 5), ("adjustment", -10)])
+        self.assertEqual(StockMovement.objects.get(kind="sale").order, order)
+        self.assertEqual(self.ledger_total(), 2)
+        self.assertEqual(reconcile(), [])
+
+    def test_ledger_is_append_only(self):
+        movement = StockMovement.objects.get(item=self.item)
+        with self.assertRaises(ValueError):
+            movement.save()
+
+    def test_reconcile_reports_and_fixes(self):
+        Stock.objects.filter(item=self.item).update(quantity=7)
+        out = StringIO()
+        call_command("reconcile_stock", stdout=out)
+        self.assertIn("差 -3", out.getvalue())
+
+        self.assertEqual(reconcile(fix=True), [(self.item.id, 7, 10)])
+        self.assertEqual(reconcile(), [])
+        self.assertEqual(self.ledger_total(), 7)
+
+
+class StockMigrationTests(TransactionTestCase):
+    def test_duplicate_rows_are_merged(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate([("base", "0008_item_image_variants")])
+        apps = executor.loader.project_state([("base", "0008_item_image_variants")]).apps
+        OldItem, OldStock = apps.get_model("base", "Item"), apps.get_model("base", "Stock")
+        item = OldItem.objects.create(name="鹿肉", price=1000, information="説明")
+        OldStock.objects.create(item=item, quantity=3)
+        OldStock.objects.create(item=item, quantity=4)
+
+        executor = MigrationExecutor(connection)
+        executor.migrate([("base", "0009_stock_counter_and_ledger")])
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+        self.assertEqual(Stock.objects.get(item_id=item.id).quantity, 7)
+        self.assertEqual(StockMovement.objects.get(item_id=item.id).quantity, 7)
+
+
+class AdminChangelistTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "pass")
+        self.client.force_login(self.admin)
+
+    def changelist_queries(self, url_name, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(url_name), params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(context.captured_queries)
+
+    def add_orders(self, count):
+        for i in range(count):
+            user = make_user(f"buyer{Order.objects.count()}_{i}")
+            item = make_item(f"商品{user.id}", stock=5)
+            commit_order(user, make_address(user), [(item, 1, 1100)])
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        for url_name in ("admin:base_item_changelist", "admin:base_order_changelist",
+                         "admin:base_orderitem_changelist", "admin:base_stockmovement_changelist"):
+            self.add_orders(2)
+            _, few = self.changelist_queries(url_name)
+            self.add_orders(5)
+            _, many = self.changelist_queries(url_name)
+            self.assertEqual(few, many, url_name)
+
+    def test_item_changelist_sorts_by_stock_in_sql(self):
+        make_item("少ない", stock=1)
+        make_item("多い", stock=50)
+        Item.objects.create(name="在庫なし", price=100, is_published=True, information="説明")
+
+        response, _ = self.changelist_queries("admin:base_item_changelist", o="-3")
+        names = [item.name for item in response.context["cl"].result_list]
+        self.assertEqual(names, ["多い", "少ない", "在庫なし"])
+        self.assertEqual(response.context["cl"].result_list[2].stock_quantity, 0)
+
+    def test_paginator_caps_filtered_counts_and_estimates_large_tables(self):
+        self.add_orders(3)
+        with patch.object(EstimatedCountPaginator, "COUNT_LIMIT", 2):
+            filtered = EstimatedCountPaginator(Order.objects.filter(created_at__lte=timezone.now()).order_by("id"), 1)
+            self.assertEqual(filtered.count, 2)
+            unfiltered = EstimatedCountPaginator(Order.objects.order_by("id"), 1)
+            self.assertEqual(unfiltered.count, Order.objects.order_by("-id").first().id)
+
+    def test_stock_movements_are_read_only(self):
+        movement = StockMovement.objects.get(item=make_item())
+        response = self.client.post(reverse("admin:base_stockmovement_delete", args=[movement.id]), {"post": "yes"})
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(StockMovement.objects.filter(id=movement.id).exists())
+
+
+class CatalogImportExportTests(TestCase):
+    def write(self, suffix, text):
+        file = tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False, encoding="utf-8")
+        file.write(text)
+        file.close()
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    def import_file(self, kind, text, suffix=".csv", **options):
+        out, err = StringIO(), StringIO()
+        call_command("import_catalog", kind, self.write(suffix, text), stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_items_are_upserted_by_sku(self):
+        existing = make_item("旧名")
+        existing.sku = "DEER-1"
+        existing.save()
+
+        self.import_file("items", (
+            "sku,name,price,is_published,information\n"
+            "DEER-1,鹿ロース,3000,true,説明\n"
+            "BOAR-1,猪バラ,2000,0,\n"
+            ",名無し,100,1,\n"
+            "BEAR-1,熊,abc,1,\n"
+        ), batch_size=2)
+
+        existing.refresh_from_db()
+        self.assertEqual((existing.name, existing.price), ("鹿ロース", 3000))
+        self.assertFalse(Item.objects.get(sku="BOAR-1").is_published)
+        self.assertEqual(Item.objects.count(), 2)
+
+    def test_errors_are_reported_with_line_numbers(self):
+        _, err = self.import_file("items", "sku,name,price,is_published,information\nX,商品,-1,1,\n")
+        self.assertIn("2行目", err)
+        self.assertFalse(Item.objects.exists())
+
+    def test_stock_import_records_ledger_and_invalidates_cache(self):
+        deer = Item.objects.create(sku="DEER-1", name="鹿", price=100, is_published=True, information="")
+        boar = make_item("猪", stock=10)
+        boar.sku = "BOAR-1"
+        boar.save()
+        self.client.get(reverse("item_detail", args=[boar.id]))
+
+        self.import_file("stock", '{"sku": "DEER-1", "quantity": 5}\n{"sku": "BOAR-1", "quantity": 4}\n{"sku": "NONE", "quantity": 1}\n', ".jsonl")
+
+        self.assertEqual(Stock.objects.get(item=deer).quantity, 5)
+        self.assertEqual(Stock.objects.get(item=boar).quantity, 4)
+        self.assertEqual(StockMovement.objects.get(item=deer).kind, StockMovement.RECEIPT)
+        self.assertEqual(StockMovement.objects.filter(item=boar).order_by("-id").first().quantity, -6)
+        self.assertEqual(reconcile(), [])
+        self.assertEqual(self.client.get(reverse("item_detail", args=[boar.id])).context["stock"], 4)
+
+    def test_queries_per_batch_do_not_grow_with_rows(self):
+        def queries(count):
+            rows = ((i, {"sku": f"S{count}-{i}", "name": "商品", "price": "100", "is_published": "1"}) for i in range(count))
+            with CaptureQueriesContext(connection) as context:
+                import_items(rows, batch_size=count)
+            return len(context.captured_queries)
+
+        self.assertEqual(queries(5), queries(50))
+
+    def test_export_round_trips(self):
+        for i in range(3):
+            Item.objects.create(sku=f"S{i}", name=f"商品{i}", price=100 * i, is_published=True, information="説明")
+        adjust_stock(Item.objects.get(sku="S1"), 7, kind=StockMovement.RECEIPT)
+
+        for suffix in (".csv", ".jsonl"):
+            items_path = self.write(suffix, "")
+            stock_path = self.write(suffix, "")
+            call_command("export_catalog", "items", items_path, stderr=StringIO())
+            call_command("export_catalog", "stock", stock_path, stderr=StringIO())
+            Item.objects.update(name="変更")
+            Stock.objects.update(quantity=0)
+
+            call_command("import_catalog", "items", items_path, stdout=StringIO())
+            call_command("import_catalog", "stock", stock_path, stdout=StringIO())
+            self.assertEqual(Item.objects.get(sku="S2").name, "商品2")
+            self.assertEqual(Stock.objects.get(item__sku="S1").quantity, 7)
+
+
+class OrderHistoryTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.address = make_address(self.user)
+        self.client.force_login(self.user)
+
+    def place_orders(self, count, lines=3):
+        items = [make_item(f"商品{Item.objects.count()}_{i}", stock=100) for i in range(lines)]
+        return [commit_order(self.user, self.address, [(item, 1, 1100) for item in items]) for _ in range(count)]
+
+    def test_commit_stores_summary(self):
+        order = self.place_orders(1)[0]
+        order.refresh_from_db()
+        self.assertEqual(order.line_count, 3)
+        self.assertEqual(order.item_names, [line.item.name for line in order.orderitem_set.order_by("id")])
+
+    @override_settings(ORDER_HISTORY_PAGE_SIZE=2)
+    def test_history_is_paginated_newest_first(self):
+        orders = self.place_orders(5)
+        other = make_user("jiro")
+        commit_order(other, make_address(other), [(make_item("他人の商品"), 1, 1100)])
+
+        seen = []
+        url = reverse("order_history")
+        while url:
+            response = self.client.get(url)
+            page = response.context["page"]
+            seen.extend(order.id for order in page)
+            url = f"{reverse('order_history')}?cursor={page.next_cursor}" if page.has_next else None
+        self.assertEqual(seen, [order.id for order in reversed(orders)])
+
+    @override_settings(ORDER_HISTORY_PAGE_SIZE=5)
+    def test_history_queries_do_not_grow_with_orders_or_lines(self):
+        self.place_orders(2, lines=1)
+        self.assertQueryBudget("order_history")
+        self.place_orders(10, lines=4)
+        self.assertQueryBudget("order_history")
+        self.assertContains(self.client.get(reverse("order_history")), "ほか3点")
+
+    def test_invalid_cursor_redirects_to_first_page(self):
+        response = self.client.get(reverse("order_history"), {"cursor": "!!"})
+        self.assertRedirects(response, reverse("order_history"))
+
+    def test_cursor_with_wrong_types_redirects_to_first_page(self):
+        for values in (["abc", "def"], [1, 2], ["2026-01-01T00:00:00+00:00", "x"]):
+            response = self.client.get(reverse("order_history"), {"cursor": encode_cursor(values)})
+            self.assertRedirects(response, reverse("order_history"))
+
+    def test_success_page_reads_lines_in_bulk(self):
+        order = self.place_orders(1, lines=5)[0]
+        Payment.objects.create(user=self.user, address=self.address, session_id="cs_done", order=order,
+                               status=Payment.STATUS_PAID, total_price=order.total_price)
+        self.assertQueryBudget("success", data={"session_id": "cs_done"})
+
+
+@override_settings(SALES_ROLLUP_LAG_SECONDS=0)
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.address = make_address(self.user)
+        self.deer = make_item("鹿肉", stock=100)
+        self.boar = make_item("猪肉", stock=100)
+
+    def order(self, *lines, days_ago=0):
+        order = commit_order(self.user, self.address, list(lines))
+        if days_ago:
+            Order.objects.filter(id=order.id).update(created_at=timezone.now() - timedelta(days=days_ago))
+        return order
+
+    def test_rolls_up_daily_and_item_totals(self):
+        self.order((self.deer, 2, 2200), (self.boar, 1, 1100))
+        self.order((self.deer, 1, 1100), days_ago=1)
+        self.order((self.deer, 3, 3300))
+
+        self.assertEqual(roll_up(batch_size=2), 3)
+
+        today = DailySales.objects.get(date=timezone.localdate())
+        self.assertEqual((today.orders, today.units, today.revenue), (2, 6, 6600))
+        self.assertEqual(DailySales.objects.get(date=timezone.localdate() - timedelta(days=1)).revenue, 1100)
+        deer_today = ItemSales.objects.get(item=self.deer, date=timezone.localdate())
+        self.assertEqual((deer_today.units, deer_today.revenue), (5, 5500))
+
+    def test_rerun_only_adds_new_orders(self):
+        self.order((self.deer, 1, 1100))
+        roll_up()
+        self.assertEqual(roll_up(), 0)
+        self.order((self.deer, 1, 1100))
+        self.assertEqual(roll_up(), 1)
+
+        self.assertEqual(DailySales.objects.get().orders, 2)
+        self.assertEqual(ItemSales.objects.get().units, 2)
+
+    @override_settings(SALES_ROLLUP_LAG_SECONDS=300)
+    def test_recent_orders_wait_for_the_next_run(self):
+        self.order((self.deer, 1, 1100), days_ago=1)
+        self.order((self.boar, 1, 1100))
+
+        self.assertEqual(roll_up(), 1)
+        self.assertEqual(roll_up(now=timezone.now() + timedelta(minutes=10)), 1)
+        self.assertEqual(DailySales.objects.count(), 2)
+
+    def test_dashboard_reads_only_rollups(self):
+        self.order((self.deer, 2, 2200))
+        call_command("rollup_sales", stdout=StringIO())
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "pass"))
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("admin:base_dailysales_changelist"))
+
+        self.assertContains(response, "鹿肉")
+        self.assertContains(response, "2200円")
+        self.assertFalse([q for q in context.captured_queries if '"base_order' in q["sql"]])
+
+
+class AnonymousCartTests(TestCase):
+    def setUp(self):
+        self.deer = make_item("鹿肉", stock=10)
+        self.boar = make_item("猪肉", stock=10)
+
+    def add(self, item, quantity=1):
+        return self.client.post(reverse("add_to_cart", args=[item.id]), {"quantity": quantity})
+
+    def test_anonymous_cart_does_not_write_to_the_database(self):
+        with CaptureQueriesContext(connection) as context:
+            self.add(self.deer, 2)
+            self.add(self.deer, 1)
+            self.add(self.boar)
+        writes = [q["sql"] for q in context.captured_queries if not q["sql"].startswith("SELECT")]
+        self.assertEqual(writes, [])
+        self.assertFalse(Cart.objects.exists())
+
+        response = self.client.get(reverse("cart"))
+        self.assertEqual([(line.item.name, line.quantity) for line in response.context["cart"]], [("鹿肉", 3), ("猪肉", 1)])
+        self.assertEqual(response.context["total_price"], 4400)
+
+        self.client.get(reverse("remove_from_cart", args=[self.deer.id]))
+        self.assertEqual(len(self.client.get(reverse("cart")).context["cart"]), 1)
+
+    def test_quantity_outside_the_per_add_limit_is_rejected(self):
+        bad = (-3, 0, "abc", "", settings.MAX_QUANTITY_PER_ADD + 1, 1000)
+        for quantity in bad:
+            response = self.add(self.deer, quantity)
+            self.assertRedirects(response, reverse("item_detail", args=[self.deer.id]), fetch_redirect_response=False)
+            self.assertNotIn("cart", response.cookies)
+
+        self.client.force_login(make_user())
+        for quantity in bad:
+            response = self.add(self.deer, quantity)
+            self.assertRedirects(response, reverse("item_detail", args=[self.deer.id]), fetch_redirect_response=False)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_stock_is_checked_for_anonymous_carts(self):
+        self.add(self.deer, 8)
+        response = self.add(self.deer, 3)
+        self.assertRedirects(response, reverse("item_detail", args=[self.deer.id]), fetch_redirect_response=False)
+        self.assertEqual(self.client.get(reverse("cart")).context["cart"].quantities(), {self.deer.id: 8})
+
+    def test_tampered_cookie_is_ignored(self):
+        self.add(self.deer)
+        self.client.cookies["cart"] = self.client.cookies["cart"].value[:-2] + "xx"
+        self.assertFalse(self.client.get(reverse("cart")).context["cart"])
+
+    @override_settings(CART_COOKIE_MAX_LINES=1)
+    def test_number_of_lines_is_capped(self):
+        self.add(self.deer)
+        self.add(self.boar)
+        self.assertEqual(self.client.get(reverse("cart")).context["cart"].quantities(), {self.deer.id: 1})
+
+    def test_login_merges_cookie_cart_in_one_upsert(self):
+        user = User.objects.create_user("taro", "taro@example.com", "pass-12345")
+        Cart.objects.create(user=user, item=self.deer, quantity=2)
+        self.add(self.deer, 1)
+        self.add(self.boar, 4)
+        gone = make_item("削除された商品")
+        self.add(gone)
+        gone.delete()
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse("login"), {"username": "taro", "password": "pass-12345"})
+        upserts = [q["sql"] for q in context.captured_queries if q["sql"].startswith('INSERT INTO "base_cart"')]
+
+        self.assertEqual(len(upserts), 1)
+        self.assertEqual(response.cookies["cart"].value, "")
+        self.assertEqual(dict(Cart.objects.filter(user=user).values_list("item_id", "quantity")), {self.deer.id: 3, self.boar.id: 4})
+
+
+class CartBatchTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.items = [make_item(f"商品{i}", price=1000, stock=5) for i in range(10)]
+        self.client.force_login(self.user)
+
+    def post(self, lines, replace=False):
+        return self.client.post(
+            reverse("cart_batch"), json.dumps({"lines": lines, "replace": replace}), content_type="application/json",
+        )
+
+    def test_adds_many_lines_and_returns_priced_cart(self):
+        Cart.objects.create(user=self.user, item=self.items[0], quantity=1)
+
+        response = self.post([{"item_id": item.id, "quantity": 2} for item in self.items])
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(len(body["lines"]), 10)
+        self.assertEqual(body["lines"][0]["quantity"], 3)
+        self.assertEqual(body["total_price"], 1100 * 21)
+
+    def test_queries_do_not_grow_with_lines(self):
+        self.assertQueryBudget("cart_batch", method="post", content_type="application/json",
+                               data=json.dumps({"lines": [{"item_id": self.items[0].id, "quantity": 1}]}))
+        self.assertQueryBudget("cart_batch", method="post", content_type="application/json",
+                               data=json.dumps({"lines": [{"item_id": item.id, "quantity": 1} for item in self.items]}))
+
+    def test_out_of_stock_changes_nothing(self):
+        response = self.post([{"item_id": self.items[0].id, "quantity": 1}, {"item_id": self.items[1].id, "quantity": 6}])
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["item_ids"], [self.items[1].id])
+        self.assertFalse(Cart.objects.exists())
+
+    def test_replace_sets_and_removes(self):
+        self.post([{"item_id": self.items[0].id, "quantity": 2}, {"item_id": self.items[1].id, "quantity": 2}])
+
+        response = self.post([{"item_id": self.items[0].id, "quantity": 4}, {"item_id": self.items[1].id, "quantity": 0}], replace=True)
+
+        self.assertEqual([(line["item_id"], line["quantity"]) for line in response.json()["lines"]], [(self.items[0].id, 4)])
+
+    def test_invalid_payload_is_rejected(self):
+        for body in ("not json", json.dumps({"lines": []}), json.dumps({"lines": [{"item_id": 1, "quantity": -1}]})):
+            response = self.client.post(reverse("cart_batch"), body, content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+
+    def test_anonymous_batch_uses_cookie_cart(self):
+        self.client.logout()
+        response = self.post([{"item_id": self.items[0].id, "quantity": 2}])
+        self.assertEqual(response.json()["total_price"], 2200)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_reorder_fills_cart_from_order(self):
+        deer, boar = make_item("鹿肉", stock=10), make_item("猪肉", stock=10)
+        order = commit_order(self.user, make_address(self.user), [(deer, 2, 2200), (boar, 4, 4400)])
+
+        self.assertQueryBudget("reorder", order.id, method="post")
+
+        self.assertEqual(dict(Cart.objects.filter(user=self.user).values_list("item_id", "quantity")), {deer.id: 2, boar.id: 4})
+
+    def test_reorder_skips_items_out_of_stock(self):
+        order = commit_order(self.user, make_address(self.user), [(self.items[0], 1, 1100), (self.items[1], 5, 5500)])
+        response = self.client.post(reverse("reorder", args=[order.id]))
+
+        self.assertRedirects(response, reverse("cart"), fetch_redirect_response=False)
+        self.assertEqual(list(Cart.objects.values_list("item_id", flat=True)), [self.items[0].id])
+
+
+class SearchTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.loin = make_item("鹿肉ロースブロック")
+        self.boar = Item.objects.create(name="猪肉スライス", price=100, is_published=True, information="鹿肉ではありません")
+        self.hidden = Item.objects.create(name="鹿肉の試作品", price=100, is_published=False, information="")
+
+    def ids(self, query, **kwargs):
+        return search_item_ids(query, **kwargs)[0]
+
+    def test_japanese_substrings_are_found_and_name_matches_rank_first(self):
+        newer = Item.objects.create(name="猪肉ロース", price=100, is_published=True, information="鹿肉と同じ産地")
+        self.assertEqual(self.ids("鹿肉"), [self.loin.id, newer.id, self.boar.id])
+        self.assertEqual(self.ids("ロース"), [newer.id, self.loin.id])
+        self.assertEqual(self.ids("ｽﾗｲｽ"), [self.boar.id])
+        self.assertEqual(self.ids("猪"), [newer.id, self.boar.id])
+        self.assertEqual(self.ids("鹿肉 スライス"), [self.boar.id])
+        self.assertEqual(self.ids("熊肉"), [])
+        self.assertEqual(self.ids("  "), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.loin.name = "熊肉ロース"
+        self.loin.save()
+        self.assertEqual(self.ids("熊肉"), [self.loin.id])
+        self.assertEqual(self.ids("鹿肉"), [self.boar.id])
+
+        self.boar.delete()
+        self.assertEqual(self.ids("鹿肉"), [])
+
+    def test_imported_items_are_indexed(self):
+        import_items([(2, {"sku": "BEAR-1", "name": "熊肉カレー", "price": "800", "is_published": "1"})])
+        self.assertEqual(self.ids("カレー"), [Item.objects.get(sku="BEAR-1").id])
+
+    def test_rebuild_command_restores_the_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM base_item_fts")
+        self.assertEqual(self.ids("鹿肉"), [])
+
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.ids("鹿肉"), [self.loin.id, self.boar.id])
+
+    def test_pages_continue_across_name_and_description_matches(self):
+        extra = [make_item(f"鹿肉セット{i}") for i in range(3)]
+        expected = [item.id for item in reversed(extra)] + [self.loin.id, self.boar.id]
+
+        seen, cursor = [], None
+        while True:
+            item_ids, cursor = search_item_ids("鹿肉", cursor, per_page=2)
+            seen.extend(item_ids)
+            if not cursor:
+                break
+        self.assertEqual(seen, expected)
+
+    def test_other_databases_fall_back_to_like(self):
+        mysql = type("Connection", (), {"vendor": "mysql"})()
+        self.assertIsInstance(get_backend(mysql), LikeSearchBackend)
+
+        with patch("base.search.get_backend", return_value=LikeSearchBackend()):
+            newer = Item.objects.create(name="猪肉ロース", price=100, is_published=True, information="鹿肉と同じ産地")
+            self.assertEqual(self.ids("鹿肉"), [self.loin.id, newer.id, self.boar.id])
+            self.assertEqual(self.ids("鹿肉 スライス"), [self.boar.id])
+            self.assertEqual(self.ids("猪"), [newer.id, self.boar.id])
+            self.assertEqual(self.ids("鹿肉", per_page=2), [self.loin.id, newer.id])
+
+    def test_search_view_stays_within_budget(self):
+        for i in range(5):
+            make_item(f"鹿肉セット{i}")
+
+        with self.settings(CATALOG_PAGE_SIZE=3):
+            self.assertQueryBudget("search", data={"q": "鹿肉"})
+            first = self.client.get(reverse("search"), {"q": "鹿肉"})
+            second = self.client.get(reverse("search"), {"q": "鹿肉", "cursor": first.context["next_cursor"]})
+            broken = self.client.get(reverse("search"), {"q": "鹿肉", "cursor": "!!"})
+
+        self.assertEqual(len(first.context["cards"]), 3)
+        self.assertContains(second, "鹿肉ロースブロック")
+        self.assertRedirects(broken, f"{reverse('search')}?q=%E9%B9%BF%E8%82%89", fetch_redirect_response=False)
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.address = make_address(self.user)
+        self.item = make_item(stock=10)
+
+    def order(self):
+        return commit_order(self.user, self.address, [(self.item, 1, 1100)])
+
+    def test_order_enqueues_confirmation_in_same_transaction(self):
+        order = self.order()
+        with self.assertRaises(OutOfStockError):
+            commit_order(self.user, self.address, [(self.item, 100, 110000)])
+
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.order, message.to, message.status), (order, "taro@example.com", OutboxMessage.STATUS_PENDING))
+        self.assertIn(f"注文番号: {order.id}", message.body)
+        self.assertIn("鹿肉セット - 1個 - 1100円", message.body)
+        self.assertEqual(mail.outbox, [])
+
+    def test_worker_sends_each_batch_over_one_connection(self):
+        orders = [self.order() for _ in range(3)]
+        with patch("base.outbox.get_connection", wraps=get_connection) as connect:
+            self.assertEqual(send_pending(batch_size=2), (3, 0))
+
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(sorted(email.subject for email in mail.outbox), sorted(
+            f"ご注文ありがとうございます（注文番号 {order.id}）" for order in orders
+        ))
+        self.assertFalse(OutboxMessage.objects.exclude(status=OutboxMessage.STATUS_SENT).exists())
+        self.assertEqual(send_pending(), (0, 0))
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2, OUTBOX_RETRY_BASE_SECONDS=60)
+    def test_failed_send_is_retried_with_backoff_then_given_up(self):
+        self.order()
+        failing = patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=SMTPException("接続できません"),
+        )
+        with failing, self.assertLogs("base.outbox", "WARNING"):
+            self.assertEqual(send_pending(), (0, 1))
+            # 待ち時間が過ぎるまでは送り直さない
+            self.assertEqual(send_pending(), (0, 0))
+
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts, message.claimed_by), (OutboxMessage.STATUS_PENDING, 1, ""))
+        self.assertGreater(message.available_at, timezone.now() + timedelta(seconds=50))
+        self.assertIn("接続できません", message.last_error)
+        self.assertEqual(retry_delay(3), timedelta(seconds=240))
+
+        OutboxMessage.objects.update(available_at=timezone.now())
+        with failing, self.assertLogs("base.outbox", "ERROR"):
+            self.assertEqual(send_pending(), (0, 1))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (OutboxMessage.STATUS_FAILED, 2))
+        self.assertEqual(send_pending(), (0, 0))
+
+    @override_settings(OUTBOX_LEASE_SECONDS=300)
+    def test_claimed_messages_are_not_claimed_twice_until_lease_expires(self):
+        self.order()
+        first = claim_batch()
+
+        self.assertEqual(len(first), 1)
+        self.assertEqual(claim_batch(), [])
+        # 取り出したワーカーが結果を書かずに落ちたら、期限の後に別のワーカーが取り出す
+        later = claim_batch(now=timezone.now() + timedelta(seconds=301))
+        self.assertEqual([message.id for message in later], [first[0].id])
+        self.assertNotEqual(later[0].claimed_by, first[0].claimed_by)
+
+    def test_send_outbox_command(self):
+        self.order()
+        out = StringIO()
+        call_command("send_outbox", "--batch-size", "10", stdout=out)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["taro@example.com"])
+        self.assertIn("1件を送信しました", out.getvalue())
+
+
+# レプリカとして二つ目のSQLiteのデータベースを使う。レプリケーションの代わりに、テストで直接書き込む。
+@override_settings(DATABASE_REPLICAS=["replica1"], REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.replica_dir = tempfile.TemporaryDirectory()
+        connections.settings["replica1"] = {
+            **connections.settings["default"], "NAME": os.path.join(cls.replica_dir.name, "replica.sqlite3"),
+        }
+        # テストの実行前には無い接続なので、ここで使ってよいデータベースに加える
+        cls.databases = cls.databases | {"replica1"}
+        with override_settings(DATABASE_REPLICAS=[]):
+            call_command("migrate", database="replica1", verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections["replica1"].close()
+        del connections["replica1"]
+        del connections.settings["replica1"]
+        cls.replica_dir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.user = make_user()
+        self.address = make_address(self.user)
+        self.item = make_item()
+
+    def tearDown(self):
+        for model in (OrderItem, Order, Stock, Item):
+            model.objects.using("replica1").all().delete()
+        routers._unhealthy.clear()
+
+    # レプリカに、プライマリーより古い内容の商品を置く
+    def copy_item_to_replica(self, name):
+        Item.objects.using("replica1").create(
+            id=self.item.id, name=name, price=self.item.price, is_published=True, information="説明",
+            created_at=self.item.created_at,
+        )
+        Stock.objects.using("replica1").create(item_id=self.item.id, quantity=10)
+
+    def test_history_is_read_from_replica_until_the_user_writes(self):
+        commit_order(self.user, self.address, [(self.item, 1, 1100)])
+        self.client.force_login(self.user)
+
+        with CaptureQueriesContext(connections["replica1"]) as replica:
+            response = self.client.get(reverse("order_history"))
+        # レプリカにはまだ注文が届いていない
+        self.assertGreater(len(replica.captured_queries), 0)
+        self.assertNotContains(response, "鹿肉セット")
+
+        response = self.client.post(reverse("add_to_cart", args=[self.item.id]), {"quantity": 1})
+        self.assertEqual(response.cookies[settings.REPLICA_STICKY_COOKIE]["max-age"], 5)
+        with CaptureQueriesContext(connections["replica1"]) as replica:
+            response = self.client.get(reverse("order_history"))
+        self.assertEqual(replica.captured_queries, [])
+        self.assertContains(response, "鹿肉セット")
+
+    def test_cache_is_filled_from_primary_right_after_invalidation(self):
+        self.copy_item_to_replica("古い鹿肉セット")
+
+        response = self.client.get(reverse("index"))
+        self.assertContains(response, "鹿肉セット")
+        self.assertNotContains(response, "古い鹿肉セット")
+
+        # 無効にしてから時間がたっていれば、作り直しはレプリカから読む
+        with override_settings(REPLICA_STICKY_SECONDS=0):
+            invalidate_on_commit([self.item.id], catalog=True)
+            response = self.client.get(reverse("index"))
+        self.assertContains(response, "古い鹿肉セット")
+
+    def test_only_catalog_reads_outside_transactions_go_to_replica(self):
+        with routing_state() as state:
+            self.assertEqual(router.db_for_read(Item), "default")
+            state.replica_reads = True
+            self.assertEqual(router.db_for_read(Item), "replica1")
+            self.assertEqual(router.db_for_read(User), "default")
+            self.assertEqual(router.db_for_read(Session), "default")
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Item), "default")
+
+            Item.objects.filter(id=self.item.id).update(price=1200)
+            self.assertEqual(router.db_for_read(Item), "default")
+        self.assertEqual(router.db_for_read(Item), "default")
+
+    def test_unreachable_replica_falls_back_to_primary(self):
+        down = patch.object(connections["replica1"], "ensure_connection", side_effect=OperationalError("接続できません"))
+        with routing_state() as state, down as connect, self.assertLogs("base.routers", "WARNING"):
+            state.replica_reads = True
+            self.assertEqual(router.db_for_read(Item), "default")
+            self.assertEqual(router.db_for_read(Item), "default")
+        # 一度失敗したレプリカは REPLICA_RETRY_SECONDS 秒は試さない
+        self.assertEqual(connect.call_count, 1)
+
+        routers._unhealthy.clear()
+        with routing_state() as state:
+            state.replica_reads = True
+            self.assertEqual(router.db_for_read(Item), "replica1")
+
+
+class FlashSaleTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = make_item("限定の鹿ロース", stock=3)
+        Item.objects.filter(id=self.item.id).update(flash_sale=True)
+        self.item.refresh_from_db()
+        self.users = [make_user(f"buyer{i}") for i in range(5)]
+
+    def test_tickets_are_allocated_in_order_until_sold_out(self):
+        tickets = [enqueue(user, self.item, 1) for user in self.users]
+        self.assertEqual(enqueue(self.users[0], self.item, 1), tickets[0])
+
+        with self.assertNumQueries(8), self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(allocate_batch(self.item.id), (3, 2))
+
+        statuses = dict(FlashSaleTicket.objects.values_list("user__username", "status"))
+        self.assertEqual(statuses, {
+            "buyer0": "allocated", "buyer1": "allocated", "buyer2": "allocated", "buyer3": "sold_out", "buyer4": "sold_out",
+        })
+        self.assertEqual(StockReservation.objects.filter(item=self.item).count(), 3)
+        self.assertEqual(Cart.objects.get(user=self.users[0]).quantity, 1)
+        self.assertEqual(available_stock([self.item.id])[self.item.id], 0)
+        # 売り切れたあとの申し込みは、在庫を読むだけでDBに書き込まずに断る
+        late = make_user("late")
+        with self.assertNumQueries(1):
+            self.assertEqual(enqueue(late, self.item, 1).status, FlashSaleTicket.STATUS_SOLD_OUT)
+        # 在庫が戻れば、ほかのプロセスのキャッシュを消さなくてもまた申し込める
+        Stock.objects.filter(item=self.item).update(quantity=F("quantity") + 1)
+        self.assertEqual(enqueue(late, self.item, 1).status, FlashSaleTicket.STATUS_QUEUED)
+
+    def test_concurrent_requests_from_one_user_share_one_ticket(self):
+        ticket = enqueue(self.users[0], self.item, 1)
+        # 同時の申し込みで、受付中の整理券がまだ見えなかった場合
+        with patch.object(QuerySet, "first", return_value=None):
+            self.assertEqual(enqueue(self.users[0], self.item, 2), ticket)
+        self.assertEqual(FlashSaleTicket.objects.count(), 1)
+
+        process_flash_sales()
+        self.assertEqual(StockReservation.objects.get(user=self.users[0]).quantity, 1)
+        # 割り当てが済めば、また申し込める
+        self.assertEqual(enqueue(self.users[0], self.item, 1).status, FlashSaleTicket.STATUS_QUEUED)
+
+    def test_ticket_that_does_not_fit_is_sold_out_but_smaller_ones_still_fit(self):
+        enqueue(self.users[0], self.item, 2)
+        enqueue(self.users[1], self.item, 2)
+        enqueue(self.users[2], self.item, 1)
+
+        self.assertEqual(process_flash_sales(batch_size=2), (2, 1))
+        self.assertEqual(
+            list(FlashSaleTicket.objects.order_by("id").values_list("status", flat=True)),
+            ["allocated", "sold_out", "allocated"],
+        )
+
+    @override_settings(FLASH_SALE_QUEUE_LIMIT=2)
+    def test_queue_is_bounded(self):
+        self.assertEqual(enqueue(self.users[0], self.item, 1).status, FlashSaleTicket.STATUS_QUEUED)
+        self.assertEqual(enqueue(self.users[1], self.item, 1).status, FlashSaleTicket.STATUS_QUEUED)
+        self.assertIsNone(enqueue(self.users[2], self.item, 1).pk)
+        self.assertEqual(FlashSaleTicket.objects.count(), 2)
+
+    def test_add_to_cart_queues_without_locking_stock(self):
+        self.client.force_login(self.users[1])
+        enqueue(self.users[0], self.item, 1)
+
+        response = self.assertQueryBudget("add_to_cart", self.item.id, method="post", data={"quantity": 1})
+        ticket = FlashSaleTicket.objects.get(user=self.users[1])
+        self.assertRedirects(response, reverse("flash_sale_ticket", args=[ticket.id]))
+        self.assertFalse(Cart.objects.exists())
+
+        response = self.assertQueryBudget("flash_sale_ticket", ticket.id)
+        self.assertContains(response, "あなたの前に1人")
+        process_flash_sales()
+        self.assertContains(self.client.get(reverse("flash_sale_ticket", args=[ticket.id])), "在庫を確保しました")
+
+        self.client.logout()
+        response = self.client.post(reverse("add_to_cart", args=[self.item.id]), {"quantity": 1})
+        self.assertTrue(response["Location"].startswith(reverse("login")))
+
+    def test_quantity_must_be_within_the_per_add_limit(self):
+        self.client.force_login(self.users[0])
+        for quantity in (0, -1, settings.MAX_QUANTITY_PER_ADD + 1):
+            response = self.client.post(reverse("add_to_cart", args=[self.item.id]), {"quantity": quantity})
+            self.assertRedirects(response, reverse("item_detail", args=[self.item.id]), fetch_redirect_response=False)
+            with self.assertRaises(ValueError):
+                enqueue(self.users[0], self.item, quantity)
+        self.assertFalse(FlashSaleTicket.objects.exists())
+
+    def test_cart_apis_and_login_do_not_bypass_the_queue(self):
+        other = make_item("鹿肉", stock=10)
+        user = User.objects.create_user("taro", "taro@example.com", "pass-12345")
+        self.client.force_login(user)
+
+        response = self.client.post(
+            reverse("cart_batch"), json.dumps({"lines": [{"item_id": self.item.id, "quantity": 1}]}),
+            content_type="application/json",
+        )
+        self.assertEqual((response.status_code, response.json()["item_ids"]), (409, [self.item.id]))
+
+        order = commit_order(user, make_address(user), [(other, 1, 1100)])
+        OrderItem.objects.create(order=order, item=self.item, quantity=1, subtotal_price=1100)
+        self.client.post(reverse("reorder", args=[order.id]))
+        self.assertEqual(list(Cart.objects.filter(user=user).values_list("item_id", flat=True)), [other.id])
+
+        # 整理券で割り当てた分は、減らすことはできる
+        Cart.objects.create(user=user, item=self.item, quantity=2)
+        response = self.client.post(
+            reverse("cart_batch"), json.dumps({"lines": [{"item_id": self.item.id, "quantity": 1}], "replace": True}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Cart.objects.get(user=user, item=self.item).quantity, 1)
+
+        # ログイン前のCookieのカートに入っていても、ログインしたときに移さない
+        Cart.objects.filter(user=user).delete()
+        self.client.logout()
+        self.client.cookies["cart"] = get_cookie_signer(salt="cart" + CART_COOKIE_SALT).sign(
+            json.dumps({self.item.id: 1, other.id: 2})
+        )
+        self.client.post(reverse("login"), {"username": "taro", "password": "pass-12345"})
+        self.assertEqual(dict(Cart.objects.filter(user=user).values_list("item_id", "quantity")), {other.id: 2})
+
+    def test_admin_toggles_flash_sale(self):
+        admin_user = User.objects.create_superuser("admin", "admin@example.com", "pass")
+        self.client.force_login(admin_user)
+        changelist = reverse("admin:base_item_changelist")
+
+        self.client.post(changelist, {"action": "end_flash_sale", "_selected_action": [self.item.id]})
+        self.item.refresh_from_db()
+        self.assertFalse(self.item.flash_sale)
+        self.client.post(changelist, {"action": "start_flash_sale", "_selected_action": [self.item.id]})
+        self.item.refresh_from_db()
+        self.assertTrue(self.item.flash_sale)
+
+
+class FlashSaleContentionTests(TransactionTestCase):
+    def test_contention_benchmark_never_oversells(self):
+        for mode in ("direct", "queued"):
+            report = run_contention(mode, buyers=8, stock=3, threads=2, batch_size=4, prefix=mode)
+            self.assertFalse(report["oversold"])
+            self.assertEqual(sum(report["responses"].values()), 8)
+            for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "resolved_s"):
+                self.assertIn(key, report)
+
+
+@override_settings(RATE_LIMITS={"cart": (60, 2), "checkout": (60, 1)}, RATE_LIMIT_IP_FACTOR=2)
+class RateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = make_item(stock=100)
+
+    def add(self, client=None, **extra):
+        return (client or self.client).post(reverse("add_to_cart", args=[self.item.id]), {"quantity": 1}, **extra)
+
+    def test_token_bucket_allows_a_burst_then_refills(self):
+        now = 1_000_000.0
+        self.assertEqual([take("bucket", 60, 3, now=now) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(take("bucket", 60, 3, now=now), 1.0)
+        # 断った分はトークンを使わないので、1秒後には取れる
+        self.assertEqual(take("bucket", 60, 3, now=now + 1), 0)
+        self.assertAlmostEqual(take("bucket", 60, 3, now=now + 1), 1.0)
+        # 長く空いても満タンより多くは貯まらない
+        self.assertEqual([take("bucket", 60, 3, now=now + 600) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(take("bucket", 60, 3, now=now + 600), 0)
+
+    def test_bucket_evicted_before_refund_still_rejects(self):
+        now = 1_000_000.0
+        for _ in range(3):
+            take("bucket", 60, 3, now=now)
+        with patch.object(cache, "decr", side_effect=ValueError):
+            self.assertAlmostEqual(take("bucket", 60, 3, now=now), 1.0)
+
+    def test_user_over_limit_gets_429_with_retry_after(self):
+        user, other = make_user("taro"), make_user("hanako")
+        self.client.force_login(user)
+        self.assertEqual([self.add().status_code for _ in range(2)], [302, 302])
+
+        response = self.add()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(response.wsgi_request.perf_record["throttled"], "cart:user")
+        self.assertEqual(Cart.objects.get(user=user).quantity, 2)
+        # 別のお客さんのバケットは別
+        other_client = Client()
+        other_client.force_login(other)
+        self.assertEqual(self.add(other_client).status_code, 302)
+        self.assertEqual(rejection_counts(), {("cart", "user"): 1})
+
+    def test_ip_limit_covers_anonymous_clients(self):
+        statuses = [self.add(Client(), REMOTE_ADDR="203.0.113.5").status_code for _ in range(5)]
+        self.assertEqual(statuses, [302, 302, 302, 302, 429])
+        self.assertEqual(self.add(Client(), REMOTE_ADDR="203.0.113.6").status_code, 302)
+        self.assertEqual(rejection_counts(), {("cart", "ip"): 1})
+
+    def test_client_ip_is_taken_from_the_trusted_proxy_hop(self):
+        request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.2", HTTP_X_FORWARDED_FOR="1.2.3.4, 203.0.113.5, 10.0.0.1")
+        self.assertEqual(client_ip(request), "10.0.0.2")
+        with self.settings(RATE_LIMIT_TRUSTED_PROXIES=1):
+            self.assertEqual(client_ip(request), "10.0.0.1")
+        with self.settings(RATE_LIMIT_TRUSTED_PROXIES=2):
+            self.assertEqual(client_ip(request), "203.0.113.5")
+            # 先頭を書き換えても別のバケットにはならない
+            statuses = [
+                self.add(Client(), REMOTE_ADDR="10.0.0.2", HTTP_X_FORWARDED_FOR=f"198.51.100.{i}, 203.0.113.5, 10.0.0.1")
+                .status_code
+                for i in range(5)
+            ]
+            self.assertEqual(statuses, [302, 302, 302, 302, 429])
+
+    def test_json_api_and_async_checkout_are_throttled(self):
+        self.client.force_login(make_user())
+        body = json.dumps({"lines": [{"item_id": self.item.id, "quantity": 1}]})
+        responses = [self.client.post(reverse("cart_batch"), body, content_type="application/json") for _ in range(3)]
+        self.assertEqual([response.status_code for response in responses], [200, 200, 429])
+        self.assertIn("error", responses[-1].json())
+
+        self.assertEqual(self.client.get(reverse("checkout")).status_code, 200)
+        self.assertEqual(self.client.get(reverse("checkout")).status_code, 429)
+
+    def test_rate_limit_stats_command(self):
+        for _ in range(5):
+            self.add(REMOTE_ADDR="203.0.113.5")
+        out, err = StringIO(), StringIO()
+        call_command("rate_limit_stats", "--json", "--reset", stdout=out, stderr=err)
+
+        self.assertEqual(json.loads(out.getvalue()), [{"scope": "cart", "kind": "ip", "rejected": 1}])
+        self.assertIn("プロセスごと", err.getvalue())
+        self.assertEqual(rejection_counts(), {})
+
+    def test_process_local_cache_is_reported(self):
+        err = StringIO()
+        call_command("rate_limit_stats", stdout=StringIO(), stderr=err)
+        self.assertIn("プロセスごと", err.getvalue())
+        self.assertEqual([message.id for message in check_rate_limit_cache(None)], ["base.W001"])
+
+        self.assertEqual([message.id for message in check_catalog_cache(None)], ["base.W002"])
+
+        shared = {"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": tempfile.mkdtemp()}}
+        with self.settings(CACHES=shared):
+            self.assertEqual(check_rate_limit_cache(None), [])
+            self.assertEqual(check_catalog_cache(None), [])
+        with self.settings(RATE_LIMIT_ENABLED=False):
+            self.assertEqual(check_rate_limit_cache(None), [])
+
+
+class TemplateRenderingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = make_item(stock=5)
+        self.user = make_user()
+
+    def test_header_fragment_varies_by_auth_state(self):
+        url = reverse("index")
+        anonymous = self.client.get(url)
+        self.assertContains(anonymous, reverse("login"))
+        self.assertNotContains(anonymous, "ログアウトする")
+
+        self.client.force_login(self.user)
+        member = self.client.get(url)
+        self.assertContains(member, reverse("order_history"))
+        self.assertContains(member, "ログアウトする")
+        self.assertNotContains(member, reverse("register"))
+
+        self.client.logout()
+        self.assertNotContains(self.client.get(url), reverse("order_history"))
+
+    def test_every_page_shows_pending_messages(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse("add_to_cart", args=[self.item.id]), {"quantity": 1})
+
+        response = self.client.get(reverse("checkout"))
+        self.assertContains(response, "<header>")
+        self.assertTrue(response.context["messages"])
+
+    def test_item_detail_fragment_follows_item_version(self):
+        url = reverse("item_detail", args=[self.item.id])
+        self.assertContains(self.client.get(url), "残り約5個")
+
+        stock = Stock.objects.get(item=self.item)
+        stock.quantity = 8
+        stock.save()
+        self.assertContains(self.client.get(url), "残り約8個")
+
+    def test_cached_loader_is_enabled_outside_debug(self):
+        self.assertFalse(settings.DEBUG)
+        loaders = engines["django"].engine.template_loaders
+        self.assertEqual(type(loaders[0]).__module__, "django.template.loaders.cached")
+
+    def test_template_timer_and_render_benchmark(self):
+        with template_timer() as timings:
+            self.client.get(reverse("index"))
+        self.assertEqual(len(timings["index.html"]), 1)
+        self.assertEqual(len(timings["common/header.html"]), 1)
+        self.assertEqual(len(timings["item_card.html"]), 1)
+
+        users, items = seed(items=3, users=1, cart_lines=2, prefix="render")
+        cache.set("shared", 1)
+        report = run_template_render(users[0], items[0], rounds=2)
+        self.assertEqual(cache.get("shared"), 1)
+        self.assertEqual(report["templates"]["cold"]["cart.html"]["renders"], 2)
+        # 温まっていれば商品カードは描画し直さない
+        self.assertLess(
+            report["templates"]["warm"]["item_card.html"]["renders"],
+            report["templates"]["cold"]["item_card.html"]["renders"],
+        )
+
+
+class TaxPriceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_price_with_tax_is_kept_up_to_date_on_save(self):
+        item = make_item(price=1000)
+        self.assertEqual(item.price_with_tax, 1100)
+
+        item.tax_category = Item.TAX_REDUCED
+        item.save(update_fields=["tax_category"])
+        item.refresh_from_db()
+        self.assertEqual(item.price_with_tax, 1080)
+
+        item.price = 500
+        item.save(update_fields=["price"])
+        self.assertEqual(Item.objects.get(id=item.id).price_with_tax, 540)
+
+    def test_backfill_after_rate_change_refreshes_cached_pages(self):
+        item = make_item(price=1000)
+        url = reverse("item_detail", args=[item.id])
+        self.assertContains(self.client.get(url), "1100円")
+
+        with override_settings(TAX_RATES={**settings.TAX_RATES, "standard": 12}):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(backfill_tax_prices(batch_size=1), (1, 1))
+            self.assertEqual(backfill_tax_prices(), (1, 0))
+            out = StringIO()
+            call_command("backfill_tax_prices", stdout=out)
+        self.assertIn("0件の税込み価格", out.getvalue())
+
+        self.assertEqual(Item.objects.get(id=item.id).price_with_tax, 1120)
+        self.assertContains(self.client.get(url), "1120円")
+
+    def test_import_keeps_tax_category_of_existing_items(self):
+        Item.objects.create(sku="DEER-1", name="鹿", price=100, information="", tax_category=Item.TAX_REDUCED)
+
+        import_items([
+            (2, {"sku": "DEER-1", "name": "鹿ロース", "price": "1000", "is_published": "1"}),
+            (3, {"sku": "BOAR-1", "name": "猪バラ", "price": "1000", "is_published": "1"}),
+        ])
+
+        self.assertEqual(Item.objects.get(sku="DEER-1").price_with_tax, 1080)
+        self.assertEqual(Item.objects.get(sku="BOAR-1").price_with_tax, 1100)
+
+    def test_index_filters_and_sorts_by_price_with_tax(self):
+        cheap = make_item("鹿", price=1000)
+        food = make_item("猪", price=1010)
+        food.tax_category = Item.TAX_REDUCED
+        food.save()
+        expensive = make_item("熊", price=3000)
+
+        response = self.client.get(reverse("index"), {"sort": "price_asc", "min_price": "1090", "max_price": "3000"})
+        # 猪は税抜きでは高いが、軽減税率で税込み 1090円 になり 鹿（1100円）より安い
+        self.assertEqual([item.id for item in response.context["page"]], [food.id, cheap.id])
+        self.assertContains(response, "min_price=1090&amp;max_price=3000")
+
+        response = self.client.get(reverse("index"), {"sort": "price_desc", "min_price": "abc"})
+        self.assertEqual([item.id for item in response.context["page"]], [expensive.id, cheap.id, food.id])
+
+
+class CommitOrderConcurrencyTests(TransactionTestCase):
+    def test_concurrent_orders_never_oversell(self):
+        item = make_item(stock=5)
+        users = [make_user(f"user{i}") for i in range(12)]
+        buyers = [(user, make_address(user)) for user in users]
+        results = []
+        barrier = threading.Barrier(len(buyers))
+
+        def buy(user, address):
+            barrier.wait()
+            try:
+                commit_order(user, address, [(item, 1, 1100)])
+                results.append("ok")
+            except (OutOfStockError, OperationalError):
+                results.append("rejected")
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=buyer) for buyer in buyers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        remaining = Stock.objects.get(item=item).quantity
+        sold = OrderItem.objects.filter(item=item).count()
+        self.assertGreaterEqual(remaining, 0)
+        self.assertEqual(sold, results.count("ok"))
+        self.assertEqual(remaining + sold, 5)
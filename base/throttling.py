@@ -0,0 +1,164 @@
+import math
+import time
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import HttpResponse, JsonResponse
+
+# ユーザーごと・IPアドレスごとのレート制限（トークンバケット）。バケットはキャッシュに持つ。
+# バケットの状態は「次の1回分のトークンが貯まる時刻」（GCRA）の一つの数値だけにして、cache.incr で進める。
+# Webのワーカーが複数あるときは、すべてのプロセスで共有するキャッシュ（Redis・Memcached）を使うこと。
+# ローカルメモリのキャッシュはプロセスごとなので、上限がワーカーの数だけ倍になり、
+# 断った回数も rate_limit_stats（別のプロセス）からは見えない（check --deploy で警告する）。
+# Redis・Memcached は incr が不可分なので、プロセスをまたいでもロックなしで数えられる。
+# ファイルのキャッシュは共有できるが incr が不可分ではないので、同時のリクエストを少し多めに通すことがある。
+REJECTION_KINDS = ("user", "ip")
+
+
+# バケットと断った回数を、すべてのプロセスで共有できるキャッシュに持っているか
+def cache_is_shared():
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+
+def bucket_key(scope, kind, identity):
+    return f"throttle:{scope}:{kind}:{identity}"
+
+
+def rejection_key(scope, kind):
+    return f"throttle:rejected:{scope}:{kind}"
+
+
+# バケットからトークンを一つ取る。per_minute は1分あたりに補充する数、burst はバケットの大きさ（続けて通せる数）。
+# 戻り値は、取れたら 0、取れなければ次に取れるまでの秒数。
+def take(key, per_minute, burst, now=None):
+    interval = max(60000 // per_minute, 1)  # トークン1つ分の時間（ミリ秒）
+    window = interval * burst  # 空のバケットが満タンになるまでの時間
+    timeout = math.ceil((window + interval) / 1000) + 1
+    now = int((now or time.time()) * 1000)
+
+    # バケットがなければ満タンで作る
+    cache.add(key, now, timeout)
+    try:
+        ready_at = cache.incr(key, interval)
+    except ValueError:
+        cache.set(key, now + interval, timeout)
+        return 0
+    # しばらく使われていなかったバケットは、満タンより多くは貯まらない
+    # （ここで同時に作り直すと少し多めに通すことがあるが、ロックは取らない）
+    if ready_at - interval < now:
+        cache.set(key, now + interval, timeout)
+        return 0
+    if ready_at - now <= window:
+        return 0
+    # 断った分はトークンを使わなかったことにする
+    # （その間にバケットが期限切れや追い出しで消えていたら、戻すものはないので何もしない）
+    try:
+        cache.decr(key, interval)
+    except ValueError:
+        pass
+    else:
+        cache.touch(key, timeout)
+    return (ready_at - now - window) / 1000
+
+
+# お客さんのIPアドレス。プロキシの後ろでは、信頼するプロキシが X-Forwarded-For に付け足したうち一番外側の
+# （右から RATE_LIMIT_TRUSTED_PROXIES 番目の）アドレスを使う。それより左はお客さんが書き換えられる。
+# プロキシを通っていない（付け足された数が足りない）リクエストは REMOTE_ADDR を使う。
+def client_ip(request):
+    proxies = settings.RATE_LIMIT_TRUSTED_PROXIES
+    if proxies:
+        forwarded = [address.strip() for address in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",")]
+        forwarded = [address for address in forwarded if address]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.META.get("REMOTE_ADDR") or None
+
+
+# 断った回数（プロセスをまたいでキャッシュで数える）。{(スコープ, "user" か "ip"): 回数}
+def rejection_counts():
+    keys = {rejection_key(scope, kind): (scope, kind) for scope in settings.RATE_LIMITS for kind in REJECTION_KINDS}
+    found = cache.get_many(keys)
+    return {keys[key]: count for key, count in found.items() if count}
+
+
+def reset_rejection_counts():
+    cache.delete_many([rejection_key(scope, kind) for scope in settings.RATE_LIMITS for kind in REJECTION_KINDS])
+
+
+def _count_rejection(scope, kind):
+    key = rejection_key(scope, kind)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def too_many_requests(request, wait):
+    message = "リクエストが多すぎます。しばらくしてからもう一度お試しください。"
+    if request.content_type == "application/json":
+        response = JsonResponse({"error": message}, status=429)
+    else:
+        response = HttpResponse(message, status=429, content_type="text/plain; charset=utf-8")
+    response["Retry-After"] = str(max(math.ceil(wait), 1))
+    return response
+
+
+# IPアドレスのバケットと、ログインしていればユーザーのバケットから一つずつ取る。
+# 取れなければ 429 のレスポンスを、取れたら None を返す。
+# 同じIPアドレスの後ろに複数のお客さんがいることがあるので、IPアドレスには RATE_LIMIT_IP_FACTOR 倍まで許す。
+def check_rate(request, scope, user):
+    limit = settings.RATE_LIMITS.get(scope)
+    if not settings.RATE_LIMIT_ENABLED or limit is None:
+        return None
+    per_minute, burst = limit
+    factor = settings.RATE_LIMIT_IP_FACTOR
+    buckets = []
+    ip = client_ip(request)
+    if ip:
+        buckets.append(("ip", ip, per_minute * factor, burst * factor))
+    if user.is_authenticated:
+        buckets.append(("user", user.pk, per_minute, burst))
+
+    for kind, identity, bucket_per_minute, bucket_burst in buckets:
+        wait = take(bucket_key(scope, kind, identity), bucket_per_minute, bucket_burst)
+        if wait:
+            _count_rejection(scope, kind)
+            # QueryInstrumentationMiddleware が性能ログに書き出す
+            request.throttled = f"{scope}:{kind}"
+            return too_many_requests(request, wait)
+    return None
+
+
+# ビューにレート制限をかける。methods に含まれるメソッドだけを数える（None ならすべて）。
+# 非同期のビューにも使える。
+def throttle(scope, methods=("POST",)):
+    def decorator(view):
+        def applies(request):
+            return methods is None or request.method in methods
+
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if applies(request):
+                    user = await request.auser()
+                    rejected = await sync_to_async(check_rate)(request, scope, user)
+                    if rejected is not None:
+                        return rejected
+                return await view(request, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if applies(request):
+                rejected = check_rate(request, scope, request.user)
+                if rejected is not None:
+                    return rejected
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,8 +1,8 @@
 from django.urls import path
 from .views import(
-    register, CustomLoginView, CustomLogoutView, index,
-    item_detail, cart, add_to_cart, remove_from_cart, add_address,
-    checkout, success, order_history
+    register, CustomLoginView, CustomLogoutView, index, search,
+    item_detail, cart, add_to_cart, flash_sale_ticket, remove_from_cart, cart_batch, add_address,
+    checkout, success, order_history, reorder, stripe_webhook, fake_stripe_checkout
 )
 
 urlpatterns = [
@@ -10,13 +10,19 @@ urlpatterns = [
     path("login/", CustomLoginView.as_view(), name="login"),
     path("logout", CustomLogoutView.as_view(next_page="login"), name="logout"),
     path("index/", index, name="index"),
+    path("search/", search, name="search"),
     path("item/<int:item_id>/", item_detail, name="item_detail"),
     path("cart/", cart, name="cart"),
     path("cart/add/<int:item_id>/", add_to_cart, name="add_to_cart"),
+    path("flash-sale/<int:ticket_id>/", flash_sale_ticket, name="flash_sale_ticket"),
     path("cart/remove/<int:item_id>/", remove_from_cart, name="remove_from_cart"),
+    path("cart/batch/", cart_batch, name="cart_batch"),
     path("address/add/", add_address, name="add_address"),
     path("checkout", checkout, name="checkout"),
     path("success/", success, name="success"),
     path("order-history/", order_history, name="order_history"),
+    path("order-history/<int:order_id>/reorder/", reorder, name="reorder"),
+    path("stripe/webhook/", stripe_webhook, name="stripe_webhook"),
+    path("stripe/fake-checkout/<str:session_id>/", fake_stripe_checkout, name="fake_stripe_checkout"),
     
 ]
\ No newline at end of file
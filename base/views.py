@@ -1,14 +1,38 @@
-import stripe
+import hashlib
+import json
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib import messages
 from django.contrib.auth import login, authenticate, logout
-from django.contrib.auth.views import LoginView, LogoutView
+from django.contrib.auth.views import LoginView, LogoutView, redirect_to_login
 from django.contrib.auth.decorators import login_required
+from django.utils.decorators import method_decorator
+from django.middleware.csrf import get_token
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST
 from .forms import UserRegisterForm, AddressForm
-from .models import Item, Cart, Stock, Order, OrderItem, Address
-from django.db import transaction
-
+from .models import Item, Cart, Order, OrderItem, Address, Payment, FlashSaleTicket
+from .caching import get_catalog_page, get_item_detail, render_item_cards
+from .carts import get_cart, update_cart
+from .exceptions import CartFullError, FlashSaleItemError, OutOfStockError
+from .flash_sales import enqueue, queue_position
+from .orders import finalize_checkout, handle_payment_event
+from .pagination import InvalidCursor, keyset_page
+from .payments import FakeStripeGateway, InvalidWebhook, checkout_session_expires_at, get_gateway
+from .pricing import get_priced_cart
+from .routers import replica_reads
+from .reservations import available_stock, reserve
+from .search import search_item_ids
+from .throttling import throttle
+from django.db.models import Max, Prefetch, Q
+from django.utils import timezone
+
+@throttle("account")
 def register(request):
     if request.method == "POST":
         form = UserRegisterForm(request.POST)
@@ -22,116 +46,314 @@ def register(request):
         form = UserRegisterForm()
     return render(request, "register.html", {"form": form})
     
+@method_decorator(throttle("account"), name="dispatch")
 class CustomLoginView(LoginView):
     template_name = "login.html"
 
 class CustomLogoutView(LogoutView):
     next_page = "login"
 
+# 商品一覧の並び順。最後に id を入れて並びを一意にする。価格は保存している税込み価格で並べる。
+CATALOG_ORDERINGS = {
+    "new": ("-created_at", "-id"),
+    "price_asc": ("price_with_tax", "id"),
+    "price_desc": ("-price_with_tax", "-id"),
+}
+
+# 商品一覧の価格（税込み）での絞り込み。{"min_price": 下限, "max_price": 上限} のうち指定されたものだけを返す。
+# 整数でない値は指定されなかったものとして扱う。
+def price_range(request):
+    bounds = {}
+    for name in ("min_price", "max_price"):
+        value = request.GET.get(name, "").strip()
+        if value.isdigit():
+            bounds[name] = int(value)
+    return bounds
+
+# 条件付きGET（ETag / Last-Modified）で使う、ページの見た目が変わる要素。
+# 表示待ちのメッセージがあるときは、必ず描画するため None を返す。
+# ページのフォームにはCSRFトークンが入っていて、ログイン・ログアウトでCSRFのシークレットが変わると
+# 古いページのフォームは送信できなくなるので、シークレットも含める（ETagはハッシュにするので外には出ない）。
+# まだシークレットがなければ get_token で作り、描画するページと同じシークレットでETagを作る。
+def page_variant(request):
+    if len(messages.get_messages(request)):
+        return None
+    get_token(request)
+    return f"user={request.user.pk or 'anon'}:csrf={request.META['CSRF_COOKIE']}"
+
+def make_etag(*parts):
+    return hashlib.sha1(":".join(str(part) for part in parts).encode()).hexdigest()
+
+# 商品一覧の1ページ分。ETagの計算とビューで同じものを使うよう、リクエストに保存しておく。
+# 戻り値は (並び順, 価格の絞り込み, カーソル, ページ)
+def catalog_page(request):
+    if not hasattr(request, "_catalog_page"):
+        sort = request.GET.get("sort", "new")
+        if sort not in CATALOG_ORDERINGS:
+            sort = "new"
+        bounds = price_range(request)
+        cursor = request.GET.get("cursor")
+        # 公開中の商品だけを、商品カードに必要な列だけ読み込む
+        items = Item.objects.filter(is_published=True).only(
+            "id", "name", "price_with_tax", "image", "image_variants", "created_at", "updated_at"
+        )
+        if "min_price" in bounds:
+            items = items.filter(price_with_tax__gte=bounds["min_price"])
+        if "max_price" in bounds:
+            items = items.filter(price_with_tax__lte=bounds["max_price"])
+        try:
+            page = get_catalog_page(
+                sort, cursor,
+                lambda: keyset_page(items, CATALOG_ORDERINGS[sort], cursor, settings.CATALOG_PAGE_SIZE),
+                urlencode(bounds),
+            )
+        except InvalidCursor:
+            page = None
+        request._catalog_page = (sort, bounds, cursor, page)
+    return request._catalog_page
+
+def catalog_etag(request):
+    variant = page_variant(request)
+    sort, bounds, cursor, page = catalog_page(request)
+    if variant is None or page is None:
+        return None
+    # キャッシュのバージョンはプロセスごとのキャッシュでは他のプロセスの変更を反映しないので、
+    # ページに載っている商品とその更新日時から作る
+    shown = [(item.id, item.updated_at.isoformat()) for item in page]
+    return make_etag("index", sort, urlencode(bounds), cursor, shown, page.next_cursor, variant)
+
+def catalog_last_modified(request):
+    _, _, _, page = catalog_page(request)
+    if page is None or page_variant(request) is None:
+        return None
+    return max((item.updated_at for item in page), default=None)
+
+@replica_reads
+@condition(etag_func=catalog_etag, last_modified_func=catalog_last_modified)
 def index(request):
-    items = Item.objects.all()
-
-    return render(request, "index.html", {"items": items})
-
+    sort, bounds, _, page = catalog_page(request)
+    # 並び替え・ページ送りのリンクでも価格の絞り込みを引き継ぐ
+    filters = urlencode(bounds)
+    if page is None:
+        return redirect(f"{reverse('index')}?{urlencode({'sort': sort, **bounds})}")
+
+    # 商品カードは商品ごとにキャッシュしたHTMLを使う
+    cards = render_item_cards(page.object_list)
+    return render(request, "index.html", {
+        "items": page, "cards": cards, "page": page, "sort": sort, "price_range": bounds, "filters": filters,
+    })
+
+# 商品検索。索引で一致する順に商品IDを取り出し、そのページの商品だけを読み込む。
+@replica_reads
+def search(request):
+    query = request.GET.get("q", "").strip()
+    cursor = request.GET.get("cursor")
+    try:
+        item_ids, next_cursor = search_item_ids(query, cursor, settings.CATALOG_PAGE_SIZE)
+    except InvalidCursor:
+        return redirect(f"{reverse('search')}?{urlencode({'q': query})}")
+
+    items = Item.objects.filter(id__in=item_ids).only(
+        "id", "name", "price_with_tax", "image", "image_variants", "created_at", "updated_at"
+    ).in_bulk()
+    items = [items[item_id] for item_id in item_ids if item_id in items]
+    return render(request, "search.html", {"query": query, "cards": render_item_cards(items), "next_cursor": next_cursor})
+
+# 商品詳細と購入可能な在庫数を読み込む。キャッシュがないときだけ呼ばれる。
+# 最終更新日時は、商品・在庫の更新日時と、仮押さえができた日時・期限が切れた日時のうち最も新しいもの
+def load_item_detail(item_id):
+    now = timezone.now()
+    item = Item.objects.filter(id=item_id).annotate(
+        stock_updated_at=Max("stock__updated_at"),
+        hold_created_at=Max("stockreservation__created_at"),
+        hold_expired_at=Max("stockreservation__expires_at", filter=Q(stockreservation__expires_at__lte=now)),
+    ).first()
+    if item is None:
+        return None
+    last_modified = max(filter(None, [item.updated_at, item.stock_updated_at, item.hold_created_at, item.hold_expired_at]))
+    return {"item": item, "stock": available_stock([item.id])[item.id], "last_modified": last_modified}
+
+def item_detail_data(request, item_id):
+    if not hasattr(request, "_item_detail"):
+        request._item_detail = get_item_detail(item_id, lambda: load_item_detail(item_id))
+    return request._item_detail
+
+# ETagはDBから読んだ内容（最終更新日時と購入可能数）から作る。
+# キャッシュのバージョンはプロセスごとのキャッシュでは他のプロセスや管理コマンドの変更を反映しないので使わない。
+def item_detail_etag(request, item_id):
+    variant = page_variant(request)
+    detail = item_detail_data(request, item_id)
+    if variant is None or detail is None:
+        return None
+    return make_etag("item_detail", item_id, detail["last_modified"].isoformat(), detail["stock"], variant)
+
+def item_detail_last_modified(request, item_id):
+    detail = item_detail_data(request, item_id)
+    if detail is None or page_variant(request) is None:
+        return None
+    return detail.get("last_modified")
+
+@replica_reads
+@condition(etag_func=item_detail_etag, last_modified_func=item_detail_last_modified)
 def item_detail(request, item_id):
-    item = get_object_or_404(Item, id=item_id)
-    stock_item_range = range(1, item.get_stock() + 1)
-    return render(request, "item_detail.html", {"item": item, "stock_item_range":stock_item_range})
+    detail = item_detail_data(request, item_id)
+    if detail is None:
+        raise Http404
+    item = detail["item"]
+    # 仮押さえ中の分を引いた在庫数を表示する。数量の選択肢は上限までにする。
+    stock = detail["stock"]
+    stock_item_range = range(1, min(stock, settings.MAX_QUANTITY_PER_ADD) + 1)
+    return render(request, "item_detail.html", {
+        "item": item, "stock": stock, "stock_item_range": stock_item_range,
+        # テンプレートの断片のキャッシュも、表示する内容が変わったら使わなくなるよう同じ値をキーにする
+        "detail_version": f"{detail['last_modified'].timestamp()}:{stock}",
+    })
 
-@login_required
 def cart(request):
-    user = request.user
-    cart_items = Cart.objects.filter(user=user)
-
-    total_price = 0
-    cart_data = []
-
-    for cart_item in cart_items:
-        image_url = cart_item.item.image.url if cart_item.item.image else None
-        subtotal = cart_item.item.tax_price() * cart_item.quantity
-        total_price += subtotal
-        cart_data.append({
-            "item":cart_item.item,
-            "image_url": image_url,
-            "quantity": cart_item.quantity,
-            "subtotal": subtotal
-        })
-    return render(request, "cart.html", {"cart": cart_data, "total_price":total_price})
-
-@login_required   
-def add_to_cart(request, item_id):
+    # 商品はまとめて読み込み、小計と合計は pricing で計算する
+    priced_cart = get_priced_cart(request)
+    return render(request, "cart.html", {"cart": priced_cart, "total_price": priced_cart.total_price})
 
-# 辞書型の中の辞書の構造になっている。例が下になる。また、ここではカートに商品を入れた時に、まだStockテーブルの更新は行わない。
-#     cart = {
-#     "1": {
-#         "name": "鹿肉セット",
-#         "price": 5000,
-#         "quantity": 2
-#     },
-#     "2": {
-#         "name": "猪肉ステーキ",
-#         "price": 3000,
-#         "quantity": 1
-#     }
-# }
+# ログインしていなくてもカートに入れられる。ログイン前のカートはCookieに持ち、ログインしたときにまとめて移す。
+# ここではカートに商品を入れた時に、まだStockテーブルの更新は行わない。
+@throttle("cart")
+def add_to_cart(request, item_id):
     item = get_object_or_404(Item, id=item_id)
-    user = request.user
 
     if request.method == "POST":
-        quantity = int(request.POST.get("quantity", 1))
+        try:
+            quantity = int(request.POST.get("quantity", 1))
+        except ValueError:
+            quantity = 0
+        if not 1 <= quantity <= settings.MAX_QUANTITY_PER_ADD:
+            messages.error(request, f"数量は1〜{settings.MAX_QUANTITY_PER_ADD}個で選んでください。")
+            return redirect("item_detail", item_id=item.id)
+        if item.flash_sale:
+            return apply_flash_sale(request, item, quantity)
+        user = request.user if request.user.is_authenticated else None
+        cart_storage = get_cart(request)
 
-        # 現在の在庫数をStockテーブルから取得
-        stock_entry = Stock.objects.filter(item=item).first()
-        available_stock = stock_entry.quantity if stock_entry else 0        
+        # 現在の在庫数から他の人の仮押さえ分を引いた数を取得
+        stock = available_stock([item.id], exclude_user=user)[item.id]
 
         # 現在のカート内商品の個数を取得
-        cart_item, created = Cart.objects.get_or_create(user=user, item=item, defaults={"quantity": 0})
-        current_cart_quantity = cart_item.quantity
-
-        if current_cart_quantity + quantity > available_stock:
+        if cart_storage.quantity(item.id) + quantity > stock:
             messages.error(request, "在庫不足です。もう一度やり直してください。")
             return redirect("item_detail", item_id=item.id)
-        
-        with transaction.atomic():
-            cart_item.quantity += quantity
-            cart_item.save()
-        
+
+        if not cart_storage.add(item.id, quantity):
+            messages.error(request, "カートに入れられる商品の種類が上限に達しています。ログインするとさらに追加できます。")
+            return redirect("cart")
+
         messages.success(request, "カートに商品を追加しました！")
         return redirect("cart")
     
     return redirect("item_detail", item_id=item.id)
 
+# フラッシュセール中の商品は、在庫の行に触らずに整理券を積むだけにして、すぐに受付の状況を返す。
+# 割り当ては process_flash_sales コマンドが受け付けた順に行い、確保できた分はカートに入る。
+def apply_flash_sale(request, item, quantity):
+    if not request.user.is_authenticated:
+        messages.error(request, "数量限定の商品は、ログインしてからお申し込みください。")
+        return redirect_to_login(reverse("item_detail", args=[item.id]))
+    ticket = enqueue(request.user, item, quantity)
+    if ticket.pk is None:
+        messages.error(request, "申し訳ありません。売り切れました。")
+        return redirect("item_detail", item_id=item.id)
+    return redirect("flash_sale_ticket", ticket_id=ticket.id)
+
 @login_required
-def remove_from_cart(request, item_id):
-    user= request.user
-    cart_item = get_object_or_404(Cart, user=user, item_id=item_id)
+def flash_sale_ticket(request, ticket_id):
+    ticket = get_object_or_404(FlashSaleTicket.objects.select_related("item"), id=ticket_id, user=request.user)
+    position = queue_position(ticket) if ticket.status == FlashSaleTicket.STATUS_QUEUED else None
+    return render(request, "flash_sale_ticket.html", {"ticket": ticket, "position": position})
 
-    with transaction.atomic():
-        cart_item.delete()
+@throttle("cart", methods=None)
+def remove_from_cart(request, item_id):
+    if not get_cart(request).remove(item_id):
+        raise Http404
     
     messages.success(request, "カートから商品を削除しました")
     return redirect("cart")
 
 
+# カートの一括変更API。JSONで {"lines": [{"item_id": 1, "quantity": 2}, ...], "replace": false} を受け取る。
+# 在庫はまとめて確認し、足りなければ何も変えずに 409 を返す。成功したら計算済みのカートを返す。
+@throttle("cart")
+@require_POST
+def cart_batch(request):
+    try:
+        payload = json.loads(request.body)
+        lines = payload["lines"]
+        replace = bool(payload.get("replace", False))
+        if not isinstance(lines, list) or not 0 < len(lines) <= settings.CART_BATCH_MAX_LINES:
+            raise ValueError
+        quantities = {}
+        for line in lines:
+            item_id, quantity = int(line["item_id"]), int(line["quantity"])
+            if quantity < 0 or (quantity == 0 and not replace):
+                raise ValueError
+            quantities[item_id] = quantities.get(item_id, 0) + quantity
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse(
+            {"error": f"lines は item_id と quantity の組を1〜{settings.CART_BATCH_MAX_LINES}行送ってください"},
+            status=400,
+        )
+
+    try:
+        update_cart(request, quantities, replace=replace)
+    except OutOfStockError as e:
+        return JsonResponse({"error": "在庫が足りない商品があります", "item_ids": e.item_ids}, status=409)
+    except FlashSaleItemError as e:
+        return JsonResponse({"error": "数量限定の商品は商品ページから整理券でお申し込みください", "item_ids": e.item_ids}, status=409)
+    except CartFullError:
+        return JsonResponse({"error": "カートに入れられる商品の種類が上限に達しています"}, status=409)
+    return JsonResponse(get_priced_cart(request, refresh=True).as_dict())
+
+# 過去の注文と同じ商品をまとめてカートに入れる。在庫が足りない商品とフラッシュセール中の商品は入れずに知らせる。
+@throttle("cart")
 @login_required
-def checkout(request):
+@require_POST
+def reorder(request, order_id):
+    order = get_object_or_404(Order, id=order_id, user=request.user)
+    quantities = {}
+    for item_id, quantity in order.orderitem_set.values_list("item_id", "quantity"):
+        quantities[item_id] = quantities.get(item_id, 0) + quantity
+
+    # 入れられない商品を除きながら入れ直す（除くたびに商品が減るので、いつかは終わる）
+    skipped = set()
+    while quantities:
+        try:
+            update_cart(request, quantities)
+            break
+        except (OutOfStockError, FlashSaleItemError) as e:
+            skipped.update(e.item_ids)
+            quantities = {item_id: quantity for item_id, quantity in quantities.items() if item_id not in skipped}
+    if skipped:
+        if quantities:
+            messages.warning(request, f"在庫が足りない商品や数量限定の商品{len(skipped)}点を除いてカートに追加しました。")
+        else:
+            messages.error(request, "在庫が足りないか数量限定の商品のため、カートに追加できませんでした。")
+        return redirect("cart")
+
+    messages.success(request, "前回と同じ商品をカートに追加しました！")
+    return redirect("cart")
+
+
+# checkout の同期部分。カートと住所を確認して在庫を仮押さえする。
+# 決済画面に進めるときは (priced_cart, address) を、そうでなければレスポンスを返す。
+def prepare_checkout(request):
     user = request.user
-    cart_items = Cart.objects.filter(user=user)
+    priced_cart = get_priced_cart(request)
 
     # カートが空ならcart.htmlにリダイレクト
-    if not cart_items.exists():
+    if not priced_cart:
         messages.error(request, "カートは空です")
         return redirect("cart")
     
     # ユーザーの登録済み住所
     addresses = Address.objects.filter(user=user)  
-    total_price = 0
-    for cart_item in cart_items:
-        item_price = cart_item.item.tax_price()  # 税込み価格を取得
-        item_quantity = cart_item.quantity  # カート内の個数
-        subtotal = item_price * item_quantity  # 小計
-        total_price += subtotal  # 合計金額を加算
-    
+    context = {"cart_items": priced_cart, "addresses": addresses, "total_price": priced_cart.total_price}
 
     if request.method == "POST":
         address_id = request.POST.get("address_id")
@@ -139,121 +361,118 @@ def checkout(request):
         # 住所が選択されているかチェック
         if not address_id:
             messages.error(request, "送付先の住所を選択してください")
-            return render(request, "checkout.html", {"cart_items": cart_items, "addresses": addresses, "total_price": total_price})
+            return render(request, "checkout.html", context)
 
         address = get_object_or_404(Address, id=address_id, user=user)
-        total_price = 0
-        for cart_item in cart_items:
-            item_price = cart_item.item.tax_price()  # 税込み価格を取得
-            item_quantity = cart_item.quantity  # カート内の個数
-            subtotal = item_price * item_quantity  # 小計
-            total_price += subtotal  # 合計金額を加算
-
-        # 在庫をチェックして、ないまたは足りない場合削除。在庫の確保はしない。
-        # 決済するときに在庫をもう一度チェックする。
-        not_stock_items = []
-        for cart_item in cart_items:
-            stock_entry = Stock.objects.get(item=cart_item.item)
-
-            # カート商品の個数と在庫の個数を比較して、足りなかったら削除する商品リストに入れる。
-            if stock_entry.quantity < cart_item.quantity:
-                not_stock_items.append(cart_item)
-        
-        # 削除する商品リストがあるなら削除する。その後、カートにリダイレクト。
-        if not_stock_items:
-            for item in not_stock_items:
-                item.delete()
-            
+
+        # 在庫をチェックして、足りていれば決済が終わるまで仮押さえする。
+        # ないまたは足りない商品はカートから削除する。
+        try:
+            reserve(user, priced_cart.quantities())
+        except OutOfStockError as e:
+            Cart.objects.filter(user=user, item_id__in=e.item_ids).delete()
             messages.error(request, "在庫が足りない商品があったので、もう一度やり直してください。")
             return redirect("cart")
-        
-        # 住所がチェックされていたら決済ページを作成し、決済する画面へ。また、在庫のチェックはその時行うようにする。
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        session = stripe.checkout.Session.create(
-            payment_method_types=["card"],
-            line_items=[
-                {
-                    "price_data": {
-                        "currency": "jpy",
-                        "product_data": {
-                            "name": cart_item.item.name,
-                        },
-                        "unit_amount": cart_item.item.tax_price(),
-                    },
-                    "quantity": cart_item.quantity,
-                }
-                for cart_item in cart_items
-            ],
-            mode="payment",
-            success_url=request.build_absolute_uri(f"/success/?address_id={address.id}"),
-            cancel_url=request.build_absolute_uri("/checkout/")
-        )
 
-        return redirect(session.url, code=303)
+        return priced_cart, address
     
-    return render(request, "checkout.html", {"cart_items": cart_items, "addresses": addresses, "total_price": total_price})
+    return render(request, "checkout.html", context)
 
+# 決済サービスの応答を待つ間にワーカーを塞がないよう、非同期ビューにしている。
+# DBを触る部分だけをスレッドで実行し、Stripeへの通信はイベントループの上で待つ。
+@throttle("checkout", methods=None)
+@login_required
+async def checkout(request):
+    # login_required が読み込んだユーザーを同期部分でも使い、二回読み込まないようにする
+    request.user = await request.auser()
+    prepared = await sync_to_async(prepare_checkout)(request)
+    if isinstance(prepared, HttpResponse):
+        return prepared
+    priced_cart, address = prepared
+
+    # 住所がチェックされていたら決済ページを作成し、決済する画面へ。
+    # 注文は決済完了のWebhookで、この時点のカートの内容から確定する。
+    session = await get_gateway().acreate_checkout_session(
+        request,
+        payment_method_types=["card"],
+        line_items=priced_cart.stripe_line_items(),
+        mode="payment",
+        # 決済画面は仮押さえより先に閉じる（仮押さえは STOCK_RESERVATION_GRACE_SECONDS 秒長い）
+        expires_at=checkout_session_expires_at(),
+        success_url=request.build_absolute_uri("/success/") + "?session_id={CHECKOUT_SESSION_ID}",
+        cancel_url=request.build_absolute_uri("/checkout/")
+    )
+    await Payment.objects.acreate(
+        user=request.user,
+        address=address,
+        session_id=session.id,
+        cart_snapshot=priced_cart.snapshot(),
+        total_price=priced_cart.total_price,
+    )
+
+    return redirect(session.url)
+
+@throttle("success", methods=None)
 @login_required
 def success(request):
     user = request.user
-    address_id = request.GET.get("address_id")
+    session_id = request.GET.get("session_id")
     
-    # 住所がない場合はエラーを出す
-    if not address_id:
-        messages.error(request, "住所を指定してください。")
+    # 決済セッションがない場合はエラーを出す
+    if not session_id:
+        messages.error(request, "決済情報が見つかりません。")
         return redirect("cart")
     
-    address = get_object_or_404(Address, id=address_id, user=user)
-    cart_items = Cart.objects.filter(user=user)
-
-    # カートが空ならリダイレクト
-    if not cart_items.exists():
-        messages.error(request, "カートはからです")
+    # 注文・住所・明細・商品をまとめて読み、テンプレートで明細ごとにクエリを出さない
+    payments = Payment.objects.select_related("order__address").prefetch_related(
+        Prefetch("order__orderitem_set", queryset=OrderItem.objects.select_related("item").order_by("id"))
+    )
+    payment = get_object_or_404(payments, session_id=session_id, user=user)
+
+    # 通常はWebhookで注文が確定済みなので、読むだけで済む。
+    # Webhookより先にブラウザが戻ってきたときは、Stripeに支払い状況を確認してここで確定する。
+    if payment.order is None and payment.status == Payment.STATUS_PENDING:
+        session = get_gateway().retrieve_checkout_session(session_id)
+        if session.payment_status == "paid":
+            try:
+                finalize_checkout(session_id, session.payment_intent or "")
+            except OutOfStockError:
+                pass
+            payment = payments.get(id=payment.id)
+
+    if payment.status == Payment.STATUS_REFUNDED:
+        messages.error(request, "在庫不足のため注文を確定できませんでした。お支払いいただいた代金は返金しました。")
         return redirect("cart")
-    
-    total_price = 0
-
-    for cart_item in cart_items:
-        item_price = cart_item.item.tax_price()
-        item_quantity = cart_item.quantity
-        subtotal = item_price * item_quantity
-        total_price += subtotal
-    
-    not_stock_items = []
-    for cart_item in cart_items:
-        stock_entry = Stock.objects.get(item=cart_item.item)
-        if stock_entry.quantity < cart_item.quantity:
-            not_stock_items.append(cart_item)
-    
-    if not_stock_items:
-        messages.error(request, "在庫不足です。やり直しをお願いします。")
+    if payment.status == Payment.STATUS_FAILED:
+        messages.error(request, "在庫不足のため注文を確定できませんでした。お問い合わせください。")
         return redirect("cart")
+
+    return render(request, "success.html", {"order": payment.order})
+
+# Stripeからの決済完了・期限切れの通知を受け取る
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
     try:
-        # 注文を確定する。注文ーブルを作り、在庫を減らす処理。
-         with transaction.atomic():
-             order = Order.objects.create(user=user, address=address, total_price=total_price)
-             for cart_item in cart_items:
-                 OrderItem.objects.create(
-                 order=order,
-                 item=cart_item.item,
-                 quantity=cart_item.quantity,
-                 subtotal_price=cart_item.item.tax_price() * cart_item.quantity
-                 )
-                 # ここで在庫を減らす。
-                 stock_entry = Stock.objects.get(item=cart_item.item)
-                 stock_entry.quantity -= cart_item.quantity
-                 stock_entry.save()
-        
-             # 注文を確定後にカートの中身を削除する。逆ではダメ
-             cart_items.delete()
-    
-    except Exception as e:
-        messages.error(request, "注文処理中にエラーが発生しました")
-        return redirect("cart")
-    
-    messages.success(request, "ご注文ありがとうございます。注文が確定しました。")
-    return render(request, "success.html",{"order":order})
+        event = get_gateway().construct_event(request.body, request.META.get("HTTP_STRIPE_SIGNATURE", ""))
+    except InvalidWebhook:
+        return HttpResponseBadRequest()
 
+    handle_payment_event(event)
+    return HttpResponse(status=200)
+
+# FakeStripeGateway 用の決済画面。開くと支払い済みになり、success_url に戻る。
+@throttle("checkout", methods=None)
+@login_required
+def fake_stripe_checkout(request, session_id):
+    gateway = get_gateway()
+    if not isinstance(gateway, FakeStripeGateway) or session_id not in gateway.sessions:
+        raise Http404
+    event = gateway.complete(session_id)
+    handle_payment_event(event)
+    return redirect(event["data"]["object"]["success_url"].replace("{CHECKOUT_SESSION_ID}", session_id))
+
+@throttle("account")
 @login_required
 def add_address(request):
     user = request.user
@@ -272,9 +491,18 @@ def add_address(request):
     
     return render(request, "add_address.html", {"form": form})
 
+@replica_reads
 @login_required
 def order_history(request):
     user = request.user
-    orders = Order.objects.filter(user=user).order_by("-created_at")
-    return render(request, "order_history.html", {"orders": orders})
+    # 新しい順にキーセットページネーションで読む。明細と商品は1ページ分まとめて読む。
+    orders = Order.objects.filter(user=user).select_related("address").prefetch_related(
+        Prefetch("orderitem_set", queryset=OrderItem.objects.select_related("item").order_by("id"))
+    )
+    cursor = request.GET.get("cursor")
+    try:
+        page = keyset_page(orders, ("-created_at", "-id"), cursor, settings.ORDER_HISTORY_PAGE_SIZE)
+    except InvalidCursor:
+        return redirect("order_history")
+    return render(request, "order_history.html", {"page": page})
 
@@ -5,6 +5,11 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
+
+checkout is an async view, so serve it through this entry point to let one
+process wait on many payment API calls at once, e.g.:
+
+    gunicorn jibie_ec.asgi:application -k uvicorn.workers.UvicornWorker
 """
 
 import os
@@ -17,6 +17,72 @@ ALLOWED_HOSTS = os.getenv("ALLOWED_HOSTS", "127.0.0.1 localhost").split()
 # ストライプのキー
 STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY", "")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
+
+# 決済に使うクラス。ローカルやテストでは base.payments.FakeStripeGateway を指定するとネットワークなしで動く
+PAYMENT_GATEWAY = os.getenv("PAYMENT_GATEWAY", "base.payments.StripeGateway")
+# Stripeへの通信のタイムアウト（秒）と、ネットワークエラー時のリトライ回数の上限。
+# checkout の決済画面の作成を非同期で待つには httpx が必要（pip install httpx）。
+# 入っていなければ同期の requests で呼び、スレッド（sync_to_async）の中で待つので、
+# ASGIでも同時に待てる数はスレッドの数までになる（起動後最初の呼び出しで警告をログに出す）。
+STRIPE_TIMEOUT = float(os.getenv("STRIPE_TIMEOUT", "10"))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", "2"))
+# FakeStripeGateway が応答を返すまでの秒数（負荷試験用）
+FAKE_STRIPE_LATENCY = float(os.getenv("FAKE_STRIPE_LATENCY", "0"))
+
+# 商品一覧の1ページあたりの件数
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "24"))
+
+# 注文履歴の1ページあたりの件数
+ORDER_HISTORY_PAGE_SIZE = int(os.getenv("ORDER_HISTORY_PAGE_SIZE", "10"))
+
+# ログインしていないお客さんのカートを持つ署名付きCookieの名前・有効期間（秒）・行数の上限
+CART_COOKIE_NAME = "cart"
+CART_COOKIE_AGE = int(os.getenv("CART_COOKIE_AGE", str(60 * 60 * 24 * 30)))
+CART_COOKIE_MAX_LINES = int(os.getenv("CART_COOKIE_MAX_LINES", "50"))
+
+# カートの一括変更API（cart_batch）で一度に送れる行数の上限
+CART_BATCH_MAX_LINES = int(os.getenv("CART_BATCH_MAX_LINES", "100"))
+
+# 商品詳細でカートに一度に追加できる数量の上限（選択肢の数）
+MAX_QUANTITY_PER_ADD = int(os.getenv("MAX_QUANTITY_PER_ADD", "20"))
+
+# Stripeの決済画面の有効期間（秒）。Stripeは作成から30分以上先の期限しか受け付けないので、
+# 秒の切り捨てや通信の遅れがあっても下回らないよう、30分より余裕をもたせる（base.payments.checkout_session_expires_at）。
+CHECKOUT_SESSION_SECONDS = int(os.getenv("CHECKOUT_SESSION_SECONDS", str(35 * 60)))
+# checkout から決済完了まで在庫を仮押さえしておく秒数。決済画面の期限ぎりぎりに支払われても在庫が残っているよう、
+# 決済画面より STOCK_RESERVATION_GRACE_SECONDS 秒長く押さえる。
+STOCK_RESERVATION_GRACE_SECONDS = int(os.getenv("STOCK_RESERVATION_GRACE_SECONDS", "600"))
+STOCK_RESERVATION_SECONDS = CHECKOUT_SESSION_SECONDS + STOCK_RESERVATION_GRACE_SECONDS
+
+# 消費税率（%）。商品の税区分（Item.tax_category）ごとに決める。ジビエなどの食品は軽減税率。
+# 変えたら backfill_tax_prices コマンドで保存している税込み価格を計算し直す。
+TAX_RATES = {
+    "standard": int(os.getenv("TAX_RATE_STANDARD", "10")),
+    "reduced": int(os.getenv("TAX_RATE_REDUCED", "8")),
+}
+
+# 変更系のURLのレート制限（base.throttling）。{スコープ: (1分あたりに補充する回数, 続けて許す回数)}
+# ユーザーごとの値で、同じIPアドレスからは RATE_LIMIT_IP_FACTOR 倍まで許す。超えたら 429 と Retry-After を返す。
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "True") == "True"
+RATE_LIMITS = {
+    "account": (10, 10),  # 会員登録・ログイン・住所登録
+    "cart": (60, 30),  # カートの変更・再注文
+    "checkout": (10, 5),  # 注文確認（POSTで決済サービスを呼ぶ）
+    "success": (30, 10),  # 注文完了（開くたびに決済の確定を試みる）
+}
+RATE_LIMIT_IP_FACTOR = int(os.getenv("RATE_LIMIT_IP_FACTOR", "4"))
+# アプリの前にあるプロキシ（Nginx・ロードバランサー）の段数。0 なら REMOTE_ADDR をお客さんのIPアドレスにする。
+# 1以上なら X-Forwarded-For の右から数えてこの番目のアドレスを使う（左側はお客さんが自由に送れるので使わない）。
+# プロキシはどれも受け取った相手のアドレスを右に付け足すようにしておく
+# （Nginx なら proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;）。
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+
+# フラッシュセールで順番待ちにできる人数（商品ごと）。超えた申し込みは売り切れとして断る
+FLASH_SALE_QUEUE_LIMIT = int(os.getenv("FLASH_SALE_QUEUE_LIMIT", "10000"))
+
+# 売上の集計（rollup_sales）で、作成からこの秒数がたっていない注文は次回に回す（確定の遅れた注文を飛ばさないため）
+SALES_ROLLUP_LAG_SECONDS = int(os.getenv("SALES_ROLLUP_LAG_SECONDS", "60"))
 
 INSTALLED_APPS = [
     "django.contrib.admin",
@@ -29,29 +95,47 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "base.middleware.QueryInstrumentationMiddleware",
+    "base.middleware.ReplicaRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "base.middleware.CartCookieMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
 ROOT_URLCONF = "jibie_ec.urls"
 
+# テンプレートは読み込んで解析した結果をプロセス内に残す（cached ローダー）。本番（DEBUG=False）では常に使う。
+# 開発中も runserver がテンプレートの変更を検知して捨てるので使えるが、TEMPLATE_CACHED_LOADER=False で外せる。
+TEMPLATE_CACHED_LOADER = os.getenv("TEMPLATE_CACHED_LOADER", str(not DEBUG)) == "True"
+TEMPLATE_LOADERS = [
+    "django.template.loaders.filesystem.Loader",
+    "django.template.loaders.app_directories.Loader",
+]
+# {% cache %} で保存するテンプレートの断片（ヘッダーなど）の有効期間（秒）
+TEMPLATE_FRAGMENT_CACHE_SECONDS = int(os.getenv("TEMPLATE_FRAGMENT_CACHE_SECONDS", "600"))
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
         "DIRS": [BASE_DIR / "templates"],
-        "APP_DIRS": True,
         "OPTIONS": {
             "context_processors": [
                 "django.template.context_processors.debug",
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "base.context_processors.fragment_cache",
             ],
+            "loaders": (
+                [("django.template.loaders.cached.Loader", TEMPLATE_LOADERS)]
+                if TEMPLATE_CACHED_LOADER
+                else TEMPLATE_LOADERS
+            ),
         },
     },
 ]
@@ -67,6 +151,51 @@ DATABASES = {
         "PASSWORD": os.getenv("DB_PASSWORD", ""),
         "HOST": os.getenv("DB_HOST", ""),
         "PORT": os.getenv("DB_PORT", ""),
+        # 接続を DB_CONN_MAX_AGE 秒使い回し、使い回す前に切れていないか確かめる
+        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "60")),
+        "CONN_HEALTH_CHECKS": True,
+    }
+}
+
+# 読み込み専用のレプリカ。DB_REPLICAS に空白区切りで並べる（PostgreSQL などは host か host:port、SQLite はファイルのパス）。
+# 接続の設定はプライマリーと同じものを使う。商品一覧・商品詳細・検索・注文履歴の読み込みだけをレプリカに振り分ける（base.routers）。
+# テストではプライマリーをそのまま使う（MIRROR）。
+DATABASE_REPLICAS = []
+for number, location in enumerate(os.getenv("DB_REPLICAS", "").split(), start=1):
+    replica = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+    if replica["ENGINE"].endswith("sqlite3"):
+        replica["NAME"] = location
+    else:
+        replica["HOST"], _, port = location.partition(":")
+        replica["PORT"] = port or replica["PORT"]
+    DATABASES[f"replica{number}"] = replica
+    DATABASE_REPLICAS.append(f"replica{number}")
+
+DATABASE_ROUTERS = ["base.routers.ReplicaRouter"]
+# 書き込んだお客さんの読み込みをプライマリーに固定する秒数（レプリカの遅れとして見込む時間）
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+REPLICA_STICKY_COOKIE = "db_primary"
+# 接続できなかったレプリカを使わずにおく秒数
+REPLICA_RETRY_SECONDS = int(os.getenv("REPLICA_RETRY_SECONDS", "30"))
+
+# 商品一覧・商品詳細のキャッシュ。ローカルメモリかファイル（CACHE_BACKEND / CACHE_LOCATION）を使う。
+# エントリは TIMEOUT 秒で期限切れになり、MAX_ENTRIES を超えると 1/CULL_FREQUENCY ずつ間引かれる。
+# 商品や在庫が変わったときの無効化（バージョンを上げる）は、変更したプロセスのキャッシュにしか届かない。
+# レート制限（RATE_LIMITS）のバケットもここに持つ。Webのワーカーが複数あるときは、すべてのプロセスで共有する
+# キャッシュ（CACHE_BACKEND=django.core.cache.backends.redis.RedisCache、CACHE_LOCATION=redis://... など）にする。
+# ローカルメモリのままだと（check --deploy で警告する）、
+# - ほかのプロセスは古い商品一覧・商品詳細を TIMEOUT 秒まで（テンプレートの断片は TEMPLATE_FRAGMENT_CACHE_SECONDS 秒まで）
+#   表示し続け、その内容から作った ETag・Last-Modified で 304 も返す
+# - レート制限の上限がワーカーの数だけ倍になる
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("CACHE_LOCATION", "jibie-ec"),
+        "TIMEOUT": int(os.getenv("CACHE_TIMEOUT", "300")),
+        "OPTIONS": {
+            "MAX_ENTRIES": int(os.getenv("CACHE_MAX_ENTRIES", "10000")),
+            "CULL_FREQUENCY": int(os.getenv("CACHE_CULL_FREQUENCY", "3")),
+        },
     }
 }
 
@@ -95,6 +224,12 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# 商品画像の縮小版（WebP / JPEG）の幅と画質。作成はプロセスプールで行う。
+IMAGE_DERIVATIVE_WIDTHS = [int(width) for width in os.getenv("IMAGE_DERIVATIVE_WIDTHS", "200 400 800").split()]
+IMAGE_DERIVATIVE_QUALITY = int(os.getenv("IMAGE_DERIVATIVE_QUALITY", "80"))
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv("IMAGE_DERIVATIVE_WORKERS", "2"))
+IMAGE_DERIVATIVES_ASYNC = os.getenv("IMAGE_DERIVATIVES_ASYNC", "True") == "True"
+
 AUTH_USER_MODEL = "base.User"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
@@ -105,14 +240,31 @@ CSRF_COOKIE_SECURE = not DEBUG  # HTTPS のみで CSRF トークンを送信
 X_FRAME_OPTIONS = "DENY"  # クリックジャッキング対策
 
 # ✅ メール設定（注文確認メール用）
-EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+# ローカルでは EMAIL_BACKEND=django.core.mail.backends.console.EmailBackend にすると画面に出力する
+EMAIL_BACKEND = os.getenv("EMAIL_BACKEND", "django.core.mail.backends.smtp.EmailBackend")
 EMAIL_HOST = os.getenv("EMAIL_HOST", "smtp.gmail.com")
 EMAIL_PORT = os.getenv("EMAIL_PORT", "587")
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER", "")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD", "")
+EMAIL_TIMEOUT = float(os.getenv("EMAIL_TIMEOUT", "10"))
+DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL", EMAIL_HOST_USER or "webmaster@localhost")
+
+# 注文確認メールのアウトボックス（send_outbox コマンド）。
+# 送信に失敗したら OUTBOX_RETRY_BASE_SECONDS 秒から倍々に待って（上限 OUTBOX_RETRY_MAX_SECONDS 秒）送り直し、
+# OUTBOX_MAX_ATTEMPTS 回失敗したら諦める。取り出したワーカーが OUTBOX_LEASE_SECONDS 秒以内に
+# 結果を書き込まなければ（途中で落ちたなど）、別のワーカーが取り出し直す。
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = int(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "60"))
+OUTBOX_RETRY_MAX_SECONDS = int(os.getenv("OUTBOX_RETRY_MAX_SECONDS", str(60 * 60 * 6)))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
 
 # ✅ ログ設定（エラーを記録する）
+# ビューごとのSQL件数・処理時間は logs/perf.jsonl に、別スレッドで書き出す
+PERF_INSTRUMENTATION = os.getenv("PERF_INSTRUMENTATION", "True") == "True"
+# 同じ形のクエリがこの回数以上実行されたらN+1の疑いとして記録する
+PERF_N_PLUS_ONE_THRESHOLD = int(os.getenv("PERF_N_PLUS_ONE_THRESHOLD", "3"))
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -122,6 +274,11 @@ LOGGING = {
             "class": "logging.FileHandler",
             "filename": BASE_DIR / "logs/error.log",
         },
+        "perf": {
+            "level": "INFO",
+            "class": "base.perflog.QueueFileHandler",
+            "filename": BASE_DIR / "logs/perf.jsonl",
+        },
     },
     "loggers": {
         "django": {
@@ -129,5 +286,10 @@ LOGGING = {
             "level": "ERROR",
             "propagate": True,
         },
+        "base.perf": {
+            "handlers": ["perf"],
+            "level": "INFO",
+            "propagate": False,
+        },
     },
 }
\ No newline at end of file